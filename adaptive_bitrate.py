@@ -0,0 +1,161 @@
+"""
+Adaptive bitrate for the merged streams sent to clients.
+Clients report the packet loss of their merged stream as OSC message
+    /surfacestreams/feedback <uuid:str> <loss:float 0..1>
+on the TUIO port (see tuio_forwarding.FEEDBACK_PATH). Per client an AIMD controller
+lowers the encoder bitrate multiplicatively while the link loses packets,
+then the frame rate once the bitrate is at its minimum, and restores both
+additively once the link recovered.
+"""
+
+import queue
+import threading
+import time
+import encoding_profiles
+import video_mixing
+from client_registry import registry
+from notifications import hub
+
+
+# loss above which the stream is degraded, below which it is restored
+LOSS_HIGH = 0.05
+
+LOSS_LOW = 0.01
+
+# multiplicative decrease and additive increase (kbit/s) of the bitrate
+DECREASE_FACTOR = 0.7
+
+INCREASE_STEP = 100
+
+MIN_BITRATE = 200
+
+# video_protocols whose default encoder has no bitrate control (only the frame rate is adapted)
+FIXED_QUALITY_PROTOCOLS = ["jpeg"]
+
+MIN_FPS = 5
+
+# seconds between two adjustments of the same client, lets the link settle
+ADJUST_INTERVAL = 1.0
+
+
+class _LinkState(object):
+    def __init__(self, bitrate, fps, bitrate_control=True):
+        self.bitrate_control = bitrate_control
+        self.target_bitrate = bitrate
+        self.target_fps = fps
+        self.bitrate = bitrate
+        self.fps = fps
+        self.last_adjust = 0.0
+
+    def degraded(self):
+        return self.bitrate < self.target_bitrate or self.fps < self.target_fps
+
+
+class AdaptiveBitrateController(object):
+    """
+    Applies loss feedback to the mixer on a background thread,
+    so feedback can be reported from the TUIO forwarding loop without blocking it.
+    """
+    def __init__(self, tune=video_mixing.tune_client, get_bitrate=video_mixing.get_output_bitrate):
+        self._tune = tune
+        self._get_bitrate = get_bitrate
+        self._links = {}
+        self._feedback = queue.Queue()
+        self._thread = None
+
+    def feedback(self, uuid, loss):
+        """
+        Reports the packet loss of a client's merged stream.
+        :param uuid: uuid of the client
+        :param loss: fraction of lost packets since the last report
+        :return:
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="adaptive-bitrate", daemon=True)
+            self._thread.start()
+        self._feedback.put((uuid, loss))
+
+    def forget(self, uuid):
+        self._feedback.put((uuid, None))
+
+    def get_links(self):
+        return {
+            uuid: {"bitrate": link.bitrate, "fps": link.fps, "degraded": link.degraded()}
+            for uuid, link in list(self._links.items())
+        }
+
+    def _run(self):
+        while True:
+            uuid, loss = self._feedback.get()
+            if loss is None:
+                self._links.pop(uuid, None)
+                continue
+            try:
+                self._adjust(uuid, loss)
+            except Exception as e:
+                print("###### could not adapt bitrate of", uuid, "\n  >", e)
+
+    def _link(self, uuid):
+        link = self._links.get(uuid, None)
+        if link is None:
+            client = registry.get(uuid)
+            if client is None:
+                return None
+            encoding = encoding_profiles.resolve(client.get("encoding_profile") or "")
+            if encoding is not None:
+                bitrate_control = encoding["bitrate"] is not None
+            else:
+                bitrate_control = client["video_protocol"] not in FIXED_QUALITY_PROTOCOLS
+            bitrate = client.get("output_bitrate", -1)
+            if bitrate <= 0 and bitrate_control:
+                # start from what the encoder really sends, its defaults are far below any guess
+                bitrate = self._get_bitrate(uuid)
+            if bitrate <= 0:
+                # unknown bitrate, only the frame rate is adapted
+                bitrate_control = False
+            fps = client.get("output_fps", -1)
+            link = _LinkState(bitrate, fps if fps > 0 else video_mixing.MERGED_STREAM_FPS, bitrate_control)
+            self._links[uuid] = link
+        return link
+
+    def _adjust(self, uuid, loss):
+        link = self._link(uuid)
+        if link is None:
+            return
+        now = time.monotonic()
+        if now - link.last_adjust < ADJUST_INTERVAL:
+            return
+        bitrate, fps = link.bitrate, link.fps
+        if loss > LOSS_HIGH:
+            if link.bitrate_control and bitrate > MIN_BITRATE:
+                bitrate = max(MIN_BITRATE, int(bitrate * DECREASE_FACTOR))
+            else:
+                fps = max(MIN_FPS, fps // 2)
+        elif loss < LOSS_LOW and link.degraded():
+            # frame rate first, it costs the least bandwidth per step
+            if fps < link.target_fps or not link.bitrate_control:
+                fps = min(link.target_fps, fps * 2)
+            else:
+                bitrate = min(link.target_bitrate, bitrate + INCREASE_STEP)
+        if (bitrate, fps) == (link.bitrate, link.fps):
+            return
+        link.bitrate, link.fps, link.last_adjust = bitrate, fps, now
+        # back at target, the configured values apply again
+        self._tune(
+            uuid,
+            bitrate if bitrate < link.target_bitrate else -1,
+            fps if fps < link.target_fps else -1
+        )
+        hub.publish("stream-adapted", {"uuid": uuid, "loss": loss, "bitrate": bitrate, "fps": fps})
+
+
+# controller shared by the TUIO forwarder and the metrics
+controller = AdaptiveBitrateController()
+
+
+def _on_client_event(event, client, previous):
+    # changed output settings are new targets
+    controller.forget(client["uuid"])
+
+
+registry.subscribe(_on_client_event)
@@ -0,0 +1,501 @@
+"""
+End-to-end benchmark of a running SurfaceStreams server on localhost.
+Registers N fake surfaces through the REST API, streams videotestsrc video
+to their video_src_port, sends synthetic TUIO to the forwarder and records
+server cpu, per-sink throughput, glass-to-glass latency and TUIO forward
+latency into a json results file.
+
+Glass-to-glass latency is measured with flashes: surface 0 sends black
+(keyed out by the mixer) and switches to white once per second, the other
+surfaces time until their merged stream turns bright.
+
+    python benchmark.py --surfaces 4 --duration 30 --server-pid <pid> --output results.json
+
+With --compositing no server is needed, the keying and compositing of the
+'numpy' mixing backend is timed against the alpha -> compositor element chain:
+
+    python benchmark.py --compositing --surfaces 4 --output compositing.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import urllib.request
+from datetime import datetime
+import numpy as np
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+from pythonosc import osc_message_builder, osc_bundle_builder, osc_packet
+from incremental_mixer import STREAM_PROTOCOLS, ALPHA_KEY, _make, _raw_caps
+import measurement_analysis
+import numpy_mixer
+
+
+API_URL = "http://127.0.0.1:5000/api"
+
+TUIO_FORWARDER = ("127.0.0.1", 5001)
+
+# seconds to wait for the pipeline job of the registrations
+REGISTRATION_TIMEOUT = 30.0
+
+# seconds of streaming before measuring starts
+WARMUP = 3.0
+
+# frame sizes of the compositing micro-benchmark
+COMPOSITING_SIZES = ((640, 360), (1280, 720), (1280, 960))
+
+# mean luma of a merged frame counting as flash
+FLASH_THRESHOLD = 128
+
+FLASH_DURATION = 0.2
+
+
+def api_request(method, path, body=None, api_url=API_URL):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(api_url + path, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as res:
+        payload = res.read()
+        location = res.headers.get("Location")
+    try:
+        payload = json.loads(payload.decode())
+    except ValueError:
+        payload = payload.decode()
+    return payload, location
+
+
+def wait_for_job(location, api_url=API_URL, timeout=REGISTRATION_TIMEOUT):
+    """ polls a pipeline job (see /pipeline/jobs) until it is done. """
+    if location is None:
+        return True
+    path = location[len("/api"):] if location.startswith("/api") else location
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job, _ = api_request("GET", path, api_url=api_url)
+        if job["status"] in ("done", "failed"):
+            return job["status"] == "done"
+        time.sleep(0.2)
+    return False
+
+
+class FakeSurface(object):
+    """
+    A registered client sending video and receiving its merged stream.
+    Received bytes and frames are counted, bright frames are reported to on_bright.
+    """
+    def __init__(self, name, protocol, width, height, fps, flash=False):
+        self.name = name
+        self.protocol = protocol
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.flash = flash
+        self.client = None
+        self.received_bytes = 0
+        self.received_frames = 0
+        self.on_bright = None
+        self._bright = False
+        self._sender = None
+        self._receiver = None
+        self._source = None
+
+    def register(self, api_url=API_URL):
+        body = {
+            "name": self.name, "ip": "127.0.0.1", "video_protocol": self.protocol,
+            "video_src_port": -1, "video_sink_port": -1, "tuio_sink_port": -1, "mixing_mode": "other"
+        }
+        self.client, location = api_request("POST", "/clients", body, api_url)
+        return location
+
+    def unregister(self, api_url=API_URL):
+        if self.client is not None:
+            api_request("DELETE", "/clients/" + self.client["uuid"], api_url=api_url)
+            self.client = None
+
+    def start(self):
+        protocol = STREAM_PROTOCOLS[self.protocol]
+        self._source = _make("videotestsrc", {"is-live": True, "pattern": "black" if self.flash else "ball"})
+        self._sender = self._pipeline([
+            self._source,
+            _make("capsfilter", {"caps": _raw_caps(self.width, self.height, self.fps)}),
+            _make("videoconvert"),
+            _make(*protocol["encode"]),
+            _make(*protocol["pay"]),
+            _make("udpsink", {"host": "127.0.0.1", "port": self.client["video_src_port"], "sync": False})
+        ])
+        udpsrc = _make("udpsrc", {"port": self.client["video_sink_port"], "caps": protocol["caps"]})
+        appsink = _make("appsink", {"emit-signals": True, "sync": False, "max-buffers": 1, "drop": True})
+        appsink.connect("new-sample", self._on_sample)
+        self._receiver = self._pipeline([
+            udpsrc,
+            _make(*protocol["depay"]),
+            _make(*protocol["decode"]),
+            _make("videoconvert"),
+            _make("capsfilter", {"caps": "video/x-raw, format=GRAY8"}),
+            appsink
+        ])
+        udpsrc.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._on_packet)
+        self._receiver.set_state(Gst.State.PLAYING)
+        self._sender.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        for pipeline in (self._sender, self._receiver):
+            if pipeline is not None:
+                pipeline.set_state(Gst.State.NULL)
+
+    def set_flash(self, on):
+        Gst.util_set_object_arg(self._source, "pattern", "white" if on else "black")
+
+    @staticmethod
+    def _pipeline(elements):
+        pipeline = Gst.Pipeline.new(None)
+        for e in elements:
+            pipeline.add(e)
+        for a, b in zip(elements, elements[1:]):
+            a.link(b)
+        return pipeline
+
+    def _on_packet(self, pad, info):
+        self.received_bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def _on_sample(self, appsink):
+        received = time.monotonic()
+        buf = appsink.emit("pull-sample").get_buffer()
+        self.received_frames += 1
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if ok:
+            bright = np.frombuffer(info.data, dtype=np.uint8)[::64].mean() > FLASH_THRESHOLD
+            buf.unmap(info)
+            if bright and not self._bright and self.on_bright is not None:
+                self.on_bright(self, received)
+            self._bright = bright
+        return Gst.FlowReturn.OK
+
+
+class TuioBlaster(object):
+    """
+    Sends TUIO cursor frames (set, alive, fseq) at a fixed rate to the forwarder
+    and times their arrival at the TUIO sinks of the surfaces.
+    """
+    def __init__(self, rate, cursors=5, target=TUIO_FORWARDER):
+        self.rate = rate
+        self.cursors = cursors
+        self.target = target
+        self.sent = 0
+        self.latencies = []
+        self._send_times = {}
+        self._running = False
+        self._threads = []
+
+    def start(self, sink_ports):
+        self._running = True
+        self._threads = [threading.Thread(target=self._send, daemon=True)]
+        for port in sink_ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", port))
+            sock.settimeout(0.5)
+            self._threads.append(threading.Thread(target=self._receive, args=(sock,), daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._running = False
+        for t in self._threads:
+            t.join()
+
+    def _send(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        fseq = 0
+        interval = 1.0 / self.rate
+        next_send = time.monotonic()
+        while self._running:
+            fseq += 1
+            bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+            for s_id in range(self.cursors):
+                x = (fseq % 100) / 100.0
+                bundle.add_content(self._message(["set", s_id, x, x, 0.0, 0.0, 0.0]))
+            bundle.add_content(self._message(["alive"] + list(range(self.cursors))))
+            bundle.add_content(self._message(["fseq", fseq]))
+            self._send_times[fseq] = time.monotonic()
+            sock.sendto(bundle.build().dgram, self.target)
+            self.sent += 1
+            next_send += interval
+            time.sleep(max(0.0, next_send - time.monotonic()))
+        sock.close()
+
+    @staticmethod
+    def _message(args):
+        builder = osc_message_builder.OscMessageBuilder(address="/tuio/2Dcur")
+        for arg in args:
+            builder.add_arg(arg)
+        return builder.build()
+
+    def _receive(self, sock):
+        while self._running:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            received = time.monotonic()
+            try:
+                messages = osc_packet.OscPacket(data).messages
+            except osc_packet.ParseError:
+                continue
+            for m in messages:
+                params = m.message.params
+                if len(params) >= 2 and params[0] == "fseq" and params[1] in self._send_times:
+                    self.latencies.append(received - self._send_times[params[1]])
+        sock.close()
+
+
+def process_cpu_seconds(pid):
+    """ user + system cpu seconds of a process and all of its children (mixer workers). """
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        # fields after the command: state ppid ... utime(12) stime(13)
+        stats[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks)
+    pids = {pid}
+    changed = True
+    while changed:
+        children = {p for p, (ppid, _) in stats.items() if ppid in pids} - pids
+        changed = len(children) > 0
+        pids |= children
+    return sum(stats[p][1] for p in pids if p in stats)
+
+
+def run_benchmark(surfaces=4, duration=30.0, protocol="jpeg", width=640, height=360, fps=30,
+                  tuio_rate=60, server_pid=None, api_url=API_URL):
+    """
+    Runs one benchmark against a running server.
+    :param surfaces: number of fake surfaces (at least 2 for glass-to-glass latency)
+    :param duration: measuring seconds
+    :param protocol: video_protocol of the surfaces
+    :param width: width of the sent streams
+    :param height: height of the sent streams
+    :param fps: frame rate of the sent streams
+    :param tuio_rate: TUIO frames per second (0 disables)
+    :param server_pid: pid of the server for cpu measurements (None disables)
+    :param api_url: url of the server api
+    :return: dict of results
+    """
+    Gst.init(None)
+    fakes = [FakeSurface("benchmark-" + str(i), protocol, width, height, fps, flash=(i == 0))
+             for i in range(surfaces)]
+    flashes = []
+    g2g = []
+
+    def _on_bright(surface, received):
+        if len(flashes) > 0 and received >= flashes[-1]:
+            g2g.append(received - flashes[-1])
+
+    blaster = None
+    try:
+        locations = [f.register(api_url) for f in fakes]
+        if not wait_for_job(locations[-1], api_url):
+            raise RuntimeError("pipeline did not pick up the benchmark surfaces")
+        for f in fakes:
+            f.on_bright = _on_bright
+            f.start()
+        if tuio_rate > 0:
+            blaster = TuioBlaster(tuio_rate)
+            blaster.start([f.client["tuio_sink_port"] for f in fakes])
+        time.sleep(WARMUP)
+
+        start_bytes = [f.received_bytes for f in fakes]
+        start_frames = [f.received_frames for f in fakes]
+        start_cpu = process_cpu_seconds(server_pid) if server_pid is not None else None
+        started = time.monotonic()
+        while time.monotonic() - started < duration:
+            flashes.append(time.monotonic())
+            fakes[0].set_flash(True)
+            time.sleep(FLASH_DURATION)
+            fakes[0].set_flash(False)
+            time.sleep(max(0.0, 1.0 - FLASH_DURATION))
+        elapsed = time.monotonic() - started
+        cpu = process_cpu_seconds(server_pid) - start_cpu if server_pid is not None else None
+        server_metrics, _ = api_request("GET", "/metrics", api_url=api_url)
+    finally:
+        if blaster is not None:
+            blaster.stop()
+        for f in fakes:
+            f.stop()
+            f.unregister(api_url)
+
+    return {
+        "created": datetime.now().isoformat(),
+        "config": {
+            "surfaces": surfaces, "duration": duration, "protocol": protocol,
+            "width": width, "height": height, "fps": fps, "tuio_rate": tuio_rate
+        },
+        "server_cpu_percent": 100.0 * cpu / elapsed if cpu is not None else None,
+        "sinks": {
+            f.name: {
+                "bytes_per_second": (f.received_bytes - b) / elapsed,
+                "frames_per_second": (f.received_frames - n) / elapsed
+            } for f, b, n in zip(fakes, start_bytes, start_frames)
+        },
+        "glass_to_glass_latency_ms": measurement_analysis.summarize(np.asarray(g2g) * 1000.0),
+        "tuio": {
+            "sent_per_second": blaster.sent / elapsed if blaster is not None else 0.0,
+            "forward_latency_ms": measurement_analysis.summarize(
+                np.asarray(blaster.latencies if blaster is not None else []) * 1000.0
+            )
+        },
+        "server_metrics": server_metrics
+    }
+
+
+def _test_frame(width, height, seed):
+    """ RGB frame with a keyed out (black) background and a bright rectangle. """
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    x, y = rng.integers(0, width // 2), rng.integers(0, height // 2)
+    frame[y:y + height // 2, x:x + width // 2] = rng.integers(64, 256, size=3, dtype=np.uint8)
+    return frame
+
+
+def time_numpy_compositing(width, height, inputs, frames):
+    """
+    Times one mixing interval of the numpy backend with N 'other' outputs, as NumpyVideoMixer does it:
+    copying each input out of its sample, prefix and suffix composites,
+    the final blend of every output and wrapping it into a buffer for its appsrc.
+    Inputs are pre-generated, so frame generation is not part of the figure.
+    :return: ms per mixing interval
+    """
+    samples = [_test_frame(width, height, i).tobytes() for i in range(inputs)]
+    background = np.zeros((height, width, 3), dtype=np.uint8)
+    started = time.perf_counter()
+    for _ in range(frames):
+        layers = [np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3)).copy() for data in samples]
+        prefixes, suffixes = numpy_mixer.composite_layers(layers, background)
+        for i in range(inputs):
+            merged = prefixes[i].copy()
+            img, mask = suffixes[i + 1]
+            numpy_mixer.blend(merged, img, mask)
+            Gst.Buffer.new_wrapped(merged.tobytes())
+    return 1000.0 * (time.perf_counter() - started) / frames
+
+
+def _run_to_eos(pipeline):
+    bus = pipeline.get_bus()
+    started = time.perf_counter()
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = time.perf_counter() - started
+    pipeline.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        raise RuntimeError(msg.parse_error()[0].message)
+    return elapsed
+
+
+def _add_chain(pipeline, elements):
+    for e in elements:
+        pipeline.add(e)
+    for a, b in zip(elements, elements[1:]):
+        a.link(b)
+    return elements
+
+
+def _element_pipeline(width, height, inputs, frames, mixing):
+    """
+    N videotestsrc -> alpha -> tee, each tee linked through a queue to the compositor
+    of every other input ('other' outputs of the direct topology), compositors -> fakesink.
+    Without mixing the sources end in fakesinks, which is the baseline of frame generation.
+    """
+    pipeline = Gst.Pipeline.new("compositing-benchmark")
+    tees = []
+    for i in range(inputs):
+        chain = [
+            _make("videotestsrc", {"num-buffers": frames, "pattern": "ball", "is-live": False}),
+            _make("capsfilter", {"caps": _raw_caps(width, height, 30)})
+        ]
+        chain += [_make("alpha", ALPHA_KEY), _make("tee")] if mixing else [_make("fakesink", {"sync": False})]
+        tees.append(_add_chain(pipeline, chain)[-1])
+    if not mixing:
+        return pipeline
+    for k in range(inputs):
+        compositor, _ = _add_chain(pipeline, [
+            _make("compositor", {"background": "black"}), _make("fakesink", {"sync": False})
+        ])
+        for i, tee in enumerate(tees):
+            if i != k:
+                queue = _make("queue")
+                pipeline.add(queue)
+                tee.link(queue)
+                queue.link(compositor)
+    return pipeline
+
+
+def time_element_compositing(width, height, inputs, frames):
+    """
+    Times the element chain of the 'elements' backend with N 'other' outputs:
+    keying once per input and one compositor per output.
+    The time of a pipeline which only generates the input frames is subtracted.
+    :return: ms per mixing interval
+    """
+    mixing = _run_to_eos(_element_pipeline(width, height, inputs, frames, True))
+    baseline = _run_to_eos(_element_pipeline(width, height, inputs, frames, False))
+    return 1000.0 * max(0.0, mixing - baseline) / frames
+
+
+def compositing_benchmark(sizes=COMPOSITING_SIZES, inputs=4, frames=100):
+    """
+    Micro-benchmark of the mixing backends without network or codecs.
+    Both figures cover keying and composing the merged frames of all N outputs of a group.
+    :param sizes: (width, height) frame sizes
+    :param inputs: number of keyed inputs (and 'other' outputs)
+    :param frames: frames per measurement
+    :return: dict of results
+    """
+    Gst.init(None)
+    return {
+        "created": datetime.now().isoformat(),
+        "config": {"inputs": inputs, "outputs": inputs, "frames": frames},
+        "sizes": {
+            "{}x{}".format(w, h): {
+                "numpy_ms_per_interval": time_numpy_compositing(w, h, inputs, frames),
+                "elements_ms_per_interval": time_element_compositing(w, h, inputs, frames)
+            } for w, h in sizes
+        }
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SurfaceStreams end-to-end benchmark")
+    parser.add_argument("--surfaces", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--protocol", default="jpeg", choices=sorted(STREAM_PROTOCOLS.keys()))
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--tuio-rate", type=int, default=60)
+    parser.add_argument("--server-pid", type=int, default=None)
+    parser.add_argument("--api", default=API_URL)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compositing", action="store_true",
+                        help="time the mixing backends only (--surfaces inputs), no server needed")
+    parser.add_argument("--frames", type=int, default=100)
+    args = parser.parse_args()
+    if args.compositing:
+        results = compositing_benchmark(inputs=args.surfaces, frames=args.frames)
+        summary = [json.dumps(results["sizes"], indent=2)]
+    else:
+        results = run_benchmark(args.surfaces, args.duration, args.protocol, args.width, args.height, args.fps,
+                                args.tuio_rate, args.server_pid, args.api)
+        summary = [json.dumps(results["glass_to_glass_latency_ms"]), json.dumps(results["tuio"])]
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(*summary)
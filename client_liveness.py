@@ -0,0 +1,93 @@
+"""
+Liveness probes for registered clients, used on warm restarts to drop
+clients which went away while the server was down.
+A client counts as dead if its host answers a probe datagram with
+'port unreachable' (or the host is unreachable), clients which stay
+silent are kept, udp sinks never answer.
+"""
+
+import errno
+import select
+import socket
+import time
+from client_registry import registry
+
+
+# seconds to wait for ICMP errors of all probes
+PROBE_TIMEOUT = 1.0
+
+# empty OSC bundle with 'immediately' time tag, ignored by TUIO clients
+EMPTY_OSC_BUNDLE = b"#bundle\x00" + b"\x00\x00\x00\x00\x00\x00\x00\x01"
+
+_DEAD_ERRORS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN)
+
+
+def _probe_address(client):
+    """
+    Returns (address, payload) to probe a client with.
+    The TUIO sink receives an empty OSC bundle, clients without TUIO sink an empty datagram on their video sink.
+    """
+    if client.get("tuio_sink_port", -1) > 0:
+        return (client["ip"], client["tuio_sink_port"]), EMPTY_OSC_BUNDLE
+    if client.get("video_sink_port", -1) > 0:
+        return (client["ip"], client["video_sink_port"]), b""
+    return None, None
+
+
+def probe_clients(clients, timeout=PROBE_TIMEOUT):
+    """
+    Probes all clients at once.
+    Connected udp sockets receive ICMP errors of their peer as socket errors.
+    :param clients: list of client dicts
+    :param timeout: seconds to wait for answers
+    :return: list of uuids of dead clients
+    """
+    probes = {}
+    dead = []
+    for c in clients:
+        address, payload = _probe_address(c)
+        if address is None or address[0] in ("", "0.0.0.0"):
+            continue
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(address)
+            sock.send(payload)
+        except OSError as e:
+            sock.close()
+            if e.errno in _DEAD_ERRORS:
+                dead.append(c["uuid"])
+            continue
+        probes[sock] = c["uuid"]
+
+    deadline = time.monotonic() + timeout
+    while len(probes) > 0:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        readable, _, _ = select.select(list(probes.keys()), [], [], remaining)
+        for sock in readable:
+            uuid = probes.pop(sock)
+            try:
+                sock.recv(1)
+            except OSError as e:
+                if e.errno in _DEAD_ERRORS:
+                    dead.append(uuid)
+            sock.close()
+    for sock in probes.keys():
+        sock.close()
+    return dead
+
+
+def remove_dead_clients(timeout=PROBE_TIMEOUT):
+    """
+    Probes all registered clients and removes the dead ones from the registry.
+    :param timeout: seconds to wait for answers
+    :return: list of removed client dicts
+    """
+    removed = []
+    for uuid in probe_clients(registry.get_all(), timeout):
+        c = registry.remove(uuid)
+        if c is not None:
+            removed.append(c)
+    return removed
@@ -0,0 +1,112 @@
+"""
+Background reaper for clients which went away without deleting themselves.
+A client is expired if its heartbeat lease ran out, or if it never heartbeats
+and neither its video input nor its TUIO input showed activity for a while.
+Removals go through the registry, so the mixer is updated by a single
+debounced reconfiguration per reaping pass.
+"""
+
+import threading
+import time
+from datetime import datetime
+import video_mixing
+from client_registry import registry, _to_datetime
+
+
+# seconds between reaping passes
+REAP_INTERVAL = 5.0
+
+# seconds a heartbeat keeps a client alive (see PUT /clients/{uuid}/heartbeat)
+LEASE_SECONDS = 30.0
+
+# seconds without video buffers and TUIO messages before a client without lease is expired
+INACTIVITY_TIMEOUT = 60.0
+
+# seconds after joining (or changing) during which inactivity is not held against a client
+JOIN_GRACE = 30.0
+
+
+def _seconds_since(value, now):
+    if value is None:
+        return None
+    return (now - _to_datetime(value)).total_seconds()
+
+
+class ClientReaper(object):
+    """
+    Periodically expires stale clients.
+    :param tuio_activity: callable returning seconds since the last TUIO datagram of an ip (None if never)
+    """
+    def __init__(self, tuio_activity=None):
+        self.tuio_activity = tuio_activity
+        self.reaped = 0
+        self._started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="client-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(REAP_INTERVAL):
+            try:
+                self.reap()
+            except Exception as e:
+                print("###### reaping clients failed\n  >", e)
+
+    def is_expired(self, client, stats, now):
+        """
+        Decides if a client is dead.
+        :param client: client dict
+        :param stats: mixer branch counters of the client, None if it is not mixed
+        :param now: current datetime
+        :return: reason of expiry, None if the client is alive
+        """
+        # clients restored by a warm restart get a full lease / timeout to show up again
+        uptime = time.monotonic() - self._started if self._started is not None else 0
+        since_heartbeat = _seconds_since(client.get("last_seen"), now)
+        if since_heartbeat is not None:
+            return "lease expired" if min(since_heartbeat, uptime) > LEASE_SECONDS else None
+        since_join = _seconds_since(client.get("created_datetime"), now)
+        if since_join is None or stats is None:
+            return None
+        since_join = min(since_join, uptime)
+        if since_join < JOIN_GRACE:
+            return None
+        # a rebuilt branch starts without buffers, its inactivity counts from the rebuild
+        since_video = stats["in"]["seconds_since_last_buffer"]
+        since_branch = stats["in"]["seconds_since_created"]
+        idle = min(since_video, since_branch) if since_video >= 0 else since_branch
+        if idle < INACTIVITY_TIMEOUT:
+            return None
+        since_tuio = self.tuio_activity(client["ip"]) if self.tuio_activity is not None else None
+        if since_tuio is not None and since_tuio < INACTIVITY_TIMEOUT:
+            return None
+        return "inactive"
+
+    def reap(self):
+        """
+        Runs one reaping pass.
+        :return: list of removed client dicts
+        """
+        stats = video_mixing.get_pipeline_stats()
+        now = datetime.now()
+        removed = []
+        for c in registry.get_all():
+            reason = self.is_expired(c, stats.get(c["uuid"], None), now)
+            if reason is None:
+                continue
+            if registry.remove(c["uuid"]) is not None:
+                print("###### reaped client", c["uuid"], c["name"], "\n  >", reason)
+                removed.append(c)
+        self.reaped += len(removed)
+        return removed
@@ -0,0 +1,202 @@
+"""
+In-memory registry of connected clients.
+Single in-process source of truth for client data: reads and counts are
+answered from memory, changes are written through to the database on a
+background thread and published to subscribers (video mixing, TUIO forwarding).
+"""
+
+import queue
+import threading
+from datetime import datetime
+from database.api import ClientApi
+from database.base import engine
+
+
+CREATED = "created"
+
+UPDATED = "updated"
+
+DELETED = "deleted"
+
+
+def _to_datetime(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f") if "." in value \
+        else datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+class ClientRegistry(object):
+    """
+    Thread-safe map of client uuid to client dict (see Client.as_dict).
+    Subscribers are called as callback(event, client, previous) with event
+    one of CREATED, UPDATED, DELETED and previous the client dict before an update.
+    Changes are queued for writing and published while the registry lock is held,
+    so the writer and all subscribers see them in the order they were applied.
+    Subscribers must not block.
+    """
+    def __init__(self, bind):
+        self._bind = bind
+        self._clients = {}
+        self._next_id = 1
+        self._lock = threading.RLock()
+        self._subscribers = []
+        self._persisted_subscribers = []
+        self._writes = queue.Queue()
+        self._writer = None
+
+    def load(self):
+        """
+        Replaces the registry contents with all clients stored in the database.
+        :return: number of loaded clients
+        """
+        with ClientApi(bind=self._bind) as c_api:
+            clients = [c.as_dict() for c in c_api.get_clients()]
+        with self._lock:
+            self._clients = {c["uuid"]: c for c in clients}
+            self._next_id = max([c["id"] for c in clients] + [0]) + 1
+        return len(clients)
+
+    def start(self):
+        """ starts the background thread writing changes to the database. """
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def stop(self):
+        """ writes all pending changes and stops the background writer. """
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def flush(self):
+        """ blocks until all pending changes are written to the database. """
+        if self._writer is not None:
+            self._writes.join()
+
+    def subscribe(self, callback, persisted=False):
+        """
+        Registers a change listener.
+        :param callback: called as callback(event, client, previous)
+        :param persisted: call back from the writer thread once the change is in the database,
+        instead of synchronously from the thread applying the change.
+        :return:
+        """
+        if persisted:
+            self._persisted_subscribers.append(callback)
+        else:
+            self._subscribers.append(callback)
+
+    def count(self):
+        return len(self._clients)
+
+    def get(self, uuid):
+        with self._lock:
+            c = self._clients.get(uuid, None)
+            return dict(c) if c is not None else None
+
+    def get_all(self):
+        with self._lock:
+            return [dict(c) for c in self._clients.values()]
+
+    def add(self, **values):
+        """
+        Adds a client. id and created_datetime are assigned by the registry.
+        :param values: client attributes, uuid is required
+        :return: dict of the added client
+        """
+        with self._lock:
+            c = dict(values)
+            c["id"] = self._next_id
+            c["created_datetime"] = datetime.now().isoformat()
+            self._next_id += 1
+            self._clients[c["uuid"]] = c
+            self._changed(CREATED, c, None)
+        return dict(c)
+
+    def update(self, uuid, **values):
+        """
+        Updates attributes of an existing client.
+        :param uuid: uuid of the client
+        :param values: changed client attributes
+        :return: dict of the updated client, None if not found
+        """
+        with self._lock:
+            previous = self._clients.get(uuid, None)
+            if previous is None:
+                return None
+            c = dict(previous)
+            c.update(values)
+            c["uuid"] = uuid
+            self._clients[uuid] = c
+            self._changed(UPDATED, c, previous)
+        return dict(c)
+
+    def remove(self, uuid):
+        """
+        Removes a client.
+        :param uuid: uuid of the client
+        :return: dict of the removed client, None if not found
+        """
+        with self._lock:
+            c = self._clients.pop(uuid, None)
+            if c is None:
+                return None
+            self._changed(DELETED, c, None)
+        return dict(c)
+
+    def touch(self, uuid):
+        """
+        Renews the lease of a client by setting its last_seen time.
+        Heartbeats are frequent and change nothing subscribers care about,
+        so no event is published, last_seen is written with the next change of the client.
+        :param uuid: uuid of the client
+        :return: dict of the client, None if not found
+        """
+        with self._lock:
+            c = self._clients.get(uuid, None)
+            if c is None:
+                return None
+            c["last_seen"] = datetime.now().isoformat()
+            return dict(c)
+
+    def _changed(self, event, client, previous):
+        self._writes.put((event, dict(client), previous))
+        for callback in self._subscribers:
+            callback(event, dict(client), previous)
+
+    def _write_loop(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                self._writes.task_done()
+                break
+            event, client, previous = item
+            try:
+                self._write(event, client)
+            except Exception as e:
+                print("#### could not persist client", client["uuid"], e)
+            self._writes.task_done()
+            for callback in self._persisted_subscribers:
+                callback(event, client, previous)
+
+    def _write(self, event, client):
+        with ClientApi(bind=self._bind) as c_api:
+            if event == DELETED:
+                c_api.remove_client(client["uuid"])
+            else:
+                values = dict(client)
+                values["created_datetime"] = _to_datetime(values["created_datetime"])
+                if values.get("last_seen") is not None:
+                    values["last_seen"] = _to_datetime(values["last_seen"])
+                c = c_api.get_client(client["uuid"])
+                if c is None and event != CREATED:
+                    # never re-insert a client whose removal was already written
+                    return
+                if c is None:
+                    c = c_api.add_client(client["uuid"], client["name"], client["ip"])
+                c.from_dict(values)
+            c_api.commit()
+
+
+# registry used by all handlers and services of this server process
+registry = ClientRegistry(bind=engine)
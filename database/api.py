@@ -1,9 +1,14 @@
 ﻿import database.base
+from sqlalchemy import or_, and_, bindparam
+from sqlalchemy.ext import baked
 from sqlalchemy.orm import sessionmaker
 from database.models import tables
 
 Session = sessionmaker()
 
+# caches the compiled SQL of hot lookups, see ClientApi.get_client and ImageApi.get_image_file
+bakery = baked.bakery()
+
 
 class Api(object):
     def __init__(self, bind):
@@ -20,6 +25,19 @@ class Api(object):
         self._db.close()
         self._db = None
 
+    def __enter__(self):
+        """ opens a session for the scope of a with statement (see open()). """
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ rolls back uncommitted changes if the scope raised and closes the session.
+            Changes have to be committed explicitly (see commit()). """
+        if exc_type is not None:
+            self._db.rollback()
+        self.close()
+        return False
+
     def commit(self):
         return self._db.commit()
 
@@ -69,20 +87,23 @@ class ClientApi(Api):
     def __init__(self, bind):
         super().__init__(bind)
 
-    def add_client(self, uuid, name, ip, video_src_port=-1, video_sink_port=-1, video_protocol="jpeg", tuio_sink_port=-1, mixing_mode="other"):
+    def add_client(self, uuid, name, ip, video_src_port=-1, video_sink_port=-1, video_protocol="jpeg", tuio_sink_port=-1, mixing_mode="other", mixing_group="default"):
         c = tables.Client(
             uuid=uuid, name=name, ip=ip,
             video_src_port=video_src_port,
             video_sink_port=video_sink_port,
             video_protocol=video_protocol,
             tuio_sink_port=tuio_sink_port,
-            mixing_mode=mixing_mode
+            mixing_mode=mixing_mode,
+            mixing_group=mixing_group
         )
         self.insert(c)
         return c
 
     def get_client(self, uuid):
-        return self.select(tables.Client, tables.Client.uuid == uuid).first()
+        q = bakery(lambda session: session.query(tables.Client))
+        q += lambda q: q.filter(tables.Client.uuid == bindparam("uuid"))
+        return q(self._db).params(uuid=uuid).first()
 
     def get_clients(self):
         return self.select_all(tables.Client)
@@ -111,11 +132,33 @@ class ImageApi(Api):
         return i
 
     def get_image_file(self, uuid):
-        return self.select(tables.ImageFile, tables.ImageFile.uuid == uuid).first()
+        q = bakery(lambda session: session.query(tables.ImageFile))
+        q += lambda q: q.filter(tables.ImageFile.uuid == bindparam("uuid"))
+        return q(self._db).params(uuid=uuid).first()
 
     def get_image_files(self):
         return self.select_all(tables.ImageFile)
 
+    def get_image_files_page(self, limit=None, after=None, since=None):
+        """ returns image files ordered by (created_datetime, uuid).
+            after: (created_datetime, uuid) of the last image of the previous page.
+            since: only images created after this datetime. """
+        q = self.query(tables.ImageFile)
+        if since is not None:
+            q = q.filter(tables.ImageFile.created_datetime > since)
+        if after is not None:
+            q = q.filter(or_(
+                tables.ImageFile.created_datetime > after[0],
+                and_(tables.ImageFile.created_datetime == after[0], tables.ImageFile.uuid > after[1])
+            ))
+        q = q.order_by(tables.ImageFile.created_datetime, tables.ImageFile.uuid)
+        if limit is not None:
+            q = q.limit(limit)
+        return q.all()
+
+    def count_image_files_with_hash(self, content_hash):
+        return self.select(tables.ImageFile, tables.ImageFile.content_hash == content_hash).count()
+
     def remove_image_file(self, uuid):
         i = self.get_image_file(uuid)
         if i is None:
@@ -1,4 +1,5 @@
-﻿from sqlalchemy import create_engine
+﻿from sqlalchemy import create_engine, event, inspect, DateTime
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative import declared_attr
 from database.config import dev
@@ -8,7 +9,39 @@ from datetime import datetime
 #  sqlalchemy database instance created based on uri
 ##
 
-engine = create_engine(dev.SQLALCHEMY_DATABASE_DEBUG_URI, echo=dev.SQLALCHEMY_ECHO)
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Applies the sqlite settings of the config to each new pooled connection. """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=%s" % dev.SQLALCHEMY_SQLITE_JOURNAL_MODE)
+    cursor.execute("PRAGMA synchronous=%s" % dev.SQLALCHEMY_SQLITE_SYNCHRONOUS)
+    cursor.execute("PRAGMA busy_timeout=%d" % dev.SQLALCHEMY_SQLITE_BUSY_TIMEOUT)
+    cursor.close()
+
+
+def create_db_engine(uri, echo=False):
+    """ Creates an engine with a connection pool sized for the server threads.
+        sqlite connections are shared across threads and use the journal mode,
+        synchronous level and busy timeout of the config. """
+    if not uri.startswith("sqlite"):
+        return create_engine(
+            uri, echo=echo, pool_size=dev.SQLALCHEMY_POOL_SIZE, max_overflow=dev.SQLALCHEMY_MAX_OVERFLOW,
+            pool_timeout=dev.SQLALCHEMY_POOL_TIMEOUT, pool_pre_ping=True
+        )
+    connect_args = {"check_same_thread": False, "timeout": dev.SQLALCHEMY_SQLITE_BUSY_TIMEOUT / 1000.0}
+    if uri in ("sqlite://", "sqlite:///:memory:"):
+        # every connection would open its own in-memory database
+        e = create_engine(uri, echo=echo, connect_args=connect_args, poolclass=StaticPool)
+    else:
+        e = create_engine(
+            uri, echo=echo, connect_args=connect_args, poolclass=QueuePool,
+            pool_size=dev.SQLALCHEMY_POOL_SIZE, max_overflow=dev.SQLALCHEMY_MAX_OVERFLOW,
+            pool_timeout=dev.SQLALCHEMY_POOL_TIMEOUT
+        )
+    event.listen(e, "connect", _set_sqlite_pragmas)
+    return e
+
+
+engine = create_db_engine(dev.SQLALCHEMY_DATABASE_DEBUG_URI, echo=dev.SQLALCHEMY_ECHO)
 
 
 ##
@@ -16,18 +49,44 @@ engine = create_engine(dev.SQLALCHEMY_DATABASE_DEBUG_URI, echo=dev.SQLALCHEMY_EC
 # to make each derived class dict serializable.
 ##
 
+# compiled serializers per (table class, field selection)
+_SERIALIZERS = {}
+
+
+def _compile_serializer(cls, fields):
+    columns = [c for c in cls.__table__.columns if fields is None or c.name in fields]
+    names = tuple(c.name for c in columns)
+    datetime_names = frozenset(c.name for c in columns if isinstance(c.type, DateTime))
+
+    def serialize(obj):
+        d = {name: getattr(obj, name) for name in names}
+        for name in datetime_names:
+            if isinstance(d[name], datetime):
+                d[name] = d[name].isoformat()
+        return d
+    return serialize
+
+
 class _TableExt(object):
     @declared_attr
     def __tablename__(cls):
         return cls.__name__.lower()
 
+    @classmethod
+    def serializer(cls, fields=None):
+        """ Returns a function converting objects of this table to dicts.
+            Column reflection happens once per field selection, not per row.
+            fields: iterable of column names to include, None for all columns. """
+        key = (cls, frozenset(fields) if fields is not None else None)
+        serialize = _SERIALIZERS.get(key, None)
+        if serialize is None:
+            serialize = _compile_serializer(cls, key[1])
+            _SERIALIZERS[key] = serialize
+        return serialize
+
     def as_dict(self):
         """ Returns all object properties as dictionary. """
-        dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        for key in dict:
-            if isinstance(dict[key], datetime):
-                dict[key] = dict[key].isoformat()
-        return dict
+        return type(self).serializer()(self)
 
     def from_dict(self, d):
         """ Sets the objects attributes from python dict.
@@ -61,6 +120,24 @@ def create_database():
     TableBase.metadata.create_all(engine)
 
 
+def schema_mismatches():
+    """ Compares the existing database with the table classes.
+        create_all only adds missing tables, never missing columns,
+        so a database written by an older build cannot be loaded.
+        Returns list of 'table.column' names missing in the database. """
+    global TableBase
+    global engine
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    missing = []
+    for name, table in TableBase.metadata.tables.items():
+        if name not in existing:
+            continue
+        columns = set(c["name"] for c in inspector.get_columns(name))
+        missing += [name + "." + c.name for c in table.columns if c.name not in columns]
+    return missing
+
+
 def drop_database():
     """ Drops all database contents.
         ALL DATABASE TABLES/INDEXES AND DATA WILL BE LOST!"""
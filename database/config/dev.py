@@ -3,3 +3,21 @@
 SQLALCHEMY_DATABASE_DEBUG_URI = 'sqlite:///surface_streams.db'
 
 SQLALCHEMY_DATABASE_DEBUG_DIR = '/SERVER_DATA'
+
+# connections kept open per engine, sized for the request threads, the registry writer,
+# the TUIO forwarder and the image variant workers
+SQLALCHEMY_POOL_SIZE = 8
+
+SQLALCHEMY_MAX_OVERFLOW = 16
+
+# seconds to wait for a free pooled connection
+SQLALCHEMY_POOL_TIMEOUT = 30
+
+# sqlite only: readers do not block the writer in WAL mode
+SQLALCHEMY_SQLITE_JOURNAL_MODE = 'WAL'
+
+# sqlite only: NORMAL is durable across crashes of the server process in WAL mode
+SQLALCHEMY_SQLITE_SYNCHRONOUS = 'NORMAL'
+
+# sqlite only: milliseconds a connection waits for a lock before 'database is locked'
+SQLALCHEMY_SQLITE_BUSY_TIMEOUT = 5000
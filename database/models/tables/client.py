@@ -15,7 +15,7 @@ class Client(TableBase):
 
     name = Column(String(256), nullable=False)
 
-    created_datetime = Column(DateTime, nullable=False, default=datetime.datetime.now())
+    created_datetime = Column(DateTime, nullable=False, default=datetime.datetime.now)
 
     ip = Column(String(64), nullable=False)
 
@@ -28,7 +28,22 @@ class Client(TableBase):
     tuio_sink_port = Column(Integer, default=-1)
 
     mixing_mode = Column(String(32), default="other", nullable=False)
+
+    mixing_group = Column(String(64), default="default", nullable=False)
+
+    output_width = Column(Integer, default=-1)
+
+    output_height = Column(Integer, default=-1)
+
+    output_fps = Column(Integer, default=-1)
+
+    output_bitrate = Column(Integer, default=-1)
+
+    encoding_profile = Column(String(64), default="")
+
+    last_seen = Column(DateTime, nullable=True)
   
     def __repr__(self):
-        return "<Client id=%s uuid=%s name=%s created_datetime=%s ip=%s video_src_port=%s video_sink_port=%s video_protocol=%s tuio_sink_port=%s mixing_mode=%s>" % (
-            self.id, self.uuid, self.name, str(self.created_datetime), self.ip, str(self.video_src_port), str(self.video_sink_port), self.video_protocol, str(self.tuio_sink_port), self.mixing_mode)
+        return "<Client id=%s uuid=%s name=%s created_datetime=%s ip=%s video_src_port=%s video_sink_port=%s video_protocol=%s tuio_sink_port=%s mixing_mode=%s mixing_group=%s output_width=%s output_height=%s output_fps=%s output_bitrate=%s encoding_profile=%s last_seen=%s>" % (
+            self.id, self.uuid, self.name, str(self.created_datetime), self.ip, str(self.video_src_port), str(self.video_sink_port), self.video_protocol, str(self.tuio_sink_port), self.mixing_mode, self.mixing_group,
+            str(self.output_width), str(self.output_height), str(self.output_fps), str(self.output_bitrate), self.encoding_profile, str(self.last_seen))
@@ -1,6 +1,6 @@
 ﻿"""ImageFile model"""
 from database.base import TableBase
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, String, DateTime, Integer
 import datetime
 
 
@@ -13,12 +13,17 @@ class ImageFile(TableBase):
 
     name = Column(String(256), nullable=False)
 
-    created_datetime = Column(DateTime, nullable=False, default=datetime.datetime.now())
+    created_datetime = Column(DateTime, nullable=False, default=datetime.datetime.now)
 
     mimetype = Column(String(64))
 
     filename = Column(String(512))
+
+    content_hash = Column(String(64), index=True)
+
+    size = Column(Integer)
   
     def __repr__(self):
-        return "<ImageFile uuid=%s name=%s created_datetime=%s mimetype=%s filename=%s>" % (
-            self.uuid, self.name, str(self.created_datetime), self.mimetype, self.filename)
+        return "<ImageFile uuid=%s name=%s created_datetime=%s mimetype=%s filename=%s content_hash=%s size=%s>" % (
+            self.uuid, self.name, str(self.created_datetime), self.mimetype, self.filename,
+            self.content_hash, str(self.size))
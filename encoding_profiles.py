@@ -0,0 +1,257 @@
+"""
+Named latency/bandwidth profiles for the merged streams sent to clients.
+A profile fixes the video_protocol (rtp caps the client decodes) and lists
+interchangeable software encoders with their keyframe interval, rate control
+and rtp packetization. Available encoders are benchmarked in the background at
+startup and whenever the merged stream size or frame rate changes, each profile
+then uses the cheapest encoder sustaining the merged stream.
+"""
+
+import multiprocessing
+import threading
+import time
+
+
+# candidates per profile in order of preference, "bitrate" holds the encoder
+# property and its factor for a bitrate in kbit/s (None if not supported)
+ENCODING_PROFILES = {
+    "lan-mjpeg": {
+        "video_protocol": "jpeg",
+        "bitrate": -1,
+        "candidates": [
+            {"encode": ("jpegenc", {"quality": 75}), "bitrate": None},
+            {"encode": ("avenc_mjpeg", {}), "bitrate": ("bitrate", 1000)}
+        ],
+        "pay": ("rtpjpegpay", {"mtu": 1400})
+    },
+    "wan-h264-zerolatency": {
+        "video_protocol": "mp4",
+        "bitrate": 1500,
+        "candidates": [
+            {"encode": ("x264enc", {
+                "tune": "zerolatency", "speed-preset": "ultrafast", "key-int-max": 30,
+                "pass": "cbr", "vbv-buf-capacity": 200, "sliced-threads": True
+            }), "bitrate": ("bitrate", 1)},
+            {"encode": ("openh264enc", {
+                "complexity": "low", "gop-size": 30, "rate-control": "bitrate", "usage-type": "screen"
+            }), "bitrate": ("bitrate", 1000)}
+        ],
+        "pay": ("rtph264pay", {"config-interval": -1, "mtu": 1200})
+    },
+    "vp8-realtime": {
+        "video_protocol": "vp8",
+        "bitrate": 1000,
+        "candidates": [
+            {"encode": ("vp8enc", {
+                "deadline": 1, "cpu-used": 8, "keyframe-max-dist": 30, "end-usage": "cbr",
+                "lag-in-frames": 0, "error-resilient": "default"
+            }), "bitrate": ("target-bitrate", 1000)}
+        ],
+        "pay": ("rtpvp8pay", {"mtu": 1200, "picture-id-mode": "15-bit"})
+    }
+}
+
+# encoders have to reach this multiple of the merged stream frame rate to be selected
+BENCHMARK_HEADROOM = 1.5
+
+BENCHMARK_FRAMES = 60
+
+BENCHMARK_TIMEOUT = 30.0
+
+# benchmark results of the last select_encoders call, see get_selection
+_SELECTION = {}
+
+# (width, height, fps) to benchmark results, a size seen before is not benchmarked again
+_BENCHMARKS = {}
+
+# latest pending (width, height, fps) and the callbacks waiting for a selection, see schedule_selection
+_pending = None
+_callbacks = []
+_selector = None
+_selector_lock = threading.Lock()
+
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _benchmark_main(conn, factories, width, height, fps, frames):
+    """
+    Entry point of the benchmark process.
+    Encodes the same test frames with every encoder and measures wall and cpu time.
+    Sends {factory: {"fps": encoded frames per second, "cpu_ms_per_frame": ...}},
+    unavailable or failing encoders are left out.
+    """
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+    from incremental_mixer import _make, _raw_caps
+
+    Gst.init(None)
+
+    def _run(encoder):
+        pipeline = Gst.Pipeline.new("encoder-benchmark")
+        elements = [
+            _make("videotestsrc", {"num-buffers": frames, "pattern": "ball"}),
+            _make("capsfilter", {"caps": _raw_caps(width, height, fps)}),
+            _make("videoconvert"),
+            encoder,
+            _make("fakesink", {"sync": False})
+        ]
+        for e in elements:
+            pipeline.add(e)
+        for a, b in zip(elements, elements[1:]):
+            a.link(b)
+        wall, cpu = time.perf_counter(), time.process_time()
+        pipeline.set_state(Gst.State.PLAYING)
+        msg = pipeline.get_bus().timed_pop_filtered(
+            int(BENCHMARK_TIMEOUT * Gst.SECOND), Gst.MessageType.EOS | Gst.MessageType.ERROR
+        )
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        pipeline.set_state(Gst.State.NULL)
+        if msg is None or msg.type != Gst.MessageType.EOS:
+            return None
+        return wall, cpu
+
+    results = {}
+    # source and conversion costs are measured once and subtracted
+    baseline = _run(_make("identity"))
+    for factory, props in factories:
+        try:
+            measured = _run(_make(factory, props))
+        except (RuntimeError, TypeError, ValueError):
+            continue
+        if measured is None or baseline is None:
+            continue
+        wall = max(measured[0] - baseline[0], 1e-6)
+        cpu = max(measured[1] - baseline[1], 0.0)
+        results[factory] = {"fps": frames / wall, "cpu_ms_per_frame": cpu * 1000.0 / frames}
+    conn.send(results)
+    conn.close()
+
+
+def benchmark_encoders(width, height, fps, frames=BENCHMARK_FRAMES):
+    """
+    Benchmarks the encoders of all profiles in a separate process,
+    so GStreamer is never initialized in the server process.
+    :return: dict of encoder factory to {"fps", "cpu_ms_per_frame"}, empty if the benchmark failed
+    """
+    factories = []
+    for profile in ENCODING_PROFILES.values():
+        for candidate in profile["candidates"]:
+            if candidate["encode"][0] not in [f for f, _ in factories]:
+                factories.append(candidate["encode"])
+    parent_conn, child_conn = _MP_CONTEXT.Pipe()
+    process = _MP_CONTEXT.Process(
+        target=_benchmark_main, args=(child_conn, factories, width, height, fps, frames),
+        name="encoder-benchmark", daemon=True
+    )
+    process.start()
+    child_conn.close()
+    results = {}
+    if parent_conn.poll(BENCHMARK_TIMEOUT * len(factories)):
+        try:
+            results = parent_conn.recv()
+        except EOFError:
+            pass
+    process.join(1.0)
+    if process.is_alive():
+        process.terminate()
+    return results
+
+
+def select_encoders(width, height, fps):
+    """
+    Picks the encoder of every profile: the one with the least cpu time per frame
+    among those sustaining fps * BENCHMARK_HEADROOM, else the fastest one.
+    Profiles without benchmarked encoder keep their first candidate.
+    Blocks for the benchmark unless the size was benchmarked before, see schedule_selection.
+    :return: dict of profile name to selected encoder factory
+    """
+    global _SELECTION
+    results = _BENCHMARKS.get((width, height, fps), None)
+    if results is None:
+        results = benchmark_encoders(width, height, fps)
+        if len(results) > 0:
+            _BENCHMARKS[(width, height, fps)] = results
+    selection = {}
+    for name, profile in ENCODING_PROFILES.items():
+        measured = [(i, results[c["encode"][0]]) for i, c in enumerate(profile["candidates"])
+                    if c["encode"][0] in results]
+        if len(measured) == 0:
+            selection[name] = {"candidate": 0, "benchmark": None}
+            continue
+        sustaining = [m for m in measured if m[1]["fps"] >= fps * BENCHMARK_HEADROOM]
+        if len(sustaining) > 0:
+            best = min(sustaining, key=lambda m: m[1]["cpu_ms_per_frame"])
+        else:
+            best = max(measured, key=lambda m: m[1]["fps"])
+        selection[name] = {"candidate": best[0], "benchmark": best[1]}
+    _SELECTION = selection
+    return get_selection()
+
+
+def schedule_selection(width, height, fps, on_done=None):
+    """
+    Runs select_encoders in a background thread.
+    Requests arriving while a benchmark runs are merged, only the latest size is benchmarked next.
+    :param on_done: called with the selection once the encoders for the latest requested size are picked
+    :return:
+    """
+    global _pending, _selector
+    with _selector_lock:
+        _pending = (width, height, fps)
+        if on_done is not None:
+            _callbacks.append(on_done)
+        if _selector is None:
+            _selector = threading.Thread(target=_run_selection, name="encoder-selection", daemon=True)
+            _selector.start()
+
+
+def _run_selection():
+    global _pending, _callbacks, _selector
+    while True:
+        with _selector_lock:
+            if _pending is None:
+                callbacks, _callbacks = _callbacks, []
+                _selector = None
+                break
+            width, height, fps = _pending
+            _pending = None
+        try:
+            selection = select_encoders(width, height, fps)
+            print("###### encoding profiles", width, height, fps, "\n  >", selection)
+        except Exception as e:
+            selection = get_selection()
+            print("###### encoder selection failed\n  >", e)
+    for on_done in callbacks:
+        on_done(selection)
+
+
+def get_selection():
+    """ Returns the selected encoder and its benchmark per profile. """
+    res = {}
+    for name, profile in ENCODING_PROFILES.items():
+        selected = _SELECTION.get(name, {"candidate": 0, "benchmark": None})
+        res[name] = {
+            "video_protocol": profile["video_protocol"],
+            "encoder": profile["candidates"][selected["candidate"]]["encode"][0],
+            "benchmark": selected["benchmark"]
+        }
+    return res
+
+
+def resolve(name):
+    """
+    Returns the encoding settings of a profile as used by the mixer (see IncrementalVideoMixer),
+    None for unknown profiles.
+    """
+    profile = ENCODING_PROFILES.get(name, None)
+    if profile is None:
+        return None
+    candidate = profile["candidates"][_SELECTION.get(name, {"candidate": 0})["candidate"]]
+    return {
+        "profile": name,
+        "encode": candidate["encode"],
+        "bitrate": candidate["bitrate"],
+        "default_bitrate": profile["bitrate"],
+        "pay": profile["pay"]
+    }
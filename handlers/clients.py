@@ -7,11 +7,16 @@ CLIENTS collection
 from datetime import datetime
 import uuid
 import video_mixing
+import client_reaper
+import encoding_profiles
 
 # 3rd party modules
 from flask import make_response, abort
-from database.api import ClientApi
-from database.base import engine
+from client_registry import registry
+from handlers import pagination
+from handlers.pipeline import job_location
+from notifications import hub
+from port_pool import pool, PortAllocationError
 
 
 def create_timestamp():
@@ -22,51 +27,152 @@ def create_uuid():
     return str(uuid.uuid4())
 
 
-CLIENT_LIMIT = 3
+CLIENT_FIELDS = [
+    "id", "uuid", "name", "created_datetime", "ip", "video_src_port", "video_sink_port",
+    "video_protocol", "tuio_sink_port", "mixing_mode", "mixing_group",
+    "output_width", "output_height", "output_fps", "output_bitrate", "encoding_profile", "last_seen"
+]
 
+# maximum number of clients, configurable through the server-config.
+# -1 follows video_mixing.estimate_client_capacity() for the current merged stream size.
+CLIENT_LIMIT = -1
 
-def create_client(name, video_src_port, ip, video_sink_port, streaming_protocol, tuio_port, mixing_mode):
+
+def client_limit():
+    return CLIENT_LIMIT if CLIENT_LIMIT > 0 else video_mixing.estimate_client_capacity()
+
+
+def output_setting(client, key, current):
+    """
+    Resolves an output setting of an update request
+    :param client:  update request body
+    :param key:     output_width, output_height, output_fps or output_bitrate
+    :param current: client as stored in the registry
+    :return:        the current value if the key is absent, -1 (server default) for -1 or null,
+                    the requested value otherwise
+    """
+    if key not in client:
+        return current[key]
+    value = client[key]
+    if value is None or value == -1:
+        return -1
+    if value <= 0:
+        abort(400, "{key} must be positive, or -1/null to follow the merged stream".format(key=key))
+    return value
+
+
+def create_client(name, video_src_port, ip, video_sink_port, streaming_protocol, tuio_port, mixing_mode,
+                  mixing_group="default", output_width=-1, output_height=-1, output_fps=-1, output_bitrate=-1,
+                  encoding_profile=""):
     """
     Helper function to create a client.
     :param name: name of the client
     :param ip: incoming stream ip
     :param video_src_port: incoming stream port
+    :param mixing_group: clients of the same mixing group see each other
+    :param output_width: width of the merged stream sent to the client (-1 for server default)
+    :param output_height: height of the merged stream sent to the client (-1 for server default)
+    :param output_fps: frame rate of the merged stream sent to the client (-1 for unlimited)
+    :param output_bitrate: encoder bitrate in kbit/s of the merged stream sent to the client (-1 for default)
+    :param encoding_profile: name of the encoding profile, replaces streaming_protocol ("" for none)
     :return: Returns the uuid and dict values of the created client.
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    num_clients = len(c_api.get_clients())
-
+    if len(encoding_profile) > 0:
+        streaming_protocol = profile_protocol(encoding_profile)
     new_uuid = create_uuid()
     ip = ip if len(ip) > 0 else "0.0.0.0"
-    video_src_port = video_src_port if video_src_port > 0 else 5001 + 3 * num_clients + 1
-    video_sink_port = video_sink_port if video_sink_port > 0 else video_src_port + 1
-    tuio_port = tuio_port if tuio_port > 0 else video_sink_port + 1
-
-    c = c_api.add_client(
-        new_uuid, name, ip if len(ip) > 0 else "0.0.0.0",
-        video_src_port, video_sink_port, streaming_protocol, tuio_port,
-        mixing_mode
+    mixing_group = mixing_group if len(mixing_group) > 0 else "default"
+
+    # explicitly requested ports are reserved, unset ports taken from the group range
+    try:
+        video_src_port, video_sink_port, tuio_port = pool.assign(
+            new_uuid, mixing_group, [video_src_port, video_sink_port, tuio_port]
+        )
+    except PortAllocationError as e:
+        pool.release(new_uuid)
+        abort(409, str(e))
+
+    # mixer and TUIO forwarder are updated through registry subscriptions
+    client = registry.add(
+        uuid=new_uuid, name=name, ip=ip,
+        video_src_port=video_src_port, video_sink_port=video_sink_port,
+        video_protocol=streaming_protocol, tuio_sink_port=tuio_port,
+        mixing_mode=mixing_mode, mixing_group=mixing_group,
+        output_width=output_width, output_height=output_height,
+        output_fps=output_fps, output_bitrate=output_bitrate,
+        encoding_profile=encoding_profile
     )
-    c_api.commit()
-    res = c.as_dict()
-    c_api.close()
+    hub.publish("ports-assigned", {
+        "uuid": new_uuid, "mixing_group": mixing_group, "video_src_port": video_src_port,
+        "video_sink_port": video_sink_port, "tuio_sink_port": tuio_port
+    })
+    return client
+
 
-    video_mixing.update_pipelines()
-    return res
+def profile_protocol(encoding_profile):
+    """
+    Helper function returning the video_protocol of an encoding profile, aborts with 400 if unknown.
+    """
+    profile = encoding_profiles.ENCODING_PROFILES.get(encoding_profile, None)
+    if profile is None:
+        abort(
+            400,
+            "Unknown encoding profile {name}, available profiles are {names}".format(
+                name=encoding_profile, names=", ".join(sorted(encoding_profiles.ENCODING_PROFILES.keys()))
+            )
+        )
+    return profile["video_protocol"]
 
 
-def read_all():
+def accepted(client):
+    """
+    Helper function to answer a client change with 202 and the pipeline job applying it.
+    :param client: dict values of the created or updated client
+    :return: response tuple
+    """
+    job = video_mixing.reconfiguration.current_job()
+    if job is None:
+        return client, 200
+    client = dict(client)
+    client["pipeline_job"] = job.as_dict()
+    return client, 202, {"Location": job_location(job)}
+
+
+def read_all(limit=None, cursor=None, fields=None, since=None, length=None, offset=None):
     """
     This function responds to a request for /api/clients
-    with the complete lists of clients
+    with the list of clients ordered by id
+    :param limit:   maximum number of clients to return
+    :param cursor:  X-Next-Cursor of the previous page
+    :param fields:  comma separated client fields to return
+    :param since:   only return clients created or updated after this ISO 8601 datetime
+    :param length:  alias for limit
+    :param offset:  number of clients to skip
     :return:        json string of list of clients
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    res = [c.as_dict() for c in c_api.get_clients()]
-    c_api.close()
-    return res
+    limit = limit if limit is not None else length
+    selected = pagination.parse_fields(fields, CLIENT_FIELDS)
+    since = pagination.parse_since(since)
+    after = pagination.decode_cursor(cursor, 1)
+    after_id = int(after[0]) if after is not None and after[0].isdigit() else None
+
+    clients = sorted(registry.get_all(), key=lambda c: c["id"])
+    if after_id is not None:
+        clients = [c for c in clients if c["id"] > after_id]
+    if since is not None:
+        since = since.isoformat()
+        clients = [c for c in clients if c["created_datetime"] > since]
+    if offset is not None and offset > 0:
+        clients = clients[offset:]
+
+    next_cursor = None
+    if limit is not None and 0 <= limit < len(clients):
+        clients = clients[:limit]
+        if limit > 0:
+            next_cursor = pagination.encode_cursor(clients[-1]["id"])
+    return pagination.page_response(
+        [{f: c.get(f) for f in selected} for c in clients], next_cursor
+    )
 
 
 def read_one(uuid):
@@ -76,18 +182,13 @@ def read_one(uuid):
     :param uuid:   uuid of client to find
     :return:        client matching uuid
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    c = c_api.get_client(uuid)
+    c = registry.get(uuid)
     if c is None:
-        c_api.close()
         abort(
             404,
             "Client with uuid {uuid} not found".format(uuid=uuid)
         )
-    res = c.as_dict()
-    c_api.close()
-    return res
+    return c
 
 
 def create(client):
@@ -95,14 +196,10 @@ def create(client):
     This function creates a new client in the clients structure
     based on the passed in client data
     :param client:  client to create in clients structure
-    :return:        201 on success, 406 on client exists
+    :return:        202 with the pipeline job on success, 400 on unknown encoding profile,
+                    406 on client limit reached, 409 on port conflict
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    len_clients = len(c_api.get_clients())
-    c_api.close()
-
-    if len_clients > CLIENT_LIMIT:
+    if registry.count() >= client_limit():
         abort(
             406,
             "Client list already at maximum capacity"
@@ -115,9 +212,17 @@ def create(client):
     video_protocol = client.get("video_protocol", "jpeg")
     tuio_sink_port = client.get("tuio_sink_port", -1)
     mixing_mode = client.get("mixing_mode", "other")
+    mixing_group = client.get("mixing_group", "default")
+    output_width = client.get("output_width", -1)
+    output_height = client.get("output_height", -1)
+    output_fps = client.get("output_fps", -1)
+    output_bitrate = client.get("output_bitrate", -1)
+    encoding_profile = client.get("encoding_profile", "")
 
-    return create_client(name, video_src_port, ip, video_sink_port,
-                         video_protocol, tuio_sink_port, mixing_mode)
+    return accepted(create_client(name, video_src_port, ip, video_sink_port,
+                                  video_protocol, tuio_sink_port, mixing_mode, mixing_group,
+                                  output_width, output_height, output_fps, output_bitrate,
+                                  encoding_profile))
 
 
 def update(uuid, client):
@@ -125,13 +230,11 @@ def update(uuid, client):
     This function updates an existing client in the clients structure
     :param uuid:   last name of client to update in the clients structure
     :param client:  client to update
-    :return:        updated client structure
+    :return:        202 with the updated client and its pipeline job, 400 on unknown or
+                    incompatible encoding profile or invalid output setting, 404 if not found, 409 on port conflict
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    c = c_api.get_client(uuid)
+    c = registry.get(uuid)
     if c is None:
-        c_api.close()
         abort(
             404,
             "Client with uuid {uuid} not found".format(uuid=uuid)
@@ -143,50 +246,91 @@ def update(uuid, client):
     video_sink_port = client.get("video_sink_port", -1)
     tuio_sink_port = client.get("tuio_sink_port", -1)
     mixing_mode = client.get("mixing_mode", "other")
+    mixing_group = client.get("mixing_group", "")
+    encoding_profile = client.get("encoding_profile", "")
+    output_width = output_setting(client, "output_width", c)
+    output_height = output_setting(client, "output_height", c)
+    output_fps = output_setting(client, "output_fps", c)
+    output_bitrate = output_setting(client, "output_bitrate", c)
+
+    # the profile can only switch encoder settings, not the protocol the client decodes
+    if len(encoding_profile) > 0 and profile_protocol(encoding_profile) != c["video_protocol"]:
+        abort(
+            400,
+            "Encoding profile {name} does not use video_protocol {protocol}".format(
+                name=encoding_profile, protocol=c["video_protocol"]
+            )
+        )
 
-    c.name = n if len(n) > 0 else c.name
-    c.ip = ip if len(ip) > 0 else c.ip
-    c.video_src_port = video_src_port if video_src_port > 0 else c.video_src_port
-    c.video_sink_port = video_sink_port if video_sink_port > 0 else c.video_sink_port
-    c.tuio_sink_port = tuio_sink_port if tuio_sink_port > 0 else c.tuio_sink_port
-    c.mixing_mode = mixing_mode
-    c.created_datetime = datetime.now()
-
-    c_api.commit()
-    res = c.as_dict()
-    c_api.close()
-
-    video_mixing.update_pipelines()
-
-    return res
+    mixing_group = mixing_group if len(mixing_group) > 0 else c["mixing_group"]
+    ports = [video_src_port, video_sink_port, tuio_sink_port]
+    try:
+        if mixing_group != c["mixing_group"]:
+            # ports not requested explicitly move into the port range of the new group
+            pool.release(uuid)
+            ports = pool.assign(uuid, mixing_group, ports)
+        else:
+            pool.reserve(uuid, [p for p in ports if p > 0])
+    except PortAllocationError as e:
+        pool.sync_client(c)
+        abort(409, str(e))
+    video_src_port, video_sink_port, tuio_sink_port = ports
+
+    return accepted(registry.update(
+        uuid,
+        name=n if len(n) > 0 else c["name"],
+        ip=ip if len(ip) > 0 else c["ip"],
+        video_src_port=video_src_port if video_src_port > 0 else c["video_src_port"],
+        video_sink_port=video_sink_port if video_sink_port > 0 else c["video_sink_port"],
+        tuio_sink_port=tuio_sink_port if tuio_sink_port > 0 else c["tuio_sink_port"],
+        mixing_mode=mixing_mode,
+        mixing_group=mixing_group,
+        output_width=output_width,
+        output_height=output_height,
+        output_fps=output_fps,
+        output_bitrate=output_bitrate,
+        encoding_profile=encoding_profile if len(encoding_profile) > 0 else c.get("encoding_profile", ""),
+        created_datetime=datetime.now().isoformat()
+    ))
 
 
 def delete(uuid):
     """
     This function deletes a client from the clients structure
     :param uuid:   uuid of client to delete
-    :return:        200 on successful delete, 404 if not found
+    :return:        202 with the pipeline job on successful delete, 404 if not found
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    c = c_api.get_client(uuid)
+    c = registry.remove(uuid)
     if c is None:
         abort(
             404,
             "Client with uuid {uuid} not found".format(uuid=uuid)
         )
-        c_api.close()
-    name = c.name
-    c_api.delete(c)
-    c_api.commit()
-    c_api.close()
-
-    if video_mixing.update_pipelines():
-        return make_response(
-            "{name} successfully deleted at uuid={uuid}".format(name=name, uuid=uuid), 200
-        )
-    else:
+    response = make_response(
+        "{name} successfully deleted at uuid={uuid}".format(name=c["name"], uuid=uuid), 202
+    )
+    job = video_mixing.reconfiguration.current_job()
+    if job is not None:
+        response.headers["Location"] = job_location(job)
+    return response
+
+
+def heartbeat(uuid):
+    """
+    This function renews the lease of a client.
+    Clients sending heartbeats are expired once they miss the lease,
+    other clients once their streams are inactive (see client_reaper).
+    :param uuid:   uuid of the client
+    :return:        lease of the client, 404 if not found
+    """
+    c = registry.touch(uuid)
+    if c is None:
         abort(
-            406,
-            "could not delete {name} at uuid={uuid}".format(name=name, uuid=uuid)
-        )
\ No newline at end of file
+            404,
+            "Client with uuid {uuid} not found".format(uuid=uuid)
+        )
+    return {
+        "uuid": uuid,
+        "last_seen": c["last_seen"],
+        "lease_seconds": client_reaper.LEASE_SECONDS
+    }
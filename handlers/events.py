@@ -0,0 +1,49 @@
+"""
+This is the events module and supports all the ReST actions for the
+EVENTS stream, pushing client and pipeline changes as server-sent events.
+"""
+
+# System modules
+import queue
+import notifications
+
+# 3rd party modules
+from flask import Response, request, stream_with_context
+
+
+# seconds between keep-alive comments on idle streams
+KEEPALIVE_INTERVAL = 15
+
+
+def stream(types=None):
+    """
+    This function responds to a request for /api/events
+    with a text/event-stream of client and pipeline events
+    :param types:   comma separated event names to receive, None for all events
+    :return:        streaming response
+    """
+    wanted = None
+    if types is not None and len(types.strip()) > 0:
+        wanted = set(t.strip() for t in types.split(","))
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+    q = notifications.hub.subscribe(last_event_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    n = q.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if wanted is None or n.event in wanted:
+                    yield n.to_sse()
+        finally:
+            notifications.hub.unsubscribe(q)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
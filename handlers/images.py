@@ -5,13 +5,31 @@ CLIENTS collection
 
 # System modules
 from datetime import datetime
+import hashlib
+import re
+import tempfile
 import uuid
 import os
+import image_variants
 
 # 3rd party modules
-from flask import make_response, abort, send_file
+from flask import make_response, abort, send_file, request
 from database.api import ImageApi
+from database.models.tables import ImageFile
 from database.base import engine
+from handlers import pagination
+
+
+# directory holding uploaded images, named by the sha256 of their content
+SERVER_DATA_DIR = "SERVER_DATA"
+
+# maximum accepted image size in bytes
+MAX_IMAGE_SIZE = 32 * 1024 * 1024
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# fields exposed by the images collection
+IMAGE_FIELDS = ["created_datetime", "name", "uuid"]
 
 
 def create_timestamp():
@@ -38,73 +56,175 @@ def create_image(name):
     """
     new_uuid = create_uuid()
 
-    i_api = ImageApi(bind=engine)
-    i_api.open()
-    img = i_api.add_image_file(uuid=new_uuid, name=name)
-    i_api.commit()
-    img_dict = img.as_dict()
-    i_api.close()
+    with ImageApi(bind=engine) as i_api:
+        img = i_api.add_image_file(uuid=new_uuid, name=name)
+        i_api.commit()
+        img_dict = img.as_dict()
 
     return img_dict
 
 
+def content_path(content_hash):
+    return os.path.join(SERVER_DATA_DIR, content_hash)
+
+
+def store_content(stream):
+    """
+    Streams uploaded data into content-addressed storage.
+    Data is hashed while it is written in chunks, identical content is stored once.
+    :param stream: readable file object
+    :return: (sha256 hex digest, size in bytes), None if MAX_IMAGE_SIZE is exceeded
+    """
+    os.makedirs(SERVER_DATA_DIR, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    fd, tmp_name = tempfile.mkstemp(dir=SERVER_DATA_DIR, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_IMAGE_SIZE:
+                    os.remove(tmp_name)
+                    return None
+                sha.update(chunk)
+                tmp.write(chunk)
+        content_hash = sha.hexdigest()
+        if os.path.exists(content_path(content_hash)):
+            os.remove(tmp_name)
+        else:
+            os.replace(tmp_name, content_path(content_hash))
+        return content_hash, size
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def release_content(i_api, content_hash):
+    """
+    Deletes stored content if no image references it anymore.
+    Has to be called after the referencing image was deleted or changed (not committed).
+    :param i_api: open ImageApi
+    :param content_hash: hash of the content
+    :return:
+    """
+    if content_hash is None:
+        return
+    if i_api.count_image_files_with_hash(content_hash) == 0:
+        if os.path.exists(content_path(content_hash)):
+            os.remove(content_path(content_hash))
+        image_variants.remove_variants(content_hash)
+
+
 def remove_image(uuid):
     """
     Helper function for delete
     :param uuid: identifier for the image to be removed
     :return: success of removal
     """
-    i_api = ImageApi(bind=engine)
-    i_api.open()
-    img = i_api.get_image_file(uuid)
-    if img is not None:
-        if img.filename is not None:
-            if os.path.exists(img.filename):
-                os.remove(img.filename)
+    with ImageApi(bind=engine) as i_api:
+        img = i_api.get_image_file(uuid)
+        if img is None:
+            return False
+        content_hash = img.content_hash
         i_api.delete(img)
         i_api.commit()
+        release_content(i_api, content_hash)
         return True
-    i_api.close()
-    return False
 
 
 def remove_all():
     """
     helper function to delete all images of current session
     """
-    i_api = ImageApi(bind=engine)
-    i_api.open()
+    with ImageApi(bind=engine) as i_api:
+        images = i_api.get_image_files()
+        if len(images) == 0:
+            return
 
-    images = i_api.get_image_files()
-    if len(images) == 0:
-        i_api.close()
-        return
+        for img in images:
+            if img.filename is not None:
+                if os.path.exists(img.filename):
+                    os.remove(img.filename)
+            if img.content_hash is not None:
+                image_variants.remove_variants(img.content_hash)
+            i_api.delete(img)
+        i_api.commit()
 
-    for img in images:
-        if img.filename is not None:
-            if os.path.exists(img.filename):
-                os.remove(img.filename)
-        i_api.delete(img)
-    i_api.commit()
-    i_api.close()
 
+# stored content (sha256), its variants (see image_variants.variant_path) and unfinished temp files
+STORED_DATA_PATTERN = re.compile(r"^([0-9a-f]{64}(\..+)?|\.(upload|variant)-.+)$")
 
-def read_all():
+
+def remove_stored_data():
+    """
+    helper function to delete all stored image data without reading the database,
+    e.g. on a cold start after a schema change, when the image table may not be readable
+    :return: number of removed files
+    """
+    if not os.path.isdir(SERVER_DATA_DIR):
+        return 0
+    removed = 0
+    for name in os.listdir(SERVER_DATA_DIR):
+        if STORED_DATA_PATTERN.match(name) is not None:
+            os.remove(os.path.join(SERVER_DATA_DIR, name))
+            removed += 1
+    image_variants.cache.discard_prefix("")
+    return removed
+
+
+def remove_missing():
+    """
+    helper function to delete images whose stored data is gone (e.g. after a warm restart)
+    :return: number of removed images
+    """
+    with ImageApi(bind=engine) as i_api:
+        missing = [
+            img for img in i_api.get_image_files()
+            if img.filename is not None and not os.path.exists(img.filename)
+        ]
+        for img in missing:
+            i_api.delete(img)
+        i_api.commit()
+    return len(missing)
+
+
+def read_all(limit=None, cursor=None, fields=None, since=None, length=None, offset=None):
     """
     This function responds to a request for /api/images
-    with the complete lists of images
+    with the list of images ordered by creation time
+    :param limit:   maximum number of images to return
+    :param cursor:  X-Next-Cursor of the previous page
+    :param fields:  comma separated image fields to return
+    :param since:   only return images created after this ISO 8601 datetime
+    :param length:  alias for limit
+    :param offset:  number of images to skip
     :return:        json string of list of images
     """
-    i_api = ImageApi(bind=engine)
-    i_api.open()
-    res = [
-        response_image_dict(img.as_dict())
-        for img in i_api.get_image_files()
-    ]
-    i_api.close()
+    limit = limit if limit is not None else length
+    serialize = ImageFile.serializer(pagination.parse_fields(fields, IMAGE_FIELDS))
+    since = pagination.parse_since(since)
+    after = pagination.decode_cursor(cursor, 2)
+    if after is not None:
+        after = (pagination.parse_since(after[0]), after[1])
+    skip = offset if offset is not None and offset > 0 else 0
 
-    # Create the list of images from our data
-    return res
+    with ImageApi(bind=engine) as i_api:
+        # one extra row tells whether there is a next page
+        images = i_api.get_image_files_page(
+            limit=skip + limit + 1 if limit is not None else None, after=after, since=since
+        )[skip:]
+        next_cursor = None
+        if limit is not None and len(images) > limit:
+            images = images[:limit]
+            if limit > 0:
+                next_cursor = pagination.encode_cursor(images[-1].created_datetime.isoformat(), images[-1].uuid)
+        res = [serialize(img) for img in images]
+
+    return pagination.page_response(res, next_cursor)
 
 
 def create(image):
@@ -123,43 +243,90 @@ def fill(uuid, data):
     This function stores the uploaded data to an image reserved by create(...)
     :param data: uploaded image data
     :param uuid: identifier for the image
-    :return: 201 on success, 404 on image not found
+    :return: 201 on success, 404 on image not found, 413 on image too large
     """
-    i_api = ImageApi(bind=engine)
-    i_api.open()
-    img = i_api.get_image_file(uuid)
-    name = ""
-    if img is not None:
+    with ImageApi(bind=engine) as i_api:
+        img = i_api.get_image_file(uuid)
+        if img is None:
+            abort(
+                404,
+                "Image with uuid {uuid} not found".format(uuid=uuid)
+            )
+
+        stored = store_content(data.stream)
+        if stored is None:
+            abort(
+                413,
+                "Image exceeds the maximum size of {size} bytes".format(size=MAX_IMAGE_SIZE)
+            )
+        previous_hash = img.content_hash
         img.mimetype = data.mimetype
-        img.filename = "SERVER_DATA/"+str(uuid)+data.filename
-        data.save(img.filename)
+        img.content_hash, img.size = stored
+        img.filename = content_path(img.content_hash)
         name = img.name
         i_api.commit()
-    else:
-        i_api.close()
-        abort(
-            404,
-            "Image with uuid {uuid} not found".format(uuid=uuid)
-        )
+        if previous_hash != img.content_hash:
+            release_content(i_api, previous_hash)
+    image_variants.schedule_variants(stored[0])
 
     return make_response(
         "{name} successfully filled at uuid={uuid}".format(name=name, uuid=uuid), 200
     )
 
 
-def read(uuid):
-    i_api = ImageApi(bind=engine)
-    i_api.open()
-    img = i_api.get_image_file(uuid)
-    if img is None or img.filename is None:
-        i_api.close()
-        abort(
-            404,
-            "Image with uuid {uuid} not found".format(uuid=uuid)
-        )
-    filename = img.filename
-    i_api.close()
-    return send_file(filename)
+def read(uuid, variant=None, format=None):
+    """
+    This function responds to a request for /api/images/{uuid} with the image data.
+    The content hash is the ETag, so unchanged images are answered with 304,
+    Range requests are supported and the file is handed to the WSGI file wrapper (sendfile).
+    :param uuid: identifier for the image
+    :param variant: resized variant (original, thumbnail, merged), None for the uploaded file
+    :param format: format of the variant (jpeg, webp)
+    :return: image data, 304 if not modified, 404 on image not found
+    """
+    with ImageApi(bind=engine) as i_api:
+        img = i_api.get_image_file(uuid)
+        if img is None or img.filename is None:
+            abort(
+                404,
+                "Image with uuid {uuid} not found".format(uuid=uuid)
+            )
+        filename = img.filename
+        mimetype = img.mimetype
+        content_hash = img.content_hash
+
+    if (variant is not None or format is not None) and content_hash is not None:
+        return read_variant(content_hash, variant or "original", format or "jpeg")
+
+    # send_file evaluates If-None-Match/If-Range against the content hash, not the file name and mtime
+    rv = send_file(filename, mimetype=mimetype, conditional=True,
+                   etag=content_hash if content_hash is not None else False)
+    # the uuid may be refilled with other content, clients revalidate with If-None-Match
+    rv.cache_control.no_cache = True
+    return rv
+
+
+def read_variant(content_hash, variant, fmt):
+    """
+    Helper function for read, responds with a resized/converted variant of an image.
+    :param content_hash: hash of the image content
+    :param variant: key of image_variants.VARIANTS
+    :param fmt: key of image_variants.FORMATS
+    :return: variant data, 304 if not modified
+    """
+    etag = content_hash + "-" + os.path.basename(image_variants.variant_path(content_hash, variant, fmt))
+    if request.if_none_match.contains(etag):
+        rv = make_response("", 304)
+    else:
+        try:
+            data, mimetype = image_variants.read_variant(content_hash, variant, fmt)
+        except image_variants.VariantError as e:
+            abort(415 if image_variants.VARIANTS_AVAILABLE else 501, str(e))
+        rv = make_response(data, 200)
+        rv.mimetype = mimetype
+    rv.set_etag(etag)
+    rv.cache_control.no_cache = True
+    return rv
 
 
 def delete(uuid):
@@ -0,0 +1,25 @@
+"""
+This is the metrics module and supports all the ReST actions for the
+live stream metrics of the SurfaceStreams server.
+"""
+
+# System modules
+import metrics
+
+# 3rd party modules
+from flask import make_response
+
+
+def read_all(format="json"):
+    """
+    This function responds to a request for /api/metrics
+    with the current per-client stream metrics and TUIO forwarding metrics
+    :param format:  'json' or 'prometheus' (text exposition format)
+    :return:        metrics dict or Prometheus text
+    """
+    res = metrics.collector.collect()
+    if format == "prometheus":
+        return make_response(metrics.to_prometheus(res), 200, {
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8"
+        })
+    return res
@@ -0,0 +1,80 @@
+"""
+Helpers shared by the list endpoints for limit/cursor pagination,
+fields= projection and since= filtering.
+"""
+
+# System modules
+import base64
+from datetime import datetime
+
+# 3rd party modules
+from flask import abort
+
+
+def parse_fields(fields, allowed):
+    """
+    Parses a comma separated fields= parameter.
+    :param fields: comma separated field names, None or empty for all fields
+    :param allowed: list of selectable field names
+    :return: tuple of selected field names in the order of allowed
+    """
+    if fields is None or len(fields.strip()) == 0:
+        return tuple(allowed)
+    selected = set(f.strip() for f in fields.split(",") if len(f.strip()) > 0)
+    unknown = selected - set(allowed)
+    if len(unknown) > 0:
+        abort(400, "unknown fields: " + ", ".join(sorted(unknown)))
+    return tuple(f for f in allowed if f in selected)
+
+
+def parse_since(since):
+    """
+    Parses an ISO 8601 since= parameter.
+    :param since: datetime string, None for no filter
+    :return: datetime or None
+    """
+    if since is None or len(since) == 0:
+        return None
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(since, fmt)
+        except ValueError:
+            pass
+    abort(400, "since has to be an ISO 8601 datetime, e.g. 2019-04-29T12:00:00")
+
+
+def encode_cursor(*values):
+    """ encodes the sort key of the last returned row as opaque cursor. """
+    raw = "\n".join(str(v) for v in values)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, num_values):
+    """
+    Decodes a cursor created by encode_cursor.
+    :param cursor: cursor string, None for the first page
+    :param num_values: number of encoded values
+    :return: list of value strings or None
+    """
+    if cursor is None or len(cursor) == 0:
+        return None
+    try:
+        values = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("\n")
+    except (ValueError, UnicodeError):
+        values = []
+    if len(values) != num_values:
+        abort(400, "invalid cursor")
+    return values
+
+
+def page_response(items, next_cursor):
+    """
+    Returns a connexion response tuple, the cursor of the next page is sent in the X-Next-Cursor header.
+    :param items: list of result dicts
+    :param next_cursor: cursor of the next page, None if this is the last page
+    :return: (body, status, headers)
+    """
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    return items, 200, headers
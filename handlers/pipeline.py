@@ -0,0 +1,36 @@
+"""
+This is the pipeline module and supports all the ReST actions for the
+PIPELINE reconfiguration state
+"""
+
+# System modules
+import video_mixing
+
+# 3rd party modules
+from flask import abort
+
+
+def job_location(job):
+    return "/api/pipeline/jobs/{id}".format(id=job.id)
+
+
+def read():
+    """
+    This function responds to a request for /api/pipeline
+    with the current pipeline generation and queued reconfigurations
+    :return:        json string of the pipeline status
+    """
+    return video_mixing.reconfiguration.status()
+
+
+def read_job(job_id):
+    """
+    This function responds to a request for /api/pipeline/jobs/{job_id}
+    with the status of one reconfiguration job
+    :param job_id:  id of the job
+    :return:        job matching id
+    """
+    job = video_mixing.reconfiguration.get_job(job_id)
+    if job is None:
+        abort(404, "Pipeline job with id {id} not found".format(id=job_id))
+    return job.as_dict()
@@ -0,0 +1,20 @@
+"""
+This is the profiling module and supports all the ReST actions for the
+PROFILING summary of the mixing pipelines
+"""
+
+# System modules
+import video_mixing
+
+
+def read_all():
+    """
+    This function responds to a request for /api/profiling
+    with the cpu time per streaming thread and the queue levels of each mixing group.
+    Profiling is switched on and off through the server-config.
+    :return:        json string of profiling data
+    """
+    return {
+        "enabled": video_mixing.PROFILING,
+        "groups": video_mixing.get_profiling() if video_mixing.PROFILING else {}
+    }
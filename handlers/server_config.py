@@ -1,11 +1,14 @@
 """
 This is the server-config module and supports all the ReST actions for the
 configuration of the SurfaceStreams server config,
-including merged-stream-width & merged-stream-height.
+including merged-stream-width, merged-stream-height, merged-stream-fps, client-limit
+and the mixing backend of each mixing group.
 """
 
 # System modules
 import video_mixing
+import encoding_profiles
+from handlers import clients
 
 # 3rd party modules
 from flask import make_response, abort
@@ -19,7 +22,14 @@ def read_all():
     """
     return {
         "merged-stream-width": video_mixing.MERGED_STREAM_WIDTH,
-        "merged-stream-height": video_mixing.MERGED_STREAM_HEIGHT
+        "merged-stream-height": video_mixing.MERGED_STREAM_HEIGHT,
+        "merged-stream-fps": video_mixing.MERGED_STREAM_FPS,
+        "client-limit": clients.client_limit(),
+        "client-capacity-estimate": video_mixing.estimate_client_capacity(),
+        "encoding-profiles": encoding_profiles.get_selection(),
+        "profiling": video_mixing.PROFILING,
+        "keepalive-fps": video_mixing.KEEPALIVE_FPS,
+        "mixing-backends": dict(video_mixing.MIXING_BACKENDS, default=video_mixing.DEFAULT_MIXING_BACKEND)
     }
 
 
@@ -31,13 +41,46 @@ def update(config):
     """
     width = config.get("merged-stream-width", -1)
     height = config.get("merged-stream-height", -1)
+    fps = config.get("merged-stream-fps", -1)
+    client_limit = config.get("client-limit", -1)
+    profiling = config.get("profiling", None)
+    backends = config.get("mixing-backends", {})
+    keepalive_fps = config.get("keepalive-fps", None)
 
-    # Does the client exist in clients?
-    if width > 0 and height > 0:
+    if client_limit != -1:
+        # 0 or less returns to the capacity estimate, which follows merged stream size changes
+        clients.CLIENT_LIMIT = client_limit if client_limit > 0 else -1
+
+    if profiling is not None:
+        video_mixing.set_profiling(profiling)
+
+    if keepalive_fps is not None:
+        video_mixing.set_keepalive_fps(keepalive_fps)
+
+    for group, backend in backends.items():
+        if backend not in video_mixing.MIXING_BACKEND_NAMES:
+            abort(400, "unknown mixing backend {backend} for group {group}".format(backend=backend, group=group))
+    for group, backend in backends.items():
+        if group == "default":
+            video_mixing.DEFAULT_MIXING_BACKEND = backend
+            video_mixing.reconfiguration.submit()
+        else:
+            video_mixing.set_mixing_backend(group, backend)
+
+    resized = width > 0 and height > 0
+    if resized:
         video_mixing.MERGED_STREAM_WIDTH = width
         video_mixing.MERGED_STREAM_HEIGHT = height
-        video_mixing.update_pipelines()
-        return make_response("Update the current SurfaceStreams server config", 200)
+    if fps > 0:
+        video_mixing.MERGED_STREAM_FPS = fps
+    if resized or fps > 0:
+        video_mixing.reconfiguration.submit()
+        # the cheapest encoder depends on the merged stream, outputs whose encoder changes are rebuilt afterwards
+        encoding_profiles.schedule_selection(
+            video_mixing.MERGED_STREAM_WIDTH, video_mixing.MERGED_STREAM_HEIGHT, video_mixing.MERGED_STREAM_FPS,
+            lambda selection: video_mixing.reconfiguration.submit()
+        )
     # otherwise, nope, that's an error
-    else:
+    elif client_limit == -1 and profiling is None and len(backends) == 0 and keepalive_fps is None:
         abort(404, "not all arguments supplied.")
+    return make_response("Update the current SurfaceStreams server config", 200)
@@ -0,0 +1,202 @@
+"""
+Resized and format-converted variants of uploaded images.
+Variants are generated on a worker pool after upload and stored next to
+the original as SERVER_DATA/<hash>.<width>x<height>.<format>.
+The hottest variants are kept in an in-memory LRU cache.
+Requires Pillow, without it only original images are served.
+"""
+
+import collections
+import glob
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import video_mixing
+
+try:
+    from PIL import Image
+    VARIANTS_AVAILABLE = True
+except ImportError:
+    Image = None
+    VARIANTS_AVAILABLE = False
+
+
+SERVER_DATA_DIR = "SERVER_DATA"
+
+THUMBNAIL_SIZE = (160, 120)
+
+# variant name to function returning its (width, height), None keeps the original size
+VARIANTS = {
+    "original": lambda: None,
+    "thumbnail": lambda: THUMBNAIL_SIZE,
+    "merged": lambda: (video_mixing.MERGED_STREAM_WIDTH, video_mixing.MERGED_STREAM_HEIGHT)
+}
+
+# format name to (Pillow format, mimetype)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp")
+}
+
+# variants generated right after upload
+PREGENERATED = [("thumbnail", "webp"), ("thumbnail", "jpeg"), ("merged", "webp"), ("merged", "jpeg")]
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class VariantError(Exception):
+    pass
+
+
+class LruBytesCache(object):
+    """
+    Thread-safe LRU cache of byte strings bounded by their total size.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key, None)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._items.keys() if k.startswith(prefix)]:
+                self._size -= len(self._items.pop(key))
+
+
+cache = LruBytesCache(CACHE_MAX_BYTES)
+
+executor = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2))
+
+_GENERATE_LOCKS = [threading.Lock() for _ in range(32)]
+
+
+def variant_path(content_hash, variant, fmt):
+    size = VARIANTS[variant]()
+    size_name = "original" if size is None else str(size[0]) + "x" + str(size[1])
+    return os.path.join(SERVER_DATA_DIR, content_hash + "." + size_name + "." + fmt)
+
+
+def generate_variant(content_hash, variant, fmt):
+    """
+    Creates a variant of stored content if it does not exist yet.
+    :param content_hash: hash of the original content
+    :param variant: key of VARIANTS
+    :param fmt: key of FORMATS
+    :return: path of the variant
+    """
+    path = variant_path(content_hash, variant, fmt)
+    # concurrent requests for the same variant wait for the first one instead of generating it again
+    with _GENERATE_LOCKS[hash(path) % len(_GENERATE_LOCKS)]:
+        if os.path.exists(path):
+            return path
+        if not VARIANTS_AVAILABLE:
+            raise VariantError("image variants require Pillow")
+        _write_variant(content_hash, variant, fmt, path)
+    return path
+
+
+def _write_variant(content_hash, variant, fmt, path):
+    """
+    Helper function for generate_variant, encodes the variant into a temp file and moves it to path.
+    """
+    try:
+        img = Image.open(os.path.join(SERVER_DATA_DIR, content_hash))
+        img.load()
+    except (IOError, OSError) as e:
+        raise VariantError("could not decode image: " + str(e))
+    size = VARIANTS[variant]()
+    if size is not None:
+        # keeps the aspect ratio, fits into size
+        img.thumbnail(size)
+    pil_format = FORMATS[fmt][0]
+    if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    fd, tmp_name = tempfile.mkstemp(dir=SERVER_DATA_DIR, prefix=".variant-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            img.save(tmp, pil_format)
+        os.replace(tmp_name, path)
+    except (IOError, OSError) as e:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise VariantError("could not store image variant: " + str(e))
+    if not os.path.exists(os.path.join(SERVER_DATA_DIR, content_hash)):
+        # the content was released while the variant was encoded, remove_variants may have missed it
+        if os.path.exists(path):
+            os.remove(path)
+        raise VariantError("image content was removed")
+
+
+def _generate_all(content_hash):
+    for variant, fmt in PREGENERATED:
+        try:
+            generate_variant(content_hash, variant, fmt)
+        except VariantError as e:
+            print("#### could not create image variant", content_hash, variant, fmt, e)
+            return
+
+
+def schedule_variants(content_hash):
+    """
+    Generates the PREGENERATED variants of uploaded content on the worker pool.
+    :param content_hash: hash of the original content
+    :return: future or None if variants are not available
+    """
+    if not VARIANTS_AVAILABLE:
+        return None
+    return executor.submit(_generate_all, content_hash)
+
+
+def read_variant(content_hash, variant, fmt):
+    """
+    Returns variant data, from the LRU cache if possible.
+    Missing variants are generated on the worker pool and awaited.
+    :param content_hash: hash of the original content
+    :param variant: key of VARIANTS
+    :param fmt: key of FORMATS
+    :return: (bytes, mimetype)
+    """
+    path = variant_path(content_hash, variant, fmt)
+    data = cache.get(path)
+    if data is None:
+        executor.submit(generate_variant, content_hash, variant, fmt).result()
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            raise VariantError("image variant was removed: " + str(e))
+        cache.put(path, data)
+    return data, FORMATS[fmt][1]
+
+
+def remove_variants(content_hash):
+    """
+    Deletes all stored and cached variants of content.
+    :param content_hash: hash of the original content
+    :return:
+    """
+    cache.discard_prefix(os.path.join(SERVER_DATA_DIR, content_hash + "."))
+    for path in glob.glob(os.path.join(SERVER_DATA_DIR, content_hash + ".*")):
+        os.remove(path)
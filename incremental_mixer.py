@@ -0,0 +1,1034 @@
+"""
+Incremental SurfaceStreams video mixing pipeline.
+Keeps a single GStreamer pipeline PLAYING and adds or removes the udp source
+and sink branches of single clients, instead of tearing down the whole
+pipeline whenever a client joins or leaves.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst, GLib
+
+
+# rtp caps, depayloader, decoder, encoder and payloader per video_protocol,
+# bitrate holds the encoder property and its factor for a bitrate in kbit/s (None if not supported)
+STREAM_PROTOCOLS = {
+    "jpeg": {
+        "caps": "application/x-rtp, media=video, clock-rate=90000, encoding-name=JPEG, payload=26",
+        "depay": ("rtpjpegdepay", {}),
+        "decode": ("jpegdec", {}),
+        "encode": ("jpegenc", {}),
+        "bitrate": None,
+        "pay": ("rtpjpegpay", {})
+    },
+    "vp8": {
+        "caps": "application/x-rtp, media=video, clock-rate=90000, encoding-name=VP8, payload=96",
+        "depay": ("rtpvp8depay", {}),
+        "decode": ("vp8dec", {}),
+        "encode": ("vp8enc", {"deadline": 1}),
+        "bitrate": ("target-bitrate", 1000),
+        "pay": ("rtpvp8pay", {})
+    },
+    "mp4": {
+        "caps": "application/x-rtp, media=video, clock-rate=90000, encoding-name=H264, payload=96",
+        "depay": ("rtph264depay", {}),
+        "decode": ("avdec_h264", {}),
+        "encode": ("x264enc", {"tune": "zerolatency", "speed-preset": "ultrafast"}),
+        "bitrate": ("bitrate", 1),
+        "pay": ("rtph264pay", {"config-interval": 1})
+    }
+}
+
+# keying applied to every incoming stream before it is blended
+ALPHA_KEY = {"method": "custom", "target-r": 0, "target-g": 0, "target-b": 0}
+
+# buffers each edge queue holds before dropping the oldest, so a slow branch cannot stall a shared tee
+EDGE_QUEUE_SIZE = 2
+
+BACKGROUND_ID = "__background__"
+
+# 'auto' topology switches from direct to tiled mixing above this number of clients
+TILED_MIXING_THRESHOLD = 4
+
+# frames per second still sent while no input changes, -1 sends every frame
+KEEPALIVE_FPS = 5.0
+
+# every STATIC_SAMPLE_STRIDE-th byte of a decoded frame is compared with the last changed frame,
+# odd so the samples spread over the columns of any row width
+STATIC_SAMPLE_STRIDE = 17
+
+# a sample differing by more than this counts as changed (decoder noise stays below)
+STATIC_PIXEL_THRESHOLD = 8
+
+# changed samples from which a frame counts as changed, a pen tip already changes more
+STATIC_CHANGED_SAMPLES = 2
+
+# seconds after which a keyframe is forced on a resumed output. Encoders count their keyframe
+# distance in frames, which suppressed frames would stretch far beyond its time.
+KEYFRAME_INTERVAL = 2.0
+
+# seconds outputs keep sending every frame after an input changed, until the change passed the compositor
+STATIC_SETTLE_TIME = 0.2
+
+# elements running a streaming thread of their own besides sources (see _SegmentProfile)
+THREAD_FACTORIES = ["queue", "compositor"]
+
+# milliseconds between queue fill level samples while profiling
+QUEUE_SAMPLE_INTERVAL = 100
+
+
+def _protocol(name):
+    return STREAM_PROTOCOLS.get(name, STREAM_PROTOCOLS["jpeg"])
+
+
+def _make(factory, props=None):
+    """
+    Creates a GStreamer element and sets its properties.
+    String values are deserialized (enums, caps), all other values are set as is.
+    :param factory: name of the element factory
+    :param props: dict of property names and values
+    :return: the created element
+    """
+    element = Gst.ElementFactory.make(factory, None)
+    if element is None:
+        raise RuntimeError("GStreamer element '" + factory + "' not available")
+    for key, value in (props or {}).items():
+        if isinstance(value, str):
+            Gst.util_set_object_arg(element, key, value)
+        else:
+            element.set_property(key, value)
+    return element
+
+
+def _raw_caps(width, height, framerate=None):
+    caps = "video/x-raw, width=" + str(width) + ", height=" + str(height)
+    if framerate is not None:
+        caps += ", framerate=" + str(framerate) + "/1"
+    return caps
+
+
+def _source_key(client):
+    """ client values which require a new source branch if changed. """
+    return client["video_src_port"], client["video_protocol"]
+
+
+def _encoding(client):
+    """
+    Returns the encoder, bitrate property, default bitrate and payloader of a client's output.
+    Clients with encoding profile carry its settings (see encoding_profiles.resolve),
+    others use the defaults of their video_protocol.
+    """
+    encoding = client.get("encoding", None)
+    if encoding is not None:
+        return encoding
+    protocol = _protocol(client["video_protocol"])
+    return {
+        "profile": None,
+        "encode": protocol["encode"],
+        "bitrate": protocol["bitrate"],
+        "default_bitrate": -1,
+        "pay": protocol["pay"]
+    }
+
+
+def _output_key(client):
+    """ client values which require a new sink branch if changed. """
+    encoding = _encoding(client)
+    return client["video_protocol"], encoding["profile"], encoding["encode"][0], \
+        client.get("output_width", -1), client.get("output_height", -1), client.get("output_fps", -1)
+
+
+class _BranchStats(object):
+    """
+    Cumulative buffer counters of one branch, updated by pad probes.
+    bytes and buffers count rtp packets at the udp element, frames count video frames
+    after the decoder (inputs) or in front of the payloader (outputs).
+    latency is the age of a buffer (running time - pts) when it reaches the probed pad, so it only
+    covers the time spent inside the pipeline, not the network or the client.
+    created is when the branch was built, its counters start from zero on every rebuild.
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.buffers = 0
+        self.frames = 0
+        self.dropped = 0
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.suppressed = 0
+        self.last_buffer = None
+        self.created = time.monotonic()
+
+    def as_dict(self):
+        return {
+            "bytes": self.bytes,
+            "buffers": self.buffers,
+            "frames": self.frames,
+            "dropped_buffers": self.dropped,
+            "suppressed_buffers": self.suppressed,
+            "pipeline_latency_ms": (self.latency_sum / self.latency_count) / 1e6 if self.latency_count > 0 else 0.0,
+            "seconds_since_last_buffer": time.monotonic() - self.last_buffer if self.last_buffer is not None else -1,
+            "seconds_since_created": time.monotonic() - self.created
+        }
+
+
+def _add_stats_probe(element, pad_name, stats, measure_latency=False, on_first_buffer=None):
+    """
+    Counts bytes and buffers passing a pad of the given element.
+    on_first_buffer is called (from the streaming thread) when the first buffer passes.
+    """
+    def _on_buffer(pad, info):
+        buf = info.get_buffer()
+        if stats.buffers == 0 and on_first_buffer is not None:
+            on_first_buffer()
+        stats.bytes += buf.get_size()
+        stats.buffers += 1
+        stats.last_buffer = time.monotonic()
+        if measure_latency and buf.pts != Gst.CLOCK_TIME_NONE:
+            clock = element.get_clock()
+            if clock is not None:
+                running_time = clock.get_time() - element.get_base_time()
+                if running_time >= buf.pts:
+                    stats.latency_sum += running_time - buf.pts
+                    stats.latency_count += 1
+        return Gst.PadProbeReturn.OK
+
+    element.get_static_pad(pad_name).add_probe(Gst.PadProbeType.BUFFER, _on_buffer)
+
+
+def _add_frame_probe(element, pad_name, stats):
+    """ Counts video frames passing a pad of the given element. """
+    def _on_buffer(pad, info):
+        stats.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    element.get_static_pad(pad_name).add_probe(Gst.PadProbeType.BUFFER, _on_buffer)
+
+
+def _frame_changed(node, data):
+    """
+    Compares a decoded frame with the last changed frame of a node by a strided sample.
+    Local changes count, not the average over the frame: a hand or pen over
+    a few percent of the surface changes the frame.
+    Updates node.sample and node.changed_at if the frame changed.
+    :param node: branch the frame belongs to
+    :param data: raw frame bytes
+    :return: True if the frame changed
+    """
+    sample = np.frombuffer(data, dtype=np.uint8)[::STATIC_SAMPLE_STRIDE].astype(np.int16)
+    if node.sample is not None and node.sample.shape == sample.shape \
+            and np.count_nonzero(np.abs(sample - node.sample) > STATIC_PIXEL_THRESHOLD) < STATIC_CHANGED_SAMPLES:
+        return False
+    node.sample = sample
+    node.changed_at = time.monotonic()
+    return True
+
+
+def _keepalive_due(node, keepalive_fps, now):
+    """ True if a node which did not change has to send a frame anyway. """
+    return keepalive_fps <= 0 or node.last_forwarded is None or now - node.last_forwarded >= 1.0 / keepalive_fps
+
+
+def _track_keyframes(output):
+    """ Records when the encoder of an output emitted its last keyframe. """
+    def _on_buffer(pad, info):
+        if not info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+            output.last_keyframe = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    output.encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, _on_buffer)
+
+
+def _force_keyframe_if_due(output, now):
+    """ Requests a keyframe from the encoder of an output whose last keyframe is older than KEYFRAME_INTERVAL. """
+    if now - output.last_keyframe < KEYFRAME_INTERVAL:
+        return
+    # restarts the interval, the keyframe itself is recorded by _track_keyframes
+    output.last_keyframe = now
+    output.encoder.get_static_pad("src").send_event(Gst.Event.new_custom(
+        Gst.EventType.CUSTOM_UPSTREAM, Gst.Structure.new_from_string("GstForceKeyUnit, all-headers=(boolean)true")
+    ))
+
+
+def _thread_cpu(thread_id):
+    """ cpu seconds used by a thread of this process, None if it is gone or /proc is not available. """
+    try:
+        with open("/proc/self/task/%d/stat" % thread_id) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError):
+        return None
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def _starts_thread(element):
+    return element.numsinkpads == 0 or element.get_factory().get_name() in THREAD_FACTORIES
+
+
+def _segment_elements(head):
+    """ names of the elements run by the streaming thread starting at head. """
+    names = []
+    pending = [head]
+    while len(pending) > 0:
+        element = pending.pop()
+        names.append(element.get_name())
+        for pad in element.iterate_src_pads():
+            peer = pad.get_peer()
+            downstream = peer.get_parent_element() if peer is not None else None
+            if downstream is not None and not _starts_thread(downstream):
+                pending.append(downstream)
+    return names
+
+
+class _SegmentProfile(object):
+    """
+    Cost of one streaming thread of the pipeline.
+    A streaming thread starts at a source, a queue or a compositor and runs all elements
+    downstream of it up to the next queue or compositor, its cpu time is the cost of that segment.
+    A tee thus counts to the segment feeding it, a compositor aggregates in its own thread
+    while its sink pads only hand over buffers.
+    The thread is identified by a single buffer, no probe stays on the data path.
+    Queues also sample their fill level, see IncrementalVideoMixer._sample_queues.
+    """
+    def __init__(self, factory, element=None):
+        self.factory = factory
+        self.element = element
+        self.thread_id = None
+        self.cpu_start = None
+        self.identified = None
+        self.levels = 0
+        self.samples = 0
+        self.max_level = 0
+
+    def identify(self, thread_id):
+        self.cpu_start = _thread_cpu(thread_id)
+        self.identified = time.monotonic()
+        self.thread_id = thread_id
+
+    def as_dict(self, elements):
+        cpu = _thread_cpu(self.thread_id) if self.thread_id is not None else None
+        used = cpu - self.cpu_start if cpu is not None and self.cpu_start is not None else 0.0
+        elapsed = time.monotonic() - self.identified if self.identified is not None else 0.0
+        return {
+            "factory": self.factory,
+            "elements": elements,
+            "cpu_ms": used * 1000.0,
+            "cpu_percent": 100.0 * used / elapsed if elapsed > 0 else 0.0
+        }
+
+
+class _Chain(object):
+    """ Linear chain of elements which can be added to and removed from a running pipeline. """
+    def __init__(self, elements):
+        self.elements = elements
+
+    @property
+    def first(self):
+        return self.elements[0]
+
+    @property
+    def last(self):
+        return self.elements[-1]
+
+    def attach(self, pipeline):
+        for e in self.elements:
+            pipeline.add(e)
+        for up, down in zip(self.elements, self.elements[1:]):
+            if not up.link(down):
+                raise RuntimeError("could not link " + up.get_name() + " to " + down.get_name())
+
+    def sync_state(self):
+        # downstream elements first, so data never hits a stopped element
+        for e in reversed(self.elements):
+            e.sync_state_with_parent()
+
+    def detach(self, pipeline):
+        for e in self.elements:
+            e.set_state(Gst.State.NULL)
+        for e in self.elements:
+            pipeline.remove(e)
+
+
+class _Node(_Chain):
+    """ pipeline branch connected to other branches by edges. """
+    def __init__(self, elements, zorder=0):
+        super().__init__(elements)
+        self.zorder = zorder
+        self.edge_count = 0
+        self.out_count = 0
+        self.removed = False
+        self.stats = _BranchStats()
+        # duplicate frame suppression, see IncrementalVideoMixer.set_keepalive
+        self.sample = None
+        self.changed_at = time.monotonic()
+        self.last_forwarded = None
+        self.last_keyframe = time.monotonic()
+
+
+class _Source(_Node):
+    """ udpsrc -> depay -> decode -> scale -> alpha -> tee, one per connected client. """
+
+
+class _Output(_Node):
+    """ compositor -> scale/rate caps -> rate limit -> encode -> pay -> udpsink, one per connected client. """
+    def __init__(self, elements, width, height):
+        super().__init__(elements)
+        self.width = width
+        self.height = height
+
+    @property
+    def rate(self):
+        return self.elements[2]
+
+    @property
+    def encoder(self):
+        return self.elements[4]
+
+    @property
+    def udpsink(self):
+        return self.last
+
+
+class _Composite(_Node):
+    """ compositor -> tee, partial composition shared by several outputs (tiled mixing). """
+
+
+class _Edge(_Chain):
+    """ tee pad -> queue -> ... -> compositor pad, one per blended (producer, consumer) pair. """
+    def __init__(self, elements, source, output, zorder):
+        super().__init__(elements)
+        self.source = source
+        self.output = output
+        self.zorder = zorder
+        self.tee_pad = None
+        self.mixer_pad = None
+
+
+class IncrementalVideoMixer(object):
+    """
+    Mixes the udp video streams of all clients. Each client receives the
+    alpha keyed composition of the other clients streams ('other' mode)
+    or of all streams ('all' mode). Changes to the client set are applied
+    as a diff against the running pipeline (see sync).
+
+    With the 'direct' topology every output blends all of its inputs (O(N^2) blends).
+    The 'tiled' topology builds a binary tree of shared composites over aligned blocks
+    of the clients in join order. Each output blends the blocks before and after its
+    client, O(log N) inputs, and a stream passes at most log2(N) composites on its way,
+    each adding an aggregation interval of latency.
+    'auto' uses tiled mixing above TILED_MIXING_THRESHOLD clients.
+
+    on_event(event, data) is called from streaming threads, e.g. with 'stream-live'
+    when the first buffer of a client's input or output passes.
+
+    Unchanged input frames are dropped before keying, the compositor keeps showing
+    the last frame of an input. Outputs whose inputs did not change only encode
+    keepalive_fps frames per second (see set_keepalive).
+    """
+    def __init__(self, width=640, height=360, topology="auto", on_event=None, name="surface-streams-mixer", fps=30):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.topology = topology
+        self.on_event = on_event
+        self.name = name
+        self.profiling = False
+        self.keepalive_fps = KEEPALIVE_FPS
+        self._changed_at = time.monotonic()
+        self._segments = {}
+        self._sampler = None
+        self._graph_file = None
+        self._rebuilds = 0
+        self._pipeline = None
+        self._clients = {}
+        self._sources = {}
+        self._outputs = {}
+        self._composites = {}
+        self._edges = {}
+        self._next_zorder = 1
+        self._lock = threading.RLock()
+
+    def start(self):
+        """
+        Creates the pipeline with its background source and sets it to PLAYING.
+        :return:
+        """
+        with self._lock:
+            self._pipeline = Gst.Pipeline.new(self.name)
+            bus = self._pipeline.get_bus()
+            bus.add_signal_watch()
+            bus.connect("message", self._on_message)
+            background = _Source([
+                _make("videotestsrc", {"is-live": True, "pattern": "black"}),
+                _make("capsfilter", {"caps": _raw_caps(self.width, self.height, self.fps) + ", format=AYUV"}),
+                _make("tee", {"allow-not-linked": True})
+            ], zorder=0)
+            background.attach(self._pipeline)
+            self._sources[BACKGROUND_ID] = background
+            self._pipeline.set_state(Gst.State.PLAYING)
+
+    def cleanup(self):
+        """
+        Stops the pipeline and releases all branches.
+        :return:
+        """
+        with self._lock:
+            if self._pipeline is not None:
+                self._pipeline.get_bus().remove_signal_watch()
+                self._pipeline.set_state(Gst.State.NULL)
+            self._pipeline = None
+            self._clients = {}
+            self._sources = {}
+            self._outputs = {}
+            self._composites = {}
+            self._edges = {}
+            self._segments = {}
+
+    def is_running(self):
+        return self._pipeline is not None
+
+    def get_client_uuids(self):
+        with self._lock:
+            return list(self._clients.keys())
+
+    def get_stats(self):
+        """
+        Returns cumulative counters of the source (in) and sink (out) branch of each client.
+        Dropped buffers of an output are buffers its edge queues leaked,
+        its bitrate the current encoder bitrate in kbit/s (-1 without bitrate control).
+        :return: dict of client uuid to {"in": {...}, "out": {...}}
+        """
+        with self._lock:
+            return {
+                uuid: {
+                    "in": self._sources[uuid].stats.as_dict(),
+                    "out": dict(self._outputs[uuid].stats.as_dict(), bitrate=self._get_bitrate(uuid))
+                }
+                for uuid in self._clients.keys()
+                if uuid in self._sources and uuid in self._outputs
+            }
+
+    def _get_bitrate(self, uuid):
+        prop = _encoding(self._clients[uuid])["bitrate"]
+        if prop is None:
+            return -1
+        return self._outputs[uuid].encoder.get_property(prop[0]) / prop[1]
+
+    def sync(self, clients):
+        """
+        Applies the given client set to the running pipeline.
+        Only branches of added, removed or changed clients are touched.
+        :param clients: list of client dicts (see Client.as_dict)
+        :return: number of branches added or removed
+        """
+        desired = {c["uuid"]: c for c in clients}
+        changes = 0
+        with self._lock:
+            for uuid in list(self._clients.keys()):
+                if uuid not in desired:
+                    self._remove_source(uuid)
+                    self._remove_output(uuid)
+                    del self._clients[uuid]
+                    changes += 2
+            for uuid, c in desired.items():
+                old = self._clients.get(uuid)
+                if old is None:
+                    self._add_source(c)
+                    self._add_output(c)
+                    changes += 2
+                else:
+                    if _source_key(old) != _source_key(c):
+                        self._remove_source(uuid)
+                        self._add_source(c)
+                        changes += 1
+                    if _output_key(old) != _output_key(c):
+                        self._remove_output(uuid)
+                        self._add_output(c)
+                        changes += 1
+                    else:
+                        # udpsink and encoder bitrate can be changed while PLAYING
+                        if old["ip"] != c["ip"] or old["video_sink_port"] != c["video_sink_port"]:
+                            self._outputs[uuid].udpsink.set_property("host", c["ip"])
+                            self._outputs[uuid].udpsink.set_property("port", c["video_sink_port"])
+                        if old.get("output_bitrate", -1) != c.get("output_bitrate", -1):
+                            self._set_bitrate(self._outputs[uuid], c)
+                self._clients[uuid] = c
+            changes += self._sync_edges()
+            # new or removed branches change the merged frames
+            self._changed_at = time.monotonic()
+            self._rebuilds += 1
+            if self.profiling:
+                self._instrument()
+                self.dump_graph()
+        return changes
+
+    def add_client(self, client):
+        """
+        Adds (or updates) a single client, leaving all other clients untouched.
+        :param client: client dict
+        :return: number of branches added or removed
+        """
+        with self._lock:
+            clients = [c for uuid, c in self._clients.items() if uuid != client["uuid"]]
+            return self.sync(clients + [client])
+
+    def remove_client(self, uuid):
+        """
+        Removes a single client, leaving all other clients untouched.
+        :param uuid: uuid of the client
+        :return: number of branches added or removed
+        """
+        with self._lock:
+            return self.sync([c for c_uuid, c in self._clients.items() if c_uuid != uuid])
+
+    def resize(self, width, height, fps=None):
+        """
+        Changes the merged stream size and frame rate. Requires a rebuild of all branches.
+        :param width: merged stream width
+        :param height: merged stream height
+        :param fps: merged stream frame rate, None keeps the current one
+        :return:
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self.cleanup()
+            self.width = width
+            self.height = height
+            self.fps = fps if fps is not None else self.fps
+            self.start()
+            self.sync(clients)
+
+    def _is_tiled(self):
+        if self.topology == "auto":
+            return len(self._clients) > TILED_MIXING_THRESHOLD
+        return self.topology == "tiled"
+
+    def _desired_graph(self):
+        """
+        Computes the edges (producer id, consumer id) -> compositor zorder
+        and the composite nodes required for the current client set.
+        """
+        edges = {}
+        composites = set()
+        order = sorted(self._clients.keys(), key=lambda u: self._sources[u].zorder)
+        single = len(order) == 1
+
+        if not self._is_tiled():
+            for out_uuid, out in self._clients.items():
+                edges[(BACKGROUND_ID, out_uuid)] = 0
+                mode = "all" if single else out["mixing_mode"]
+                for src_uuid in order:
+                    if mode == "all" or src_uuid != out_uuid:
+                        edges[(src_uuid, out_uuid)] = self._sources[src_uuid].zorder
+            return edges, composites
+
+        def block(start, level):
+            # composition of the 2^level clients from order[start], named after its first and last client
+            if level == 0:
+                return order[start]
+            half = 1 << (level - 1)
+            node = "block:" + order[start] + ":" + order[start + 2 * half - 1]
+            if node not in composites:
+                composites.add(node)
+                edges[(block(start, level - 1), node)] = 0
+                edges[(block(start + half, level - 1), node)] = 1
+            return node
+
+        def span(begin, end):
+            # order[begin..end-1] as the largest aligned blocks, lowest first
+            nodes = []
+            while begin < end:
+                level = 0
+                while begin % (2 << level) == 0 and begin + (2 << level) <= end:
+                    level += 1
+                nodes.append(block(begin, level))
+                begin += 1 << level
+            return nodes
+
+        for k, out_uuid in enumerate(order):
+            inputs = [BACKGROUND_ID] + span(0, k)
+            if single or self._clients[out_uuid]["mixing_mode"] == "all":
+                inputs.append(out_uuid)
+            inputs += span(k + 1, len(order))
+            for zorder, producer in enumerate(inputs):
+                edges[(producer, out_uuid)] = zorder
+        return edges, composites
+
+    def _sync_edges(self):
+        desired, composites = self._desired_graph()
+        current = set(self._edges.keys())
+        for key in current - set(desired.keys()):
+            self._remove_edge(key)
+        for node_id in set(self._composites.keys()) - composites:
+            self._remove_composite(node_id)
+        for node_id in composites - set(self._composites.keys()):
+            self._add_composite(node_id)
+        for key, zorder in desired.items():
+            edge = self._edges.get(key, None)
+            if edge is None:
+                self._add_edge(key, zorder)
+            elif edge.zorder != zorder:
+                edge.zorder = zorder
+                edge.mixer_pad.set_property("zorder", zorder)
+        return len(current ^ set(desired.keys()))
+
+    def _producer(self, node_id):
+        return self._sources[node_id] if node_id in self._sources else self._composites[node_id]
+
+    def _consumer(self, node_id):
+        return self._outputs[node_id] if node_id in self._outputs else self._composites[node_id]
+
+    def _add_composite(self, node_id):
+        composite = _Composite([
+            _make("compositor", {"background": "transparent"}),
+            _make("capsfilter", {"caps": _raw_caps(self.width, self.height) + ", format=AYUV"}),
+            _make("tee", {"allow-not-linked": True})
+        ])
+        composite.attach(self._pipeline)
+        composite.sync_state()
+        self._composites[node_id] = composite
+
+    def _remove_composite(self, node_id):
+        composite = self._composites.pop(node_id)
+        composite.removed = True
+        self._forget_profile(composite)
+        for key in [k for k in self._edges.keys() if node_id in k]:
+            self._remove_edge(key)
+        self._dispose_node(composite)
+
+    def _dispose_node(self, node):
+        if node.removed and node.edge_count == 0 and node.out_count == 0:
+            node.detach(self._pipeline)
+
+    def _add_source(self, client):
+        protocol = _protocol(client["video_protocol"])
+        depay, depay_props = protocol["depay"]
+        decode, decode_props = protocol["decode"]
+        # decoded, scaled and keyed once, raw frames are shared by all consumers
+        source = _Source([
+            _make("udpsrc", {"port": client["video_src_port"], "caps": protocol["caps"]}),
+            _make(depay, depay_props),
+            _make(decode, decode_props),
+            _make("videoconvert"),
+            _make("videoscale"),
+            _make("capsfilter", {"caps": _raw_caps(self.width, self.height)}),
+            _make("alpha", ALPHA_KEY),
+            _make("tee", {"allow-not-linked": True})
+        ], zorder=self._next_zorder)
+        self._next_zorder += 1
+        _add_stats_probe(source.first, "src", source.stats,
+                         on_first_buffer=self._event_callback("stream-live", client["uuid"], "in"))
+        _add_frame_probe(source.elements[2], "src", source.stats)
+        source.elements[5].get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._on_source_frame, source)
+        source.attach(self._pipeline)
+        source.sync_state()
+        self._sources[client["uuid"]] = source
+
+    def _remove_source(self, uuid):
+        source = self._sources.pop(uuid, None)
+        if source is None:
+            return
+        self._forget_profile(source)
+        # stop the udpsrc first, no data passes the tee afterwards
+        source.first.set_state(Gst.State.NULL)
+        for key in [k for k in self._edges.keys() if k[0] == uuid]:
+            edge = self._edges.pop(key)
+            self._forget_profile(edge)
+            edge.tee_pad.unlink(edge.first.get_static_pad("sink"))
+            self._dispose_edge(edge)
+        source.detach(self._pipeline)
+
+    def _add_output(self, client):
+        encoding = _encoding(client)
+        encode, encode_props = encoding["encode"]
+        pay, pay_props = encoding["pay"]
+        width = client.get("output_width", -1)
+        height = client.get("output_height", -1)
+        if width <= 0 or height <= 0:
+            width, height = self.width, self.height
+        fps = client.get("output_fps", -1)
+        output = _Output([
+            _make("compositor", {"background": "black"}),
+            _make("capsfilter", {"caps": _raw_caps(width, height, fps if fps > 0 else None)}),
+            # drops frames if the frame rate is lowered for a congested link (see tune_output)
+            _make("videorate", {"drop-only": True}),
+            _make("videoconvert"),
+            _make(encode, encode_props),
+            _make(pay, pay_props),
+            _make("udpsink", {
+                "host": client["ip"], "port": client["video_sink_port"],
+                "sync": False, "async": False
+            })
+        ], width, height)
+        self._set_bitrate(output, client)
+        _add_stats_probe(output.udpsink, "sink", output.stats, measure_latency=True,
+                         on_first_buffer=self._event_callback("stream-live", client["uuid"], "out"))
+        _add_frame_probe(output.elements[5], "sink", output.stats)
+        _track_keyframes(output)
+        # unchanged merged frames are dropped before they are converted and encoded
+        output.elements[3].get_static_pad("sink").add_probe(
+            Gst.PadProbeType.BUFFER, self._on_output_frame, (client["uuid"], output)
+        )
+        output.attach(self._pipeline)
+        output.sync_state()
+        self._outputs[client["uuid"]] = output
+
+    def set_keepalive(self, fps):
+        """
+        Sets the frame rate still sent to clients while none of their inputs changes.
+        :param fps: keep-alive frames per second, -1 disables duplicate frame suppression
+        :return:
+        """
+        with self._lock:
+            self.keepalive_fps = fps
+
+    def _last_change(self, uuid):
+        """ monotonic time of the last change of any input of the given client's output. """
+        client = self._clients.get(uuid)
+        # a single client sees its own stream (see _desired_graph)
+        own = client is None or client["mixing_mode"] == "all" or len(self._clients) == 1
+        latest = self._changed_at
+        for s_uuid, source in list(self._sources.items()):
+            if s_uuid != BACKGROUND_ID and (own or s_uuid != uuid):
+                latest = max(latest, source.changed_at)
+        return latest
+
+    def _on_source_frame(self, pad, info, source):
+        if self.keepalive_fps <= 0:
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        ok, mapped = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            return Gst.PadProbeReturn.OK
+        try:
+            changed = _frame_changed(source, mapped.data)
+        finally:
+            buf.unmap(mapped)
+        now = time.monotonic()
+        if not changed and not _keepalive_due(source, self.keepalive_fps, now):
+            source.stats.suppressed += 1
+            return Gst.PadProbeReturn.DROP
+        source.last_forwarded = now
+        return Gst.PadProbeReturn.OK
+
+    def _on_output_frame(self, pad, info, data):
+        uuid, output = data
+        now = time.monotonic()
+        if self.keepalive_fps > 0 and now - self._last_change(uuid) >= STATIC_SETTLE_TIME \
+                and not _keepalive_due(output, self.keepalive_fps, now):
+            output.stats.suppressed += 1
+            return Gst.PadProbeReturn.DROP
+        if output.stats.suppressed > 0:
+            _force_keyframe_if_due(output, now)
+        output.last_forwarded = now
+        return Gst.PadProbeReturn.OK
+
+    def _event_callback(self, event, uuid, direction):
+        if self.on_event is None:
+            return None
+        return lambda: self.on_event(event, {"uuid": uuid, "direction": direction})
+
+    @staticmethod
+    def _set_bitrate(output, client, bitrate=-1):
+        encoding = _encoding(client)
+        bitrate = bitrate if bitrate > 0 else client.get("output_bitrate", -1)
+        bitrate = bitrate if bitrate > 0 else encoding["default_bitrate"]
+        prop = encoding["bitrate"]
+        if bitrate > 0 and prop is not None:
+            output.encoder.set_property(prop[0], int(bitrate * prop[1]))
+            return True
+        return False
+
+    def tune_output(self, uuid, bitrate=-1, fps=-1):
+        """
+        Changes encoder bitrate and frame rate of a client's merged stream while PLAYING.
+        :param uuid: uuid of the client
+        :param bitrate: bitrate in kbit/s, -1 restores the configured bitrate
+        :param fps: maximum frame rate, -1 removes the limit
+        :return: False if the client has no output
+        """
+        with self._lock:
+            output = self._outputs.get(uuid, None)
+            if output is None:
+                return False
+            if not self._set_bitrate(output, self._clients[uuid], bitrate):
+                # nothing configured, back to the encoder's own default
+                prop = _encoding(self._clients[uuid])["bitrate"]
+                if prop is not None:
+                    output.encoder.set_property(prop[0], output.encoder.find_property(prop[0]).default_value)
+            output.rate.set_property("max-rate", fps if fps > 0 else GLib.MAXINT)
+            return True
+
+    def _remove_output(self, uuid):
+        output = self._outputs.pop(uuid, None)
+        if output is None:
+            return
+        output.removed = True
+        self._forget_profile(output)
+        for key in [k for k in self._edges.keys() if k[1] == uuid]:
+            self._remove_edge(key)
+        self._dispose_node(output)
+
+    def _add_edge(self, key, zorder):
+        src_id, out_id = key
+        source = self._producer(src_id)
+        output = self._consumer(out_id)
+        # all producers deliver keyed AYUV frames at the merged stream size
+        elements = [
+            _make("queue", {
+                "leaky": "downstream", "max-size-buffers": EDGE_QUEUE_SIZE,
+                "max-size-bytes": 0, "max-size-time": 0
+            })
+        ]
+        edge = _Edge(elements, source, output, zorder)
+        edge.first.connect("overrun", self._on_edge_overrun, output)
+        edge.attach(self._pipeline)
+        edge.mixer_pad = output.first.get_request_pad("sink_%u")
+        edge.mixer_pad.set_property("zorder", zorder)
+        if isinstance(output, _Output):
+            # inputs are at the merged stream size, scaled once more per output resolution
+            edge.mixer_pad.set_property("width", output.width)
+            edge.mixer_pad.set_property("height", output.height)
+        edge.last.get_static_pad("src").link(edge.mixer_pad)
+        edge.sync_state()
+        edge.tee_pad = source.last.get_request_pad("src_%u")
+        edge.tee_pad.link(edge.first.get_static_pad("sink"))
+        output.edge_count += 1
+        source.out_count += 1
+        self._edges[key] = edge
+
+    def _remove_edge(self, key):
+        """
+        Unlinks an edge from its (still running) source once the tee pad is idle.
+        Disposal is deferred to the main loop, since the probe runs on a streaming thread.
+        """
+        edge = self._edges.pop(key)
+        self._forget_profile(edge)
+
+        def _on_idle(pad, info):
+            pad.unlink(edge.first.get_static_pad("sink"))
+            GLib.idle_add(self._dispose_edge, edge)
+            return Gst.PadProbeReturn.REMOVE
+
+        edge.tee_pad.add_probe(Gst.PadProbeType.IDLE, _on_idle)
+
+    def _dispose_edge(self, edge):
+        with self._lock:
+            if self._pipeline is None:
+                return False
+            edge.detach(self._pipeline)
+            edge.source.last.release_request_pad(edge.tee_pad)
+            edge.output.first.release_request_pad(edge.mixer_pad)
+            edge.output.edge_count -= 1
+            edge.source.out_count -= 1
+            self._dispose_node(edge.output)
+            if not isinstance(edge.source, _Source):
+                self._dispose_node(edge.source)
+        return False
+
+    @staticmethod
+    def _on_edge_overrun(queue, output):
+        # a full leaky queue drops its oldest buffer
+        output.stats.dropped += 1
+
+    def set_profiling(self, enabled):
+        """
+        Switches profiling of the running pipeline on or off.
+        While enabled, the cpu time of every streaming thread is tracked, the fill levels of the
+        queues are sampled every QUEUE_SAMPLE_INTERVAL ms and the pipeline graph is dumped
+        after every reconfiguration.
+        :param enabled: profiling state
+        :return:
+        """
+        with self._lock:
+            self.profiling = enabled
+            self._segments = {}
+            if enabled:
+                self._instrument()
+                self.dump_graph()
+                if self._sampler is None:
+                    self._sampler = GLib.timeout_add(QUEUE_SAMPLE_INTERVAL, self._sample_queues)
+
+    def get_profile(self):
+        """
+        Returns the cpu time per streaming thread (costliest first) with the elements it runs,
+        and the fill levels per queue.
+        :return: dict of profiling data
+        """
+        with self._lock:
+            if not self.profiling or self._pipeline is None:
+                return {"enabled": self.profiling}
+            self._instrument()
+            threads = sorted(
+                [(name, p.as_dict(_segment_elements(p.element))) for name, p in self._segments.items()],
+                key=lambda item: item[1]["cpu_ms"], reverse=True
+            )
+            queues = {
+                name: {
+                    "level": p.element.get_property("current-level-buffers"),
+                    "mean_level": p.levels / p.samples if p.samples > 0 else 0.0,
+                    "max_level": p.max_level,
+                    "limit": p.element.get_property("max-size-buffers")
+                } for name, p in self._segments.items() if p.factory == "queue"
+            }
+            return {"enabled": True, "threads": dict(threads), "queues": queues, "graph": self._graph_file}
+
+    def dump_graph(self):
+        """
+        Writes the pipeline graph to GST_DEBUG_DUMP_DOT_DIR (has to be set before Gst.init).
+        :return: path of the written dot file, None if dumping is disabled
+        """
+        directory = os.environ.get("GST_DEBUG_DUMP_DOT_DIR", None)
+        if directory is None or self._pipeline is None:
+            return None
+        name = "%s-%d" % (self.name, self._rebuilds)
+        Gst.debug_bin_to_dot_file(self._pipeline, Gst.DebugGraphDetails.ALL, name)
+        self._graph_file = os.path.join(directory, name + ".dot")
+        return self._graph_file
+
+    def _instrument(self):
+        """ registers the streaming threads started since the last call. """
+        for element in self._pipeline.iterate_elements():
+            name = element.get_name()
+            if name in self._segments or not _starts_thread(element):
+                continue
+            profile = self._segments[name] = _SegmentProfile(element.get_factory().get_name(), element)
+            pad = element.get_static_pad("src")
+            if pad is not None:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self._identify_thread, profile)
+
+    @staticmethod
+    def _identify_thread(pad, info, profile):
+        profile.identify(threading.get_native_id())
+        return Gst.PadProbeReturn.REMOVE
+
+    def _forget_profile(self, chain):
+        """ drops the profiling state of the elements of a removed branch. """
+        for element in chain.elements:
+            self._segments.pop(element.get_name(), None)
+
+    def _sample_queues(self):
+        with self._lock:
+            if not self.profiling:
+                self._sampler = None
+                return False
+            for profile in self._segments.values():
+                if profile.factory == "queue":
+                    level = profile.element.get_property("current-level-buffers")
+                    profile.levels += level
+                    profile.samples += 1
+                    profile.max_level = max(profile.max_level, level)
+            return True
+
+    def _on_message(self, bus, message):
+        t = message.type
+        if t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            print("#### MIXER ERROR: %s" % err, debug)
+        elif t == Gst.MessageType.WARNING:
+            err, debug = message.parse_warning()
+            print("#### MIXER WARNING: %s" % err, debug)
+        return True
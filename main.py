@@ -1,38 +1,4 @@
-import connexion
-
-from flask import render_template
-from handlers import images
-from tuio_forwarding import TuioForwardingServer
-from database import base
-
-# Create the ReST API application instance
-app = connexion.App(__name__, specification_dir='./')
-# Read the swagger.yml file to configure the endpoints
-app.add_api('swagger.yml')
-# Create the TUIO forwarder instance
-tuio_forwarding = TuioForwardingServer(ip='0.0.0.0', port=5001)
-
-
-# Create a URL route in our application for "/"
-@app.route('/')
-def home():
-    """
-    This function just responds to the browser URL
-    localhost:5000/
-    :return:        the rendered template 'home.html'
-    """
-    return render_template('home.html')
-
-
-def server_cleanup():
-    images.remove_all()
-    tuio_forwarding.terminate()
-
-
-def server_main():
-    base.recreate_database()
-    tuio_forwarding.start()
-    app.run(host='0.0.0.0', port=5000)
+import sys
 
 
 def plotting_main():
@@ -46,6 +12,9 @@ def plotting_main():
 
 # If we're running in stand alone mode, run the application
 if __name__ == '__main__':
-    server_main()
-    server_cleanup()
-    #plotting_main()
\ No newline at end of file
+    # the server is only imported here, spawned worker processes re-import this module
+    import server
+    warm = server.WARM_RESTART and "--cold" not in sys.argv
+    warm = server.server_main(warm)
+    server.server_cleanup(warm)
+    #plotting_main()
@@ -0,0 +1,133 @@
+"""
+NumPy backed analysis of StatsMonitor measurement files.
+Measurement files are csv files with a 'name, bytes per second' header and
+one row per stream and second. Files are parsed in chunks, so hours long
+captures never have to be held as python lists.
+"""
+
+import itertools
+import json
+import numpy as np
+
+
+CHUNK_ROWS = 100000
+
+
+def load_measurements(file_name, chunk_rows=CHUNK_ROWS):
+    """
+    Loads a measurement file chunk by chunk.
+    :param file_name: csv file with 'name, bytes per second' header
+    :param chunk_rows: number of rows parsed at once
+    :return: dict of stream name to float64 array of bytes per second
+    """
+    chunks = {}
+    with open(file_name, "r") as csvfile:
+        header = [h.strip() for h in csvfile.readline().split(",")]
+        if len(header) < 2 or header[0] != "name" or header[1] != "bytes per second":
+            raise ValueError("incorrect csv format. 'name, bytes per second' expected.")
+        while True:
+            lines = list(itertools.islice(csvfile, chunk_rows))
+            if len(lines) == 0:
+                break
+            rows = np.array([line.rstrip("\n").split(",", 2)[:2] for line in lines if "," in line])
+            if len(rows) == 0:
+                continue
+            names, inverse = np.unique(rows[:, 0], return_inverse=True)
+            values = rows[:, 1].astype(np.float64)
+            for i, name in enumerate(names):
+                chunks.setdefault(str(name), []).append(values[inverse == i])
+    return {name: np.concatenate(parts) for name, parts in chunks.items()}
+
+
+def outlier_mask(values, num_sd=2.0):
+    """
+    Vectorized outlier detection.
+    :param values: array of samples
+    :param num_sd: samples further than num_sd standard deviations from the mean are outliers
+    :return: boolean array, True for samples to keep
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return np.ones(0, dtype=bool)
+    mean = values.mean()
+    sd = values.std()
+    return (values > mean - num_sd * sd) & (values < mean + num_sd * sd)
+
+
+def rolling_mean(values, window):
+    """
+    Moving average over window samples (valid part only).
+    :param values: array of samples
+    :param window: window size in samples
+    :return: array of len(values) - window + 1 averages
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if window <= 1 or values.size < window:
+        return values.copy()
+    csum = np.cumsum(np.insert(values, 0, 0.0))
+    return (csum[window:] - csum[:-window]) / window
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+    """
+    Summary statistics of a sample array.
+    :param values: array of samples
+    :param percentiles: percentiles to compute
+    :return: dict of statistics
+    """
+    values = np.asarray(values, dtype=np.float64)
+    res = {"count": int(values.size)}
+    if values.size == 0:
+        return res
+    res["mean"] = float(values.mean())
+    res["min"] = float(values.min())
+    res["max"] = float(values.max())
+    for p, v in zip(percentiles, np.percentile(values, percentiles)):
+        res["p" + str(p)] = float(v)
+    return res
+
+
+def analyze_monitor_stats(file_names, scale_factors=None, window=10, num_sd=2.0):
+    """
+    Converts measurement files to mbit/s, removes outliers and computes
+    rolling averages and summary statistics per file and stream name.
+    :param file_names: list of measurement files
+    :param scale_factors: optional factor per file applied to all of its values
+    :param window: rolling average window in samples (seconds)
+    :param num_sd: outlier threshold in standard deviations
+    :return: dict of file name to stream name to {"mbps", "rolling", "outliers", "summary"}
+    """
+    scale_factors = scale_factors if scale_factors is not None else []
+    res = {}
+    for f_i, f_name in enumerate(file_names):
+        scale_factor = scale_factors[f_i] if len(scale_factors) == len(file_names) else 1
+        res[f_name] = {}
+        for name, values in load_measurements(f_name).items():
+            mbps = values * (scale_factor * 8 / 1000000)
+            mask = outlier_mask(mbps, num_sd)
+            kept = mbps[mask]
+            res[f_name][name] = {
+                "mbps": kept,
+                "rolling": rolling_mean(kept, window),
+                "outliers": int(mbps.size - kept.size),
+                "summary": summarize(kept)
+            }
+    return res
+
+
+def write_report(analysis, report_file):
+    """
+    Writes the summary statistics of an analysis as json.
+    :param analysis: result of analyze_monitor_stats
+    :param report_file: output file name
+    :return:
+    """
+    report = {
+        f_name: {
+            name: dict(stream["summary"], outliers=stream["outliers"])
+            for name, stream in streams.items()
+        }
+        for f_name, streams in analysis.items()
+    }
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
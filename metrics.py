@@ -0,0 +1,123 @@
+"""
+Live stream metrics of the SurfaceStreams server.
+Turns the cumulative counters of the mixer workers and the TUIO forwarder
+into per-client rates and renders them as dict or Prometheus text format.
+"""
+
+import collections
+import threading
+import time
+import video_mixing
+from client_registry import registry
+
+
+# rates are computed against a snapshot at least this old, so frequent scrapes stay meaningful
+MIN_RATE_INTERVAL = 1.0
+
+
+class MetricsCollector(object):
+    def __init__(self):
+        self.tuio_stats = None
+        self._history = collections.deque()
+        self._lock = threading.Lock()
+
+    def set_tuio_stats(self, stats):
+        """
+        :param stats: ForwardingStats of the running TUIO forwarder
+        """
+        self.tuio_stats = stats
+
+    def _snapshot(self):
+        snapshot = {"time": time.monotonic(), "clients": video_mixing.get_pipeline_stats()}
+        if self.tuio_stats is not None:
+            snapshot["tuio_messages"] = self.tuio_stats.total_messages
+            snapshot["tuio_datagrams_sent"] = self.tuio_stats.total_datagrams_sent
+        return snapshot
+
+    def collect(self):
+        """
+        Returns per-client stream rates and TUIO forwarding rates.
+        :return: dict with 'clients' (uuid to metrics) and 'tuio'
+        """
+        with self._lock:
+            current = self._snapshot()
+            self._history.append(current)
+            # keep the youngest snapshot which is at least MIN_RATE_INTERVAL old as reference
+            while len(self._history) > 2 and current["time"] - self._history[1]["time"] >= MIN_RATE_INTERVAL:
+                self._history.popleft()
+            previous = self._history[0]
+        elapsed = max(current["time"] - previous["time"], 1e-9)
+
+        def rate(counters, prev_counters, key):
+            return (counters[key] - prev_counters.get(key, 0)) / elapsed if prev_counters else 0.0
+
+        clients = {}
+        for c in registry.get_all():
+            stats = current["clients"].get(c["uuid"], None)
+            if stats is None:
+                continue
+            prev = previous["clients"].get(c["uuid"], {})
+            clients[c["uuid"]] = {
+                "name": c["name"],
+                "mixing_group": c.get("mixing_group"),
+                "in_bytes_per_second": rate(stats["in"], prev.get("in"), "bytes"),
+                "in_frames_per_second": rate(stats["in"], prev.get("in"), "frames"),
+                "out_bytes_per_second": rate(stats["out"], prev.get("out"), "bytes"),
+                "out_frames_per_second": rate(stats["out"], prev.get("out"), "frames"),
+                "dropped_buffers": stats["out"]["dropped_buffers"],
+                "suppressed_frames": stats["out"]["suppressed_buffers"],
+                "pipeline_latency_ms": stats["out"]["pipeline_latency_ms"],
+                "seconds_since_last_input": stats["in"]["seconds_since_last_buffer"]
+            }
+
+        tuio = {}
+        if self.tuio_stats is not None:
+            tuio = {
+                "messages_per_second":
+                    (current["tuio_messages"] - previous.get("tuio_messages", current["tuio_messages"])) / elapsed,
+                "datagrams_sent_per_second":
+                    (current["tuio_datagrams_sent"] - previous.get("tuio_datagrams_sent", current["tuio_datagrams_sent"]))
+                    / elapsed,
+                "p99_forward_latency_ms": self.tuio_stats.p99_latency() * 1000.0
+            }
+        return {"clients": clients, "tuio": tuio}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def to_prometheus(metrics):
+    """
+    Renders collected metrics in the Prometheus text exposition format.
+    :param metrics: result of MetricsCollector.collect
+    :return: str
+    """
+    lines = []
+    client_metrics = [
+        ("in_bytes_per_second", "gauge", "Received video bytes per second"),
+        ("in_frames_per_second", "gauge", "Decoded input video frames per second"),
+        ("out_bytes_per_second", "gauge", "Sent merged video bytes per second"),
+        ("out_frames_per_second", "gauge", "Encoded merged video frames per second"),
+        ("dropped_buffers", "counter", "Frames dropped by leaky mixer queues"),
+        ("suppressed_frames", "counter", "Unchanged merged frames not encoded (see keepalive-fps)"),
+        ("pipeline_latency_ms", "gauge",
+         "Average frame age when leaving the mixer, excludes network transfer and client decoding"),
+    ]
+    for key, kind, help_text in client_metrics:
+        name = "surface_streams_client_" + key
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + kind)
+        for uuid, m in metrics["clients"].items():
+            lines.append('%s{uuid="%s",name="%s",mixing_group="%s"} %s' % (
+                name, _label(uuid), _label(m["name"]), _label(m["mixing_group"]), repr(float(m[key]))
+            ))
+    for key, value in metrics["tuio"].items():
+        name = "surface_streams_tuio_" + key
+        lines.append("# TYPE " + name + " gauge")
+        lines.append(name + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+# collector used by the metrics handler
+collector = MetricsCollector()
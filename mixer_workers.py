@@ -0,0 +1,328 @@
+"""
+Supervisor for process-isolated mixer workers.
+Each mixing group (set of clients that see each other) is mixed by an
+IncrementalVideoMixer running in its own worker process. The server talks
+to a worker through a control channel (multiprocessing Pipe) and restarts
+workers which stall or die, without blocking other groups.
+"""
+
+import multiprocessing
+import threading
+import time
+
+
+# worker processes are spawned, so they never inherit threads or GLib state of the server
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+REQUEST_TIMEOUT = 5.0
+
+# seconds a fresh worker may take until its mixer runs (gi import, Gst.init, registry scan)
+STARTUP_TIMEOUT = 60.0
+
+# commands which only read state, a timeout makes the worker unavailable but does not restart it
+READ_ONLY_COMMANDS = ["stats", "profiling", "clients", "ping"]
+
+
+class MixerWorkerError(Exception):
+    pass
+
+
+class MixerWorkerUnavailable(MixerWorkerError):
+    """ a worker did not answer a read-only request in time, it keeps running. """
+
+
+def _worker_main(conn, events, group, width, height, topology, backend="elements", fps=30):
+    """
+    Entry point of a mixer worker process.
+    Runs the GLib MainLoop of the mixer and applies control commands on it.
+    :param conn: worker end of the control channel
+    :param events: queue receiving (group, event, data) tuples of the mixer
+    :param group: mixing group of the worker
+    :param width: merged stream width
+    :param height: merged stream height
+    :param topology: mixing topology, see IncrementalVideoMixer
+    :param backend: 'elements' (IncrementalVideoMixer) or 'numpy' (NumpyVideoMixer)
+    :param fps: merged stream frame rate
+    :return:
+    """
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst, GLib
+    if backend == "numpy":
+        from numpy_mixer import NumpyVideoMixer as Mixer
+    else:
+        from incremental_mixer import IncrementalVideoMixer as Mixer
+
+    Gst.init(None)
+    loop = GLib.MainLoop()
+    mixer = Mixer(
+        width=width, height=height, topology=topology,
+        on_event=lambda event, data: events.put((group, event, data)), name="mixer-" + group, fps=fps
+    )
+    commands = {
+        "sync": mixer.sync,
+        "add": mixer.add_client,
+        "remove": mixer.remove_client,
+        "resize": mixer.resize,
+        "tune": mixer.tune_output,
+        "profile": mixer.set_profiling,
+        "profiling": mixer.get_profile,
+        "keepalive": mixer.set_keepalive,
+        "clients": mixer.get_client_uuids,
+        "stats": mixer.get_stats,
+        "ping": lambda: True
+    }
+
+    def _apply(cmd, args, done):
+        try:
+            done["result"] = ("ok", commands[cmd](*args))
+        except Exception as e:
+            done["result"] = ("error", repr(e))
+        done["event"].set()
+        return False
+
+    def _serve():
+        while True:
+            try:
+                seq, cmd, args = conn.recv()
+            except EOFError:
+                seq, cmd, args = None, "stop", ()
+            if cmd == "stop":
+                GLib.idle_add(loop.quit)
+                break
+            if cmd not in commands:
+                conn.send((seq, "error", "unknown command " + cmd))
+                continue
+            # pipeline changes are applied on the main loop thread
+            done = {"event": threading.Event()}
+            GLib.idle_add(_apply, cmd, args, done)
+            done["event"].wait()
+            conn.send((seq,) + done["result"])
+
+    mixer.start()
+    # startup handshake, see MixerWorker.start
+    conn.send((0, "ok", "ready"))
+    threading.Thread(target=_serve, daemon=True).start()
+    try:
+        loop.run()
+    finally:
+        mixer.cleanup()
+        conn.close()
+
+
+class MixerWorker(object):
+    """
+    Handle of one mixer worker process, owned by the server process.
+    """
+    def __init__(self, group, width, height, topology="auto", events=None, backend="elements", fps=30):
+        self.group = group
+        self.backend = backend
+        self.events = events if events is not None else _MP_CONTEXT.Queue()
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.topology = topology
+        self.clients = []
+        self.profiling = False
+        self.keepalive_fps = None
+        self._seq = 0
+        self._conn = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Spawns the worker process and waits up to STARTUP_TIMEOUT for its mixer to run.
+        :return:
+        """
+        parent_conn, child_conn = _MP_CONTEXT.Pipe()
+        self._process = _MP_CONTEXT.Process(
+            target=_worker_main, args=(
+                child_conn, self.events, self.group, self.width, self.height, self.topology, self.backend, self.fps
+            ),
+            name="mixer-" + self.group, daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        started = time.monotonic()
+        if self._call_reply(0, STARTUP_TIMEOUT) is None:
+            self._kill()
+            raise MixerWorkerError("mixer worker " + self.group + " did not start")
+        print("###### started mixer worker", self.group, "pid", self._process.pid,
+              "in %.1f s" % (time.monotonic() - started))
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process is not None else None
+
+    def request(self, cmd, *args, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a command over the control channel and waits for its result.
+        Dead workers and workers stalling on a command that changes the pipeline are restarted
+        with the last known client set. Stalled read-only commands (READ_ONLY_COMMANDS)
+        raise MixerWorkerUnavailable and leave the worker running.
+        :param cmd: command name (sync, add, remove, resize, tune, profile, profiling, keepalive, clients, stats, ping)
+        :param args: command arguments
+        :param timeout: seconds to wait for the worker
+        :return: result of the command
+        """
+        with self._lock:
+            if not self.is_alive():
+                self._restart()
+            reply = self._call(cmd, args, timeout)
+            if reply is None and cmd in READ_ONLY_COMMANDS:
+                raise MixerWorkerUnavailable("mixer worker " + self.group + " did not answer '" + cmd + "'")
+            if reply is None:
+                print("###### mixer worker", self.group, "stalled, restarting")
+                self._restart()
+                raise MixerWorkerError("mixer worker " + self.group + " did not answer '" + cmd + "'")
+        status, result = reply
+        if status != "ok":
+            raise MixerWorkerError(result)
+        return result
+
+    def _call(self, cmd, args, timeout):
+        """
+        Sends one tagged command and waits for the reply with the same tag.
+        Late replies of earlier (timed out) commands are dropped.
+        :return: (status, result) or None on timeout
+        """
+        self._seq += 1
+        seq = self._seq
+        self._conn.send((seq, cmd, args))
+        return self._call_reply(seq, timeout)
+
+    def _call_reply(self, seq, timeout):
+        deadline = time.monotonic() + timeout
+        while self._conn.poll(max(0.0, deadline - time.monotonic())):
+            try:
+                reply_seq, status, result = self._conn.recv()
+            except EOFError:
+                # the worker died
+                return None
+            if reply_seq == seq:
+                return status, result
+            print("###### mixer worker", self.group, "dropped late reply", reply_seq)
+        return None
+
+    def _restart(self):
+        self._kill()
+        self.start()
+        replay = []
+        if len(self.clients) > 0:
+            replay.append(("sync", (self.clients,)))
+        if self.profiling:
+            replay.append(("profile", (True,)))
+        if self.keepalive_fps is not None:
+            replay.append(("keepalive", (self.keepalive_fps,)))
+        # start() waited for the handshake, the mixer is running
+        for cmd, args in replay:
+            if self._call(cmd, args, REQUEST_TIMEOUT) is None:
+                print("###### mixer worker", self.group, "did not replay '" + cmd + "'")
+
+    def sync(self, clients):
+        self.clients = clients
+        return self.request("sync", clients)
+
+    def add(self, client):
+        self.clients = [c for c in self.clients if c["uuid"] != client["uuid"]] + [client]
+        return self.request("add", client)
+
+    def remove(self, uuid):
+        self.clients = [c for c in self.clients if c["uuid"] != uuid]
+        return self.request("remove", uuid)
+
+    def resize(self, width, height, fps=None):
+        self.width = width
+        self.height = height
+        self.fps = fps if fps is not None else self.fps
+        return self.request("resize", width, height, self.fps)
+
+    def tune(self, uuid, bitrate=-1, fps=-1):
+        return self.request("tune", uuid, bitrate, fps)
+
+    def profile(self, enabled):
+        self.profiling = enabled
+        return self.request("profile", enabled)
+
+    def keepalive(self, fps):
+        self.keepalive_fps = fps
+        return self.request("keepalive", fps)
+
+    def stop(self):
+        with self._lock:
+            if self.is_alive():
+                try:
+                    self._conn.send((None, "stop", ()))
+                except (BrokenPipeError, EOFError):
+                    pass
+                self._process.join(REQUEST_TIMEOUT)
+            self._kill()
+
+    def _kill(self):
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+            self._process.join(REQUEST_TIMEOUT)
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+
+class MixerSupervisor(object):
+    """
+    Keeps one MixerWorker per mixing group.
+    Events of all workers are passed to on_event(group, event, data).
+    """
+    def __init__(self, on_event=None):
+        self.workers = {}
+        self.on_event = on_event
+        self.events = _MP_CONTEXT.Queue()
+        self._lock = threading.Lock()
+        self._event_thread = None
+
+    def _forward_events(self):
+        while True:
+            group, event, data = self.events.get()
+            if self.on_event is not None:
+                try:
+                    self.on_event(group, event, data)
+                except Exception as e:
+                    print("###### failed to handle mixer event", event, e)
+
+    def get(self, group):
+        return self.workers.get(group, None)
+
+    def groups(self):
+        return list(self.workers.keys())
+
+    def ensure(self, group, width, height, topology="auto", backend="elements", fps=30):
+        """
+        Returns the worker of the given group, starting it if needed.
+        """
+        with self._lock:
+            worker = self.workers.get(group, None)
+            if self._event_thread is None:
+                self._event_thread = threading.Thread(target=self._forward_events, daemon=True)
+                self._event_thread.start()
+            if worker is None:
+                worker = MixerWorker(group, width, height, topology, events=self.events, backend=backend, fps=fps)
+                worker.start()
+                self.workers[group] = worker
+            return worker
+
+    def stop(self, group):
+        with self._lock:
+            worker = self.workers.pop(group, None)
+        if worker is None:
+            return False
+        worker.stop()
+        return True
+
+    def stop_all(self):
+        for group in self.groups():
+            self.stop(group)
@@ -0,0 +1,98 @@
+"""
+Push notifications about clients and mixing pipelines.
+Events are published by the client registry, the client handlers and
+video_mixing, and fanned out to all subscribers (see handlers/events.py).
+"""
+
+import collections
+import itertools
+import json
+import queue
+import threading
+from client_registry import registry
+
+
+# recent events kept to resume streams after a reconnect (Last-Event-ID)
+HISTORY_SIZE = 256
+
+# events buffered per subscriber before the oldest are dropped
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class Notification(object):
+    def __init__(self, event_id, event, data):
+        self.id = event_id
+        self.event = event
+        self.data = data
+
+    def to_sse(self):
+        """ formats the notification as server-sent event. """
+        return "id: %d\nevent: %s\ndata: %s\n\n" % (self.id, self.event, json.dumps(self.data))
+
+
+class NotificationHub(object):
+    """
+    Thread-safe publish/subscribe hub with one bounded queue per subscriber.
+    """
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._history = collections.deque(maxlen=HISTORY_SIZE)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, last_event_id=None):
+        """
+        Adds a subscriber.
+        :param last_event_id: id of the last event the subscriber has seen, newer events are replayed
+        :return: queue receiving Notification objects
+        """
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if last_event_id is not None:
+                for n in self._history:
+                    if n.id > last_event_id:
+                        self._put(q, n)
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def publish(self, event, data):
+        """
+        Sends an event to all subscribers.
+        :param event: event name
+        :param data: json serializable event data
+        :return:
+        """
+        with self._lock:
+            n = Notification(next(self._ids), event, data)
+            self._history.append(n)
+            for q in self._subscribers:
+                self._put(q, n)
+
+    @staticmethod
+    def _put(q, n):
+        # slow subscribers lose their oldest events instead of blocking publishers
+        while True:
+            try:
+                q.put_nowait(n)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+# hub shared by all publishers of this server process
+hub = NotificationHub()
+
+
+def _on_client_event(event, client, previous):
+    hub.publish("client-" + event, client)
+
+
+registry.subscribe(_on_client_event)
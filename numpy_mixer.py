@@ -0,0 +1,267 @@
+"""
+NumPy mixing backend for SurfaceStreams.
+Decoded input frames are pulled from appsinks into shared arrays, keyed and
+blended in one vectorized pass per layer and pushed into one appsrc per
+output, replacing the alpha -> queue -> compositor element chains of
+IncrementalVideoMixer. Selected per mixing group (see video_mixing.MIXING_BACKENDS).
+"""
+
+import threading
+import time
+import numpy as np
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+from incremental_mixer import IncrementalVideoMixer, _Source, _Output, _SegmentProfile, \
+    _make, _raw_caps, _protocol, _encoding, _add_stats_probe, _add_frame_probe, _frame_changed, _keepalive_due, \
+    _track_keyframes, _force_keyframe_if_due
+
+
+# pixels whose brightest channel is at or below this value are keyed out (black key)
+KEY_THRESHOLD = 16
+
+
+def key_mask(frame):
+    """ pixels of an RGB frame which survive the black key. """
+    return frame.max(axis=2) > KEY_THRESHOLD
+
+
+def blend(dst, frame, mask):
+    """ keys frame and blends it over dst in place. """
+    np.copyto(dst, frame, where=mask[..., None])
+
+
+def composite_layers(frames, background):
+    """
+    Composes keyed frames in layer order.
+    :param frames: list of RGB frames (None for layers without frame), lowest layer first
+    :param background: RGB frame below all layers
+    :return: (prefixes, suffixes) with prefixes[i] the composite of frames[:i] over the background
+    and suffixes[i] = (image, mask) the composite of frames[i:] with its coverage mask
+    """
+    masks = [key_mask(f) if f is not None else None for f in frames]
+    prefixes = [background]
+    for f, m in zip(frames, masks):
+        acc = prefixes[-1].copy()
+        if f is not None:
+            blend(acc, f, m)
+        prefixes.append(acc)
+    suffixes = [(background, np.zeros(background.shape[:2], dtype=bool))]
+    for f, m in zip(reversed(frames), reversed(masks)):
+        img, mask = suffixes[0]
+        if f is not None:
+            img = img.copy()
+            # the layer only shows where no higher layer covers it
+            blend(img, f, m & ~mask)
+            mask = mask | m
+        suffixes.insert(0, (img, mask))
+    return prefixes, suffixes
+
+
+class _ArrayOutput(_Output):
+    """ appsrc -> scale -> rate limit -> convert -> size/rate caps -> encode -> pay -> udpsink. """
+    @property
+    def appsrc(self):
+        return self.first
+
+    @property
+    def rate(self):
+        return self.elements[2]
+
+    @property
+    def encoder(self):
+        return self.elements[5]
+
+
+class NumpyVideoMixer(IncrementalVideoMixer):
+    """
+    IncrementalVideoMixer whose keying and compositing run on NumPy arrays.
+    Every frame interval all inputs are composed once in join order (prefix composites)
+    and once in reverse order (suffix composites), each output then needs a single
+    blend of (prefix before client, suffix after client) as with the tiled topology.
+    Intervals in which no output is due (no changed input, no keep-alive frame) are not composed at all.
+    """
+    def __init__(self, width=640, height=360, topology="auto", on_event=None, name="surface-streams-mixer", fps=30):
+        super().__init__(width, height, topology, on_event, name, fps)
+        self._frames = {}
+        self._stop = None
+        self._thread = None
+        self._compose_profile = None
+
+    def start(self):
+        with self._lock:
+            self._pipeline = Gst.Pipeline.new(self.name)
+            bus = self._pipeline.get_bus()
+            bus.add_signal_watch()
+            bus.connect("message", self._on_message)
+            self._pipeline.set_state(Gst.State.PLAYING)
+            self._background = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._mix_loop, args=(self._stop,), name=self.name + "-numpy", daemon=True
+            )
+            self._thread.start()
+            self._profile_mix_thread()
+
+    def cleanup(self):
+        with self._lock:
+            if self._stop is not None:
+                # the mixing thread never waits for the lock longer than a frame interval
+                self._stop.set()
+                self._thread.join()
+            self._stop = None
+            self._thread = None
+            super().cleanup()
+            self._frames = {}
+
+    def set_profiling(self, enabled):
+        super().set_profiling(enabled)
+        with self._lock:
+            self._profile_mix_thread()
+
+    def get_profile(self):
+        with self._lock:
+            res = super().get_profile()
+            if res.get("enabled", False) and self._compose_profile is not None:
+                res["threads"]["numpy-compositor"] = self._compose_profile.as_dict(["numpy-compositor"])
+            return res
+
+    def _profile_mix_thread(self):
+        # the mixing thread is a python thread, its cpu time is the cost of keying and compositing
+        self._compose_profile = None
+        if self.profiling and self._thread is not None:
+            self._compose_profile = _SegmentProfile("numpy")
+            self._compose_profile.identify(self._thread.native_id)
+
+    def _sync_edges(self):
+        # compositing happens in _mix, there are no edges
+        return 0
+
+    def _add_source(self, client):
+        protocol = _protocol(client["video_protocol"])
+        depay, depay_props = protocol["depay"]
+        decode, decode_props = protocol["decode"]
+        uuid = client["uuid"]
+        appsink = _make("appsink", {"emit-signals": True, "sync": False, "max-buffers": 1, "drop": True})
+        source = _Source([
+            _make("udpsrc", {"port": client["video_src_port"], "caps": protocol["caps"]}),
+            _make(depay, depay_props),
+            _make(decode, decode_props),
+            _make("videoconvert"),
+            _make("videoscale"),
+            _make("capsfilter", {"caps": _raw_caps(self.width, self.height) + ", format=RGB"}),
+            appsink
+        ], zorder=self._next_zorder)
+        self._next_zorder += 1
+        appsink.connect("new-sample", self._on_sample, uuid, source)
+        _add_frame_probe(source.elements[2], "src", source.stats)
+        _add_stats_probe(source.first, "src", source.stats,
+                         on_first_buffer=self._event_callback("stream-live", uuid, "in"))
+        source.attach(self._pipeline)
+        source.sync_state()
+        self._sources[uuid] = source
+
+    def _remove_source(self, uuid):
+        super()._remove_source(uuid)
+        self._frames.pop(uuid, None)
+
+    def _add_output(self, client):
+        encoding = _encoding(client)
+        encode, encode_props = encoding["encode"]
+        pay, pay_props = encoding["pay"]
+        width = client.get("output_width", -1)
+        height = client.get("output_height", -1)
+        if width <= 0 or height <= 0:
+            width, height = self.width, self.height
+        fps = client.get("output_fps", -1)
+        output = _ArrayOutput([
+            _make("appsrc", {
+                "caps": _raw_caps(self.width, self.height, self.fps) + ", format=RGB",
+                "is-live": True, "do-timestamp": True, "format": "time",
+                "max-bytes": 2 * self.width * self.height * 3, "block": False
+            }),
+            _make("videoscale"),
+            _make("videorate", {"drop-only": True}),
+            _make("videoconvert"),
+            _make("capsfilter", {"caps": _raw_caps(width, height, fps if fps > 0 else None)}),
+            _make(encode, encode_props),
+            _make(pay, pay_props),
+            _make("udpsink", {
+                "host": client["ip"], "port": client["video_sink_port"],
+                "sync": False, "async": False
+            })
+        ], width, height)
+        self._set_bitrate(output, client)
+        _add_stats_probe(output.udpsink, "sink", output.stats, measure_latency=True,
+                         on_first_buffer=self._event_callback("stream-live", client["uuid"], "out"))
+        _add_frame_probe(output.elements[6], "sink", output.stats)
+        _track_keyframes(output)
+        output.attach(self._pipeline)
+        output.sync_state()
+        self._outputs[client["uuid"]] = output
+
+    def _on_sample(self, appsink, uuid, source):
+        buf = appsink.emit("pull-sample").get_buffer()
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if ok:
+            frame = np.frombuffer(info.data, dtype=np.uint8)
+            if frame.size == self.width * self.height * 3:
+                # unchanged frames are not copied, the last changed frame stays in place
+                if self.keepalive_fps <= 0 or _frame_changed(source, info.data) or uuid not in self._frames:
+                    self._frames[uuid] = frame.reshape((self.height, self.width, 3)).copy()
+                else:
+                    source.stats.suppressed += 1
+            buf.unmap(info)
+        return Gst.FlowReturn.OK
+
+    def _mix_loop(self, stop):
+        # resize restarts the mixing thread, the frame rate is fixed for its lifetime
+        interval = 1.0 / self.fps
+        next_tick = time.monotonic()
+        while not stop.is_set():
+            if self._lock.acquire(timeout=interval):
+                try:
+                    if not stop.is_set() and self._pipeline is not None:
+                        self._mix()
+                finally:
+                    self._lock.release()
+            next_tick += interval
+            now = time.monotonic()
+            if next_tick < now:
+                # mixing fell behind, skip the missed ticks instead of bursting
+                next_tick = now
+            time.sleep(next_tick - now)
+
+    def _output_due(self, uuid, now):
+        output = self._outputs[uuid]
+        if _keepalive_due(output, self.keepalive_fps, now):
+            return True
+        return self._last_change(uuid) > output.last_forwarded
+
+    def _mix(self):
+        clients = sorted(
+            [c for uuid, c in self._clients.items() if uuid in self._sources and uuid in self._outputs],
+            key=lambda c: self._sources[c["uuid"]].zorder
+        )
+        now = time.monotonic()
+        due = [self._output_due(c["uuid"], now) for c in clients]
+        if not any(due):
+            # no input changed and no keep-alive frame is due, nothing to compose
+            return
+        prefixes, suffixes = composite_layers([self._frames.get(c["uuid"]) for c in clients], self._background)
+        for i, c in enumerate(clients):
+            output = self._outputs[c["uuid"]]
+            if not due[i]:
+                output.stats.suppressed += 1
+                continue
+            if output.stats.suppressed > 0:
+                _force_keyframe_if_due(output, now)
+            output.last_forwarded = now
+            # a single client sees its own stream, as with the elements backend
+            if c["mixing_mode"] == "all" or len(clients) == 1:
+                merged = prefixes[-1]
+            else:
+                merged = prefixes[i].copy()
+                img, mask = suffixes[i + 1]
+                blend(merged, img, mask)
+            output.appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(merged.tobytes()))
@@ -1,43 +1,30 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import csv
+import measurement_analysis
 
 
 def remove_outliers(arr):
-    elements = np.array(arr)
+    elements = np.asarray(arr, dtype=np.float64)
+    mask = measurement_analysis.outlier_mask(elements)
+    print("  > removed the following outliers", elements[~mask].tolist())
+    return elements[mask]
 
-    mean = np.mean(elements, axis=0)
-    sd = np.std(elements, axis=0)
 
-    final_list = [x for x in arr if (x > mean - 2 * sd)]
-    final_list = [x for x in final_list if (x < mean + 2 * sd)]
-    outliers = [x for x in arr if x not in final_list]
-    print("  > removed the following outliers", outliers)
-    return final_list
-
-
-def plot_monitor_stats(file_names, scale_factors=[]):
+def plot_monitor_stats(file_names, scale_factors=[], output_file=None, report_file=None, window=10):
     """
     Plots StatsMonitor data stored in csv files denoted in file_names list.
     :param file_names: list of files to incorporate.
-    :return:
+    :param scale_factors: optional factor per file applied to all of its values.
+    :param output_file: write the plot to this image file instead of showing it (headless mode).
+    :param report_file: write summary statistics per stream to this json file.
+    :param window: rolling average window in seconds, plotted as a line over the samples.
+    :return: the analysis (see measurement_analysis.analyze_monitor_stats)
     """
-    # extract data
-    data = {}
-    for f_name in file_names:
-        data[f_name] = {}
-        with open(f_name, "r") as csvfile:
-            data_reader = csv.reader(csvfile, delimiter=",")
-            i = 0
-            for row in data_reader:
-                if i == 0:
-                    if row[0] != "name" or row[1] != "bytes per second":
-                        raise ValueError("incorrect csv format. 'name, bytes per second' expected.")
-                else:
-                    if row[0] not in data[f_name]:
-                        data[f_name][row[0]] = []
-                    data[f_name][row[0]].append(float(row[1]))
-                i += 1
+    if output_file is not None:
+        plt.switch_backend("Agg")
+    analysis = measurement_analysis.analyze_monitor_stats(file_names, scale_factors, window=window)
+    if report_file is not None:
+        measurement_analysis.write_report(analysis, report_file)
     # setup plot style
     plot_clr = ["r","g","b"]
     plot_style = ["o", "^", "--", "s"]
@@ -47,21 +34,25 @@ def plot_monitor_stats(file_names, scale_factors=[]):
             value_style.append(c+s)
     # plot data
     i = 0
-    f_i = 0
     for f_name in file_names:
-        for name in data[f_name].keys():
-            scale_factor = 1 if len(scale_factors) != len(data) else scale_factors[f_i]
+        for name, stream in analysis[f_name].items():
             print("### " + f_name + "." + name)
-            mbps = [scale_factor * (b*8 / 1000000) for b in data[f_name][name]]
-            mbps = remove_outliers(mbps)
-            t = [i for i in range(1, len(mbps)+1)]
-            plt.plot(t, mbps, value_style[i])
-            plt.axis([0, max(t)+1, 0, 20])
+            print("  > removed " + str(stream["outliers"]) + " outliers")
+            mbps = stream["mbps"]
+            t = np.arange(1, len(mbps)+1)
+            plt.plot(t, mbps, value_style[i % len(value_style)])
+            if len(stream["rolling"]) < len(mbps):
+                plt.plot(t[window-1:], stream["rolling"], value_style[i % len(value_style)][0] + "-")
+            plt.axis([0, len(mbps)+1, 0, 20])
             i += 1
-            avg = np.mean(np.array(mbps))
-            print("  > avg mbps " + str(avg))
-        f_i += 1
+            print("  > avg mbps " + str(stream["summary"].get("mean", 0.0)))
+            print("  > p99 mbps " + str(stream["summary"].get("p99", 0.0)))
     # configure axis labels and show plot
     plt.xlabel("time in seconds")
     plt.ylabel("data rate in mbits/s")
-    plt.show()
\ No newline at end of file
+    if output_file is not None:
+        plt.savefig(output_file)
+        plt.close()
+    else:
+        plt.show()
+    return analysis
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+Port allocation for client video and TUIO streams.
+Tracks which ports are owned by which client, reclaims them when a client
+is deleted. video_src_port is bound by the server, so only bindable ports are handed out for it.
+video_sink_port and tuio_sink_port are ports on the client host the server only sends to.
+"""
+
+import heapq
+import socket
+import threading
+from client_registry import registry, DELETED
+
+
+# inclusive port range per mixing group, groups without an entry use 'default'
+PORT_RANGES = {
+    "default": (5002, 5999)
+}
+
+# client attributes holding ports allocated from the pool
+PORT_KEYS = ["video_src_port", "video_sink_port", "tuio_sink_port"]
+
+
+class PortAllocationError(Exception):
+    pass
+
+
+def is_bindable(port, ip="0.0.0.0"):
+    """
+    Checks if a udp port can currently be bound on this host.
+    :param port: port to check
+    :param ip: interface to bind
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((ip, port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class _Range(object):
+    """ port range with a high-water mark and a heap of released ports. """
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.next_unused = first
+        self.released = []
+
+    def candidates(self):
+        while len(self.released) > 0:
+            yield heapq.heappop(self.released)
+        while self.next_unused <= self.last:
+            self.next_unused += 1
+            yield self.next_unused - 1
+
+    def give_back(self, port):
+        if self.first <= port <= self.last:
+            heapq.heappush(self.released, port)
+
+
+class PortPool(object):
+    """
+    Thread-safe port pool, indexed by port and by owner (client uuid).
+    """
+    def __init__(self, ranges=None, check_bindable=True):
+        self._range_config = ranges if ranges is not None else PORT_RANGES
+        self._ranges = {}
+        self._owners = {}
+        self._ports = {}
+        self._check_bindable = check_bindable
+        self._lock = threading.Lock()
+
+    def _range(self, group):
+        if group not in self._range_config:
+            group = "default"
+        if group not in self._ranges:
+            self._ranges[group] = _Range(*self._range_config[group])
+        return self._ranges[group]
+
+    def owner_of(self, port):
+        return self._owners.get(port, None)
+
+    def ports_of(self, owner):
+        with self._lock:
+            return sorted(self._ports.get(owner, []))
+
+    def allocate(self, owner, group="default", count=1, bound=0):
+        """
+        Allocates the lowest free ports of the group range.
+        :param owner: uuid of the client owning the ports
+        :param group: mixing group selecting the port range
+        :param count: number of ports to allocate
+        :param bound: the first bound ports are bound by this server and have to be bindable
+        :return: list of allocated ports
+        """
+        with self._lock:
+            r = self._range(group)
+            bound_ports = []
+            other_ports = []
+            skipped = []
+            for port in r.candidates():
+                if port in self._owners:
+                    continue
+                if len(bound_ports) < bound and (not self._check_bindable or is_bindable(port)):
+                    bound_ports.append(port)
+                elif len(other_ports) < count - bound:
+                    # the server never binds these, a port busy on this host is fine
+                    other_ports.append(port)
+                else:
+                    # in use by another process, retry once released
+                    skipped.append(port)
+                if len(bound_ports) + len(other_ports) == count:
+                    break
+            ports = bound_ports + other_ports
+            for port in skipped:
+                r.give_back(port)
+            if len(ports) < count:
+                for port in ports:
+                    r.give_back(port)
+                raise PortAllocationError("no free ports left for mixing group " + group)
+            for port in ports:
+                self._take(owner, port)
+            return ports
+
+    def assign(self, owner, group, ports):
+        """
+        Reserves the requested ports of a client and allocates the unset ones from the group range.
+        :param owner: uuid of the client owning the ports
+        :param group: mixing group selecting the port range
+        :param ports: [video_src_port, video_sink_port, tuio_sink_port], values <= 0 are allocated
+        :return: list of the assigned ports in the same order
+        """
+        self.reserve(owner, [p for p in ports if p > 0])
+        allocated = self.allocate(owner, group, len([p for p in ports if p <= 0]), bound=1 if ports[0] <= 0 else 0)
+        return [p if p > 0 else allocated.pop(0) for p in ports]
+
+    def reserve(self, owner, ports):
+        """
+        Assigns explicitly requested ports to an owner.
+        :param owner: uuid of the client owning the ports
+        :param ports: list of ports
+        :return:
+        """
+        with self._lock:
+            for port in ports:
+                other = self._owners.get(port, None)
+                if other is not None and other != owner:
+                    raise PortAllocationError("port " + str(port) + " is already in use")
+            for port in ports:
+                self._take(owner, port)
+
+    def release(self, owner, ports=None):
+        """
+        Returns ports of an owner to the pool.
+        :param owner: uuid of the client owning the ports
+        :param ports: ports to release, None releases all ports of the owner
+        :return:
+        """
+        with self._lock:
+            owned = self._ports.get(owner, set())
+            for port in list(owned if ports is None else ports):
+                if self._owners.get(port, None) != owner:
+                    continue
+                del self._owners[port]
+                owned.discard(port)
+                for r in self._ranges.values():
+                    r.give_back(port)
+            if len(owned) == 0:
+                self._ports.pop(owner, None)
+
+    def sync_client(self, client):
+        """
+        Makes the pool ownership match the ports of a client dict.
+        :param client: client dict
+        :return:
+        """
+        ports = set([client[k] for k in PORT_KEYS if client.get(k) is not None and client[k] > 0])
+        self.release(client["uuid"], [p for p in self.ports_of(client["uuid"]) if p not in ports])
+        self.reserve(client["uuid"], ports)
+
+    def _take(self, owner, port):
+        self._owners[port] = owner
+        self._ports.setdefault(owner, set()).add(port)
+
+
+# pool shared by all client handlers
+pool = PortPool()
+
+
+def reserve_registered_clients():
+    """
+    Reserves the ports of all clients currently in the registry (e.g. after loading it).
+    :return:
+    """
+    for c in registry.get_all():
+        pool.sync_client(c)
+
+
+def _on_client_event(event, client, previous):
+    if event == DELETED:
+        pool.release(client["uuid"])
+    else:
+        pool.sync_client(client)
+
+
+registry.subscribe(_on_client_event)
@@ -0,0 +1,99 @@
+"""
+SurfaceStreams REST server, TUIO forwarder and their startup and shutdown.
+Only imported by main.py when run as a script: mixer workers and the encoder
+benchmark are spawned processes which re-import main.py, not this module.
+"""
+
+import connexion
+
+from flask import render_template
+from handlers import images
+import video_mixing
+from tuio_forwarding import AsyncTuioForwardingServer
+from database import base
+from client_registry import registry
+import port_pool
+import metrics
+import client_liveness
+import encoding_profiles
+import adaptive_bitrate
+from client_reaper import ClientReaper
+
+# Create the ReST API application instance
+app = connexion.App(__name__, specification_dir='./')
+# Read the swagger.yml file to configure the endpoints
+app.add_api('swagger.yml')
+# Reject oversized uploads before they are parsed (multipart overhead on top of the image)
+app.app.config['MAX_CONTENT_LENGTH'] = images.MAX_IMAGE_SIZE + 1024 * 1024
+# Print TUIO forwarding throughput every n seconds (0 disables)
+TUIO_REPORT_INTERVAL = 0
+# Create the TUIO forwarder instance
+tuio_forwarding = AsyncTuioForwardingServer(
+    ip='0.0.0.0', port=5001, coalesce=True, report_interval=TUIO_REPORT_INTERVAL,
+    on_feedback=adaptive_bitrate.controller.feedback
+)
+metrics.collector.set_tuio_stats(tuio_forwarding.stats)
+# Expire clients with lapsed heartbeat lease or inactive streams
+reaper = ClientReaper(tuio_activity=tuio_forwarding.seconds_since_activity)
+# Keep registered clients and uploaded images across restarts (start with --cold to reset)
+WARM_RESTART = True
+
+
+# Create a URL route in our application for "/"
+@app.route('/')
+def home():
+    """
+    This function just responds to the browser URL
+    localhost:5000/
+    :return:        the rendered template 'home.html'
+    """
+    return render_template('home.html')
+
+
+def server_cleanup(warm=WARM_RESTART):
+    if not warm:
+        images.remove_all()
+    reaper.stop()
+    video_mixing.clear_pipelines()
+    tuio_forwarding.terminate()
+    registry.stop()
+
+
+def server_main(warm=WARM_RESTART):
+    """
+    Starts the server.
+    :param warm: keep clients and images of the last run, falls back to a cold start
+    if the database was written by a build with another schema
+    :return: whether the server was warm started
+    """
+    if warm:
+        missing = base.schema_mismatches()
+        if len(missing) > 0:
+            print("###### database schema outdated, cold start\n  > missing columns", missing)
+            warm = False
+    if warm:
+        # keep the database, drop what went away while the server was down
+        base.create_database()
+        loaded = registry.load()
+        dead = client_liveness.remove_dead_clients()
+        print("###### warm restart\n  > restored clients", loaded - len(dead),
+              "\n  > removed dead clients", len(dead),
+              "\n  > removed images without data", images.remove_missing())
+    else:
+        # the images of the last run are gone with their table, images.remove_all() needs the old schema
+        print("###### cold start\n  > removed stored image files", images.remove_stored_data())
+        base.recreate_database()
+        registry.load()
+    port_pool.reserve_registered_clients()
+    registry.start()
+    tuio_forwarding.start()
+    reaper.start()
+    # all mixing groups are rebuilt from the registry in one reconfiguration, held until
+    # the encoder benchmark picked the cheapest encoder per profile. The REST api is served meanwhile.
+    video_mixing.reconfiguration.submit()
+    encoding_profiles.schedule_selection(
+        video_mixing.MERGED_STREAM_WIDTH, video_mixing.MERGED_STREAM_HEIGHT, video_mixing.MERGED_STREAM_FPS,
+        lambda selection: video_mixing.reconfiguration.start()
+    )
+    app.run(host='0.0.0.0', port=5000)
+    return warm
@@ -1,26 +1,337 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+import multiprocessing
 from database.base import engine
 from database.api import ClientApi
+from client_registry import registry
 from core.tuio.osc_receiver import OscReceiver
-from pythonosc import dispatcher, udp_client
+from pythonosc import dispatcher, osc_bundle, osc_message, osc_message_builder, osc_bundle_builder
 
 
-def forward_tuio_message(path, *lst):
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    for c in c_api.get_clients():
-        if c.tuio_sink_port is None or c.tuio_sink_port <= 0:
-            continue
-        tuio_sink = udp_client.SimpleUDPClient(c.ip, c.tuio_sink_port)
-        tuio_sink.send_message(path, lst)
-    c_api.close()
+# Generation of the client registry, shared with the forwarding process.
+# Bumped via invalidate_forwarding_table() whenever clients change,
+# so the forwarding table only hits the database after a change.
+TABLE_GENERATION = multiprocessing.Value("i", 0)
+
+
+def invalidate_forwarding_table():
+    """
+    Marks all forwarding tables as outdated.
+    Has to be called whenever a client is created, updated or deleted.
+    :return:
+    """
+    with TABLE_GENERATION.get_lock():
+        TABLE_GENERATION.value += 1
+
+
+# OSC address of stream feedback sent by clients to the TUIO port, handled by the server and never forwarded
+FEEDBACK_PATH = "/surfacestreams/feedback"
+
+_FEEDBACK_PREFIX = FEEDBACK_PATH.encode()
+
+
+# bumped once changes are in the database, so forwarding processes reading it are never stale
+registry.subscribe(lambda event, client, previous: invalidate_forwarding_table(), persisted=True)
+
+
+def load_sink_addresses_from_database():
+    with ClientApi(bind=engine) as c_api:
+        return set([
+            (c.ip, c.tuio_sink_port) for c in c_api.get_clients()
+            if c.tuio_sink_port is not None and c.tuio_sink_port > 0
+        ])
+
+
+def load_sink_addresses_from_registry():
+    return set([
+        (c["ip"], c["tuio_sink_port"]) for c in registry.get_all()
+        if c["tuio_sink_port"] is not None and c["tuio_sink_port"] > 0
+    ])
+
+
+def encode_message(path, args):
+    """
+    Encodes an OSC message once, so the same bytes can be sent to all sinks.
+    :param path: OSC address of the message
+    :param args: list of message arguments
+    :return: encoded datagram
+    """
+    builder = osc_message_builder.OscMessageBuilder(address=path)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build().dgram
+
+
+class TuioForwardingTable(object):
+    """
+    In-memory list of TUIO sinks with one reusable udp socket per sink.
+    Sinks are (re)loaded only if the registry generation changed.
+    """
+    def __init__(self, generation=TABLE_GENERATION, load_sink_addresses=load_sink_addresses_from_database,
+                 connect=True):
+        """
+        :param generation: shared registry generation counter
+        :param load_sink_addresses: callable returning the set of (ip, port) sink addresses.
+        Forwarders running in another process than the registry have to load from the database.
+        :param connect: open a connected socket per sink (used by send).
+        Forwarders sending through their own transport only need the addresses.
+        """
+        self._generation = generation
+        self._load_sink_addresses = load_sink_addresses
+        self._connect = connect
+        self._loaded_generation = None
+        self._sinks = {}
+
+    def refresh(self):
+        """
+        Reloads the sinks if the client registry changed since the last load.
+        Sockets of sinks which are still registered are kept.
+        :return:
+        """
+        generation = self._generation.value
+        if generation == self._loaded_generation:
+            return
+        addresses = self._load_sink_addresses()
+        for address in list(self._sinks.keys()):
+            if address not in addresses:
+                sock = self._sinks.pop(address)
+                if sock is not None:
+                    sock.close()
+        for address in addresses:
+            if address not in self._sinks:
+                sock = None
+                if self._connect:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.connect(address)
+                self._sinks[address] = sock
+        self._loaded_generation = generation
+
+    def get_addresses(self):
+        """
+        Returns the (ip, port) addresses of all sinks, refreshed if outdated.
+        :return:
+        """
+        self.refresh()
+        return list(self._sinks.keys())
+
+    def send(self, dgram):
+        """
+        Sends the encoded datagram to all sinks.
+        :param dgram: encoded OSC message or bundle
+        :return:
+        """
+        self.refresh()
+        for address, sock in self._sinks.items():
+            try:
+                sock.send(dgram)
+            except OSError as e:
+                # ICMP port unreachable is reported on the next send, sink may come back
+                print("#### TUIO sink", address, "unreachable:", e)
+
+    def close(self):
+        for sock in self._sinks.values():
+            if sock is not None:
+                sock.close()
+        self._sinks = {}
+        self._loaded_generation = None
 
 
 class TuioForwardingDispatcher(dispatcher.Dispatcher):
-    def __init__(self):
+    def __init__(self, forwarding_table=None):
         super().__init__()
-        self.set_default_handler(forward_tuio_message)
+        self.forwarding_table = forwarding_table if forwarding_table is not None else TuioForwardingTable()
+        self.set_default_handler(self.forward_tuio_message)
+
+    def forward_tuio_message(self, path, *lst):
+        self.forwarding_table.send(encode_message(path, lst))
 
 
 class TuioForwardingServer(OscReceiver):
     def __init__(self, ip, port):
         super().__init__(ip, port, TuioForwardingDispatcher())
+
+
+class ForwardingStats(object):
+    """
+    Throughput and latency counters of the TUIO forwarder.
+    Latency is measured from receiving a datagram until its content was sent to all sinks.
+    """
+    def __init__(self, max_samples=10000):
+        self.messages = 0
+        self.datagrams_sent = 0
+        self.total_messages = 0
+        self.total_datagrams_sent = 0
+        self._latencies = collections.deque(maxlen=max_samples)
+        self._since = time.perf_counter()
+
+    def add_forward(self, num_messages, num_sent, latency):
+        self.messages += num_messages
+        self.datagrams_sent += num_sent
+        self.total_messages += num_messages
+        self.total_datagrams_sent += num_sent
+        self._latencies.append(latency)
+
+    def p99_latency(self):
+        """ p99 forward latency in seconds over the samples of the current period. """
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] if latencies else 0.0
+
+    def report(self, reset=True):
+        """
+        Returns messages/s, sent datagrams/s and p99 forward latency since the last report.
+        :param reset: start a new measuring period
+        :return: dict of stats
+        """
+        now = time.perf_counter()
+        elapsed = max(now - self._since, 1e-9)
+        res = {
+            "messages_per_second": self.messages / elapsed,
+            "datagrams_sent_per_second": self.datagrams_sent / elapsed,
+            "p99_forward_latency_ms": self.p99_latency() * 1000.0
+        }
+        if reset:
+            self.messages = 0
+            self.datagrams_sent = 0
+            self._latencies.clear()
+            self._since = now
+        return res
+
+
+class AsyncTuioForwardingProtocol(asyncio.DatagramProtocol):
+    """
+    Forwards TUIO datagrams to all sinks of the forwarding table without blocking.
+    With coalesce enabled loose /tuio/2Dcur messages of one frame (up to fseq)
+    are sent as a single OSC bundle per sender. Bundles (which already hold a whole frame,
+    of any TUIO profile) and all other messages are passed through unchanged.
+    Feedback messages (FEEDBACK_PATH, not bundled) are passed to on_feedback(uuid, loss) instead.
+    """
+    TUIO_CURSOR_PATH = "/tuio/2Dcur"
+
+    def __init__(self, forwarding_table, coalesce=True, stats=None, on_feedback=None):
+        self.forwarding_table = forwarding_table
+        self.coalesce = coalesce
+        self.stats = stats
+        self.on_feedback = on_feedback
+        self.transport = None
+        # sender ip to time.monotonic() of its last datagram
+        self.last_activity = {}
+        self._frames = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received = time.perf_counter()
+        self.last_activity[addr[0]] = time.monotonic()
+        if data.startswith(_FEEDBACK_PREFIX):
+            self._feedback(data)
+            return
+        if not self.coalesce or osc_bundle.OscBundle.dgram_is_bundle(data):
+            # a bundle is one frame already, splitting it would break the one-bundle-per-frame contract
+            self._forward(data, 1, received)
+            return
+        try:
+            msg = osc_message.OscMessage(data)
+        except osc_message.ParseError:
+            return
+        if msg.address != self.TUIO_CURSOR_PATH:
+            self._forward(data, 1, received)
+            return
+        frame = self._frames.get(addr)
+        if frame is None:
+            frame = self._frames[addr] = (received, [])
+        frame[1].append(msg)
+        if len(msg.params) > 0 and msg.params[0] == "fseq":
+            del self._frames[addr]
+            self._forward(self._bundle(frame[1]), len(frame[1]), frame[0])
+
+    def _feedback(self, data):
+        if self.on_feedback is None:
+            return
+        try:
+            params = osc_message.OscMessage(data).params
+        except osc_message.ParseError:
+            return
+        if len(params) >= 2 and isinstance(params[0], str) and isinstance(params[1], (int, float)):
+            self.on_feedback(params[0], float(params[1]))
+
+    @staticmethod
+    def _bundle(messages):
+        builder = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+        for msg in messages:
+            builder.add_content(msg)
+        return builder.build().dgram
+
+    def _forward(self, dgram, num_messages, received):
+        addresses = self.forwarding_table.get_addresses()
+        for address in addresses:
+            self.transport.sendto(dgram, address)
+        if self.stats is not None:
+            self.stats.add_forward(num_messages, len(addresses), time.perf_counter() - received)
+
+
+class AsyncTuioForwardingServer(object):
+    """
+    asyncio based TUIO forwarder running its own event loop on a background thread.
+    Offers the same start/terminate interface as TuioForwardingServer.
+    """
+    def __init__(self, ip, port, coalesce=True, report_interval=0, on_feedback=None):
+        """
+        :param ip: ip to listen on
+        :param port: port to listen on
+        :param coalesce: bundle /tuio/2Dcur messages of one frame before forwarding
+        :param report_interval: print throughput stats every report_interval seconds (0 disables)
+        :param on_feedback: called as on_feedback(uuid, loss) for stream feedback of clients
+        """
+        self._ip = ip
+        self._port = port
+        self._report_interval = report_interval
+        self.stats = ForwardingStats()
+        self.protocol = AsyncTuioForwardingProtocol(
+            # datagrams are sent through the endpoint transport, no socket per sink needed
+            TuioForwardingTable(load_sink_addresses=load_sink_addresses_from_registry, connect=False),
+            coalesce, self.stats, on_feedback
+        )
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        transport, _ = self._loop.run_until_complete(self._loop.create_datagram_endpoint(
+            lambda: self.protocol, local_addr=(self._ip, self._port)
+        ))
+        if self._report_interval > 0:
+            self._loop.call_later(self._report_interval, self._report)
+        try:
+            self._loop.run_forever()
+        finally:
+            transport.close()
+            self.protocol.forwarding_table.close()
+            self._loop.close()
+
+    def _report(self):
+        stats = self.stats.report()
+        print("#### TUIO forwarding: %.1f msg/s, %.1f sent/s, p99 latency %.3f ms" % (
+            stats["messages_per_second"], stats["datagrams_sent_per_second"], stats["p99_forward_latency_ms"]
+        ))
+        self._loop.call_later(self._report_interval, self._report)
+
+    def seconds_since_activity(self, ip):
+        """ seconds since the last TUIO datagram from the given ip, None if it never sent one. """
+        last = self.protocol.last_activity.get(ip, None)
+        return time.monotonic() - last if last is not None else None
+
+    def terminate(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+            self._thread = None
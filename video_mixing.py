@@ -1,18 +1,24 @@
-import threading
-import gi
+import collections
+import itertools
 import os
-from core.gstreamer.udp_video_mixer import UdpVideoMixer
-from database.api import ClientApi
-from database.base import engine
-gi.require_version("Gst", "1.0")
-gi.require_version("Gtk", "3.0")
-gi.require_version("GstVideo", "1.0")
-from gi.repository import Gst, Gtk, GObject
+import threading
+import time
+from mixer_workers import MixerSupervisor, MixerWorkerError
+from client_registry import registry
+from notifications import hub
+import encoding_profiles
+
 
+def _on_mixer_event(group, event, data):
+    data = dict(data)
+    data["mixing_group"] = group
+    hub.publish(event, data)
 
-PIPELINES = {}
 
-THREAD_RUNNING = False
+# mixer workers per mixing group, each running in its own process
+PIPELINES = MixerSupervisor(on_event=_on_mixer_event)
+
+DEFAULT_GROUP = "default"
 
 DEBUG_GRAPH_DIR = os.getcwd()
 
@@ -20,102 +26,449 @@ MERGED_STREAM_WIDTH = 640
 
 MERGED_STREAM_HEIGHT = 360
 
+MERGED_STREAM_FPS = 30
+
+# 'direct', 'tiled' or 'auto' (see IncrementalVideoMixer)
+MIXING_TOPOLOGY = "auto"
+
+# 'elements' keys and blends with GStreamer elements (IncrementalVideoMixer),
+# 'numpy' in one vectorized pass per layer (NumpyVideoMixer)
+MIXING_BACKEND_NAMES = ["elements", "numpy"]
+
+DEFAULT_MIXING_BACKEND = "elements"
+
+# mixing backend per mixing group, groups without an entry use DEFAULT_MIXING_BACKEND
+MIXING_BACKENDS = {}
+
+# rough number of per-pixel operations (decode, key, blend, encode) one core sustains per second
+PIXEL_OPS_PER_CORE = 250e6
+
+# per-pixel passes for each client with tiled mixing, without its output inputs:
+# decode + keying + 2 shared block composite inputs + encode (2)
+TILED_PASSES_PER_CLIENT = 6
+
+# composites a stream may pass before it reaches an output, each adds an aggregation interval of latency.
+# Tiled mixing of N clients needs ceil(log2(N)) of them.
+MAX_COMPOSITE_DEPTH = 5
+
+# per-thread profiling of all mixers, see set_profiling
+PROFILING = False
+
+# frames per second sent to a client while none of its inputs changes, -1 sends every frame
+KEEPALIVE_FPS = 5.0
+
+# seconds without further changes before queued reconfigurations are applied
+RECONFIGURE_DEBOUNCE = 0.25
+
+# upper bound of the debounce delay while changes keep arriving
+RECONFIGURE_MAX_DELAY = 2.0
+
+# finished jobs kept for status requests
+RECONFIGURE_JOB_HISTORY = 128
+
 os.environ["GST_DEBUG_DUMP_DOT_DIR"] = DEBUG_GRAPH_DIR
 os.putenv('GST_DEBUG_DUMP_DIR_DIR', DEBUG_GRAPH_DIR)
 
 
-def _run_thread():
+def estimate_client_capacity(width=None, height=None, cores=None):
     """
-    Function executed on separate thread,
-    to keep GStreamer MainLoop and Server running concurrently.
-    :return:
+    Estimates how many clients this host can mix at the merged stream size.
+    Assumes tiled mixing, where each output blends 2 * ceil(log2(N)) + 1 inputs
+    and the composite tree is at most MAX_COMPOSITE_DEPTH deep.
+    :param width: merged stream width, defaults to MERGED_STREAM_WIDTH
+    :param height: merged stream height, defaults to MERGED_STREAM_HEIGHT
+    :param cores: number of cores, defaults to all cores of this host
+    :return: estimated number of clients
     """
-    GObject.threads_init()
-    Gst.init(None)
-    Gtk.main()
+    width = width if width is not None else MERGED_STREAM_WIDTH
+    height = height if height is not None else MERGED_STREAM_HEIGHT
+    cores = cores if cores is not None else (os.cpu_count() or 1)
+    budget = cores * PIXEL_OPS_PER_CORE / (width * height * MERGED_STREAM_FPS)
+    clients = 1
+    while clients < 2 ** MAX_COMPOSITE_DEPTH:
+        n = clients + 1
+        passes = TILED_PASSES_PER_CLIENT + 2 * (n - 1).bit_length() + 1
+        if n * passes > budget:
+            break
+        clients = n
+    return clients
 
 
-def _ensure_gtk_thread_running():
+def group_clients(clients):
     """
-    Checks if GStreamer MainLoop thread is running
-    and runs it if not.
-    :return:
+    Splits clients into their mixing groups.
+    Clients with encoding profile get its resolved encoder settings as 'encoding'.
+    :param clients: list of client dicts
+    :return: dict of group name to list of client dicts
     """
-    global THREAD_RUNNING
-    if not THREAD_RUNNING:
-        gtk_main = threading.Thread(target=_run_thread)
-        gtk_main.start()
-        THREAD_RUNNING = True
+    groups = {}
+    for c in clients:
+        encoding = encoding_profiles.resolve(c.get("encoding_profile") or "")
+        if encoding is not None:
+            c["encoding"] = encoding
+        group = c.get("mixing_group") or DEFAULT_GROUP
+        groups.setdefault(group, []).append(c)
+    return groups
 
 
-def create_multi_mixing_pipeline(mode="other"):
+def create_multi_mixing_pipeline(group, clients, backend=None):
     """
-    Creates a SurfaceStream video mixing pipeline.
-    :param CLIENTS: client dicts denoting connection and stream descriptive data.
-    :param mode: use 'other' to only merge streams of other clients connected for each client.
-    use 'all' to merge alle streams.
-    :return:
+    Creates a SurfaceStream video mixing pipeline for one mixing group in a worker process.
+    The mixing mode of each client is applied per output branch,
+    'other' only merges streams of other clients, 'all' merges all streams.
+    :param group: name of the mixing group
+    :param clients: client dicts denoting connection and stream descriptive data.
+    :param backend: mixing backend (see MIXING_BACKEND_NAMES), None uses the backend configured for the group
+    :return: the mixer worker of the group
     """
     global MERGED_STREAM_WIDTH, MERGED_STREAM_HEIGHT
 
-    clear_pipelines()
-    _ensure_gtk_thread_running()
-
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    clients = c_api.get_clients()
-    print("################# CREATING MULTI MIXING PIPELINE")
-    mixer = UdpVideoMixer(
-        [c.as_dict() for c in clients],
-        default_mode=mode,
-        width=MERGED_STREAM_WIDTH,
-        height=MERGED_STREAM_HEIGHT
+    remove_pipeline(group)
+
+    if backend is None:
+        backend = MIXING_BACKENDS.get(group, DEFAULT_MIXING_BACKEND)
+    print("################# CREATING MULTI MIXING PIPELINE", group, "backend", backend)
+    worker = PIPELINES.ensure(
+        group, MERGED_STREAM_WIDTH, MERGED_STREAM_HEIGHT, MIXING_TOPOLOGY, backend, MERGED_STREAM_FPS
     )
-    i = 0
-    uuid = ""
-    for c in clients:
-        mixer.set_in_port(c.video_src_port, i)
-        mixer.set_out_address(c.ip, i)
-        mixer.set_out_port(c.video_sink_port, i)
-        uuid = c.uuid
-        print("#### CLIENT "+ str(i))
-        print(" > video_src_port" + str(c.video_src_port))
-        print(" > ip" + str(c.ip))
-        print(" > video_sink_port" + str(c.video_sink_port))
-        i += 1
-    PIPELINES[uuid] = mixer
-    c_api.close()
-    mixer.start()
-
-
-def update_pipelines():
-    """
-    Function to update current SurfaceStreams pipeline based on connected clients
+    if PROFILING:
+        worker.profile(True)
+    worker.keepalive(KEEPALIVE_FPS)
+    changes = worker.sync(clients)
+    hub.publish("pipeline-created", {
+        "mixing_group": group, "backend": backend, "clients": [c["uuid"] for c in clients], "changed_branches": changes
+    })
+    return worker
+
+
+def update_pipelines(only_groups=None):
+    """
+    Function to update current SurfaceStreams pipelines based on connected clients.
+    Each mixing group is reconfigured by its own worker, only the branches
+    of clients which joined, left or changed are touched.
+    :param only_groups: names of the mixing groups to update, None updates all groups.
+    :return: success of the update
+    """
+    groups = group_clients(registry.get_all())
+
+    for group in PIPELINES.groups():
+        if group not in groups and (only_groups is None or group in only_groups):
+            remove_pipeline(group)
+
+    success = True
+    for group, clients in groups.items():
+        if only_groups is not None and group not in only_groups:
+            continue
+        worker = PIPELINES.get(group)
+        try:
+            if worker is None or worker.backend != MIXING_BACKENDS.get(group, DEFAULT_MIXING_BACKEND):
+                # a backend switch needs a fresh worker, create_multi_mixing_pipeline stops the old one
+                create_multi_mixing_pipeline(group, clients)
+                continue
+            if worker.width != MERGED_STREAM_WIDTH or worker.height != MERGED_STREAM_HEIGHT \
+                    or worker.fps != MERGED_STREAM_FPS:
+                worker.resize(MERGED_STREAM_WIDTH, MERGED_STREAM_HEIGHT, MERGED_STREAM_FPS)
+            changes = worker.sync(clients)
+            print("###### reconfigured pipeline", group, "\n  > changed branches", changes)
+            hub.publish("pipeline-updated", {
+                "mixing_group": group, "clients": [c["uuid"] for c in clients], "changed_branches": changes
+            })
+        except MixerWorkerError as e:
+            print("###### could not update pipeline", group, "\n  >", e)
+            hub.publish("pipeline-error", {"mixing_group": group, "error": str(e)})
+            success = False
+
+    return success
+
+
+class ReconfigurationJob(object):
+    """
+    Handle of a queued pipeline reconfiguration.
+    status is 'pending', 'running', 'done' or 'failed',
+    generation the pipeline generation which applied the job.
+    """
+    def __init__(self, job_id):
+        self.id = job_id
+        self.groups = set()
+        self.all_groups = False
+        self.status = "pending"
+        self.generation = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "groups": None if self.all_groups else sorted(self.groups),
+            "generation": self.generation,
+            "submitted": self.submitted,
+            "finished": self.finished
+        }
+
+
+class ReconfigurationQueue(object):
+    """
+    Single consumer of pipeline reconfigurations.
+    Changes submitted while a job is pending are merged into it, the job is applied
+    once no change arrived for RECONFIGURE_DEBOUNCE seconds (or after RECONFIGURE_MAX_DELAY),
+    so a burst of client changes results in a single update_pipelines call.
+    Jobs submitted before start are held, so no mixer is built before the server is ready.
+    """
+    def __init__(self):
+        self.generation = 0
+        self._ids = itertools.count(1)
+        self._jobs = collections.OrderedDict()
+        self._pending = None
+        self._running = None
+        self._last_change = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts applying queued and future jobs.
+        :return:
+        """
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pipeline-reconfiguration", daemon=True)
+                self._thread.start()
+
+    def submit(self, groups=None):
+        """
+        Queues a reconfiguration of the given mixing groups.
+        :param groups: names of the mixing groups to update, None updates all groups
+        :return: the pending ReconfigurationJob covering this change
+        """
+        with self._condition:
+            if self._pending is None:
+                self._pending = ReconfigurationJob(next(self._ids))
+                self._add_job(self._pending)
+            if groups is None:
+                self._pending.all_groups = True
+            else:
+                self._pending.groups.update(groups)
+            self._last_change = time.monotonic()
+            self._condition.notify()
+            return self._pending
+
+    def get_job(self, job_id):
+        with self._condition:
+            return self._jobs.get(job_id, None)
+
+    def current_job(self):
+        """
+        Returns the newest job, which includes all changes submitted so far.
+        """
+        with self._condition:
+            if len(self._jobs) == 0:
+                return None
+            return next(reversed(self._jobs.values()))
+
+    def status(self):
+        with self._condition:
+            return {
+                "generation": self.generation,
+                "pending_job": self._pending.as_dict() if self._pending is not None else None,
+                "running_job": self._running.as_dict() if self._running is not None else None,
+                "groups": PIPELINES.groups()
+            }
+
+    def _add_job(self, job):
+        self._jobs[job.id] = job
+        while len(self._jobs) > RECONFIGURE_JOB_HISTORY:
+            self._jobs.popitem(last=False)
+
+    def _next_job(self):
+        with self._condition:
+            while self._pending is None:
+                self._condition.wait()
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                wait = min(self._last_change + RECONFIGURE_DEBOUNCE, started + RECONFIGURE_MAX_DELAY) - now
+                if wait <= 0:
+                    break
+                self._condition.wait(wait)
+            job, self._pending = self._pending, None
+            job.status = "running"
+            self._running = job
+            return job
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                success = update_pipelines(None if job.all_groups else job.groups)
+            except Exception as e:
+                print("###### pipeline reconfiguration failed\n  >", e)
+                success = False
+            with self._condition:
+                self.generation += 1
+                job.generation = self.generation
+                job.status = "done" if success else "failed"
+                job.finished = time.time()
+                self._running = None
+            hub.publish("pipeline-generation", {"generation": job.generation, "job": job.as_dict()})
+
+
+# reconfigurations are applied by a single consumer thread, never in request handlers
+reconfiguration = ReconfigurationQueue()
+
+
+def _on_client_event(event, client, previous):
+    """
+    Registry subscription, queues an update of the mixing group(s) of a changed client.
+    """
+    groups = set([client.get("mixing_group") or DEFAULT_GROUP])
+    if previous is not None:
+        groups.add(previous.get("mixing_group") or DEFAULT_GROUP)
+    reconfiguration.submit(groups)
+
+
+registry.subscribe(_on_client_event)
+
+
+def tune_client(uuid, bitrate=-1, fps=-1):
+    """
+    Changes bitrate and frame rate of a client's merged stream without reconfiguring its pipeline.
+    :param uuid: uuid of the client
+    :param bitrate: bitrate in kbit/s, -1 restores the configured bitrate
+    :param fps: maximum frame rate, -1 removes the limit
+    :return: success of the change
+    """
+    client = registry.get(uuid)
+    if client is None:
+        return False
+    worker = PIPELINES.get(client.get("mixing_group") or DEFAULT_GROUP)
+    if worker is None:
+        return False
+    try:
+        return worker.tune(uuid, bitrate, fps)
+    except MixerWorkerError as e:
+        print("###### could not tune stream of", uuid, "\n  >", e)
+        return False
+
+
+def get_output_bitrate(uuid):
+    """
+    Reads the bitrate the encoder of a client's merged stream currently uses.
+    :param uuid: uuid of the client
+    :return: bitrate in kbit/s, -1 if unknown or the encoder has no bitrate control
+    """
+    client = registry.get(uuid)
+    if client is None:
+        return -1
+    worker = PIPELINES.get(client.get("mixing_group") or DEFAULT_GROUP)
+    if worker is None:
+        return -1
+    try:
+        stats = worker.request("stats")
+    except MixerWorkerError as e:
+        print("###### could not read bitrate of", uuid, "\n  >", e)
+        return -1
+    return stats.get(uuid, {}).get("out", {}).get("bitrate", -1)
+
+
+def set_mixing_backend(group, backend):
+    """
+    Selects the mixing backend of a mixing group.
+    A running mixer of the group is rebuilt by the reconfiguration queue.
+    :param group: name of the mixing group
+    :param backend: one of MIXING_BACKEND_NAMES
+    :return: the reconfiguration job or None if the backend did not change
+    """
+    if backend not in MIXING_BACKEND_NAMES:
+        raise ValueError("unknown mixing backend " + backend)
+    MIXING_BACKENDS[group] = backend
+    worker = PIPELINES.get(group)
+    if worker is None or worker.backend == backend:
+        return None
+    return reconfiguration.submit([group])
+
+
+def set_profiling(enabled):
+    """
+    Switches profiling of all mixer workers on or off at runtime, the running pipelines are kept.
+    GStreamer tracers are only read by Gst.init, they can be enabled for all workers
+    by starting the server with GST_TRACERS set.
+    :param enabled: profiling state
     :return:
     """
-    c_api = ClientApi(bind=engine)
-    c_api.open()
-    len_clients = len(c_api.get_clients())
-    c_api.close()
+    global PROFILING
+    PROFILING = enabled
+    for group in PIPELINES.groups():
+        worker = PIPELINES.get(group)
+        if worker is None:
+            continue
+        try:
+            worker.profile(enabled)
+        except MixerWorkerError as e:
+            print("###### could not switch profiling of pipeline", group, "\n  >", e)
 
-    if len_clients == 0:
-        clear_pipelines()
-    else:
-        create_multi_mixing_pipeline(mode="other" if len_clients > 1 else "all")
 
-    return True
+def set_keepalive_fps(fps):
+    """
+    Sets the frame rate of merged streams whose inputs do not change.
+    :param fps: keep-alive frames per second, -1 disables duplicate frame suppression
+    :return:
+    """
+    global KEEPALIVE_FPS
+    KEEPALIVE_FPS = fps
+    for group in PIPELINES.groups():
+        worker = PIPELINES.get(group)
+        if worker is None:
+            continue
+        try:
+            worker.keepalive(fps)
+        except MixerWorkerError as e:
+            print("###### could not set keep-alive rate of pipeline", group, "\n  >", e)
+
+
+def get_profiling():
+    """
+    Collects the profiling data of all mixer workers.
+    :return: dict of mixing group to profile (see IncrementalVideoMixer.get_profile)
+    """
+    profiles = {}
+    for group in PIPELINES.groups():
+        worker = PIPELINES.get(group)
+        if worker is None:
+            continue
+        try:
+            profiles[group] = worker.request("profiling")
+        except MixerWorkerError as e:
+            print("###### could not read profile of pipeline", group, "\n  >", e)
+    return profiles
+
+
+def get_pipeline_stats():
+    """
+    Collects the branch counters of all mixer workers.
+    :return: dict of client uuid to {"in": {...}, "out": {...}} counters
+    """
+    stats = {}
+    for group in PIPELINES.groups():
+        worker = PIPELINES.get(group)
+        if worker is None:
+            continue
+        try:
+            stats.update(worker.request("stats"))
+        except MixerWorkerError as e:
+            print("###### could not read stats of pipeline", group, "\n  >", e)
+    return stats
 
 
-def remove_pipeline(uuid):
+def remove_pipeline(group):
     """
-    Deletes pipeline referenced by given uuid.
-    :param uuid: uuid of pipeline to remove.
+    Stops the mixer worker of the given mixing group.
+    :param group: name of the mixing group.
     :return:
     """
-    if uuid in PIPELINES:
-        PIPELINES[uuid].cleanup()
-        del PIPELINES[uuid]
-        print("###### removed pipeline\n  > pipelines", PIPELINES.keys())
+    if PIPELINES.stop(group):
+        print("###### removed pipeline\n  > pipelines", PIPELINES.groups())
+        hub.publish("pipeline-removed", {"mixing_group": group})
         return True
     else:
         return False
@@ -123,9 +476,7 @@ def remove_pipeline(uuid):
 
 def clear_pipelines():
     """
-    Deletes all SurfaceStream pipelines.
+    Stops all SurfaceStream mixer workers.
     :return:
     """
-    uuid_list = [k for k in PIPELINES.keys()]
-    for uuid in uuid_list:
-        remove_pipeline(uuid)
\ No newline at end of file
+    PIPELINES.stop_all()